@@ -0,0 +1,457 @@
+"""On-disk caches of results that are expensive to recompute.
+
+Entries are content-keyed: the key of an entry includes a digest of the simulation and circuit
+configs, so that a cache directory can be shared by runs on different circuits, and the keys of
+the simulated results (holding currents, trials) a digest of the compiled mechanisms and of the
+bluecellulab version.
+"""
+
+import hashlib
+import importlib.metadata
+import io
+import json
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from bluepysnap import Simulation
+
+from psp_validation import PSPError
+
+L = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIRNAME = ".psp-cache"
+HOLDING_CURRENT = "holding_current"
+CONNECTIVITY = "connectivity"
+SIMULATION = "simulation"
+NOISE = "noise"
+SECTIONS = (HOLDING_CURRENT, CONNECTIVITY, SIMULATION, NOISE)
+
+SIMULATION_CACHE_VERSION = "1.0"
+NOISE_BANK_VERSION = "1.0"
+# default size limit of the simulation cache [MB]
+DEFAULT_SIMULATION_CACHE_MAX_SIZE = 10240.0
+# number of results waiting to be written by the background thread of the simulation cache
+# before `put` blocks
+SIMULATION_CACHE_MAX_PENDING = 16
+
+# environment variable with the path to the compiled mechanisms used by bluecellulab
+MOD_LIBRARY_PATH_VAR = "BLUECELLULAB_MOD_LIBRARY_PATH"
+# compiled mechanisms loaded by NEURON from the working directory
+DEFAULT_MOD_LIBRARIES = tuple(
+    f"{arch}/{lib}"
+    for arch in ("x86_64", "arm64")
+    for lib in ("libnrnmech.so", ".libs/libnrnmech.so")
+)
+
+
+def config_digest(sonata_simulation_config):
+    """Get a digest of the simulation config and of the circuit config it refers to.
+
+    Note: the contents of the circuit files (nodes, edges, morphologies...) are not hashed;
+    the cache has to be cleared if they are modified in place.
+    """
+    sha = hashlib.sha256()
+    sonata_simulation_config = pathlib.Path(sonata_simulation_config)
+    sha.update(sonata_simulation_config.read_bytes())
+
+    circuit_config = pathlib.Path(Simulation(sonata_simulation_config).config["network"])
+    if circuit_config.exists():
+        sha.update(circuit_config.read_bytes())
+    else:
+        sha.update(str(circuit_config).encode())
+
+    return sha.hexdigest()
+
+
+def mechanisms_digest():
+    """Get a digest of the compiled mechanisms (path, size and modification time).
+
+    The mechanisms are looked up like bluecellulab and NEURON do: from the path in the
+    BLUECELLULAB_MOD_LIBRARY_PATH environment variable, or in the working directory.
+    The version of bluecellulab, which loads them, is part of the digest.
+    """
+    paths = [os.environ[MOD_LIBRARY_PATH_VAR]] if MOD_LIBRARY_PATH_VAR in os.environ else []
+    paths += [path for path in DEFAULT_MOD_LIBRARIES if pathlib.Path(path).exists()]
+
+    key = [importlib.metadata.version("bluecellulab")]
+    for library in paths:
+        path = pathlib.Path(library).resolve()
+        if path.is_file():
+            stat = path.stat()
+            key.append([str(path), stat.st_size, stat.st_mtime_ns])
+        else:
+            key.append([str(path)])
+    return hash_key(key)
+
+
+def _json_default(value):
+    """Serialize the NumPy scalars and arrays of the cache keys."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def hash_key(key):
+    """Get the file name stem of a cache entry from its JSON serializable key."""
+    return hashlib.sha256(json.dumps(key, default=_json_default).encode()).hexdigest()
+
+
+def _write_json_atomic(path, data):
+    """Write JSON file so that concurrent readers never see a partially written file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, suffix=".tmp", delete=False, encoding="utf-8"
+    ) as f:
+        json.dump(data, f)
+    pathlib.Path(f.name).replace(path)
+
+
+class HoldingCurrentCache:
+    """Cache of the holding currents.
+
+    Each entry is a small JSON file named after the hash of
+    (config digest, mechanisms digest, post node id, hold_V, post_ttx).
+    """
+
+    def __init__(self, cache_dir, sonata_simulation_config):
+        """The HoldingCurrentCache constructor.
+
+        Args:
+            cache_dir (pathlib.Path): path to the cache directory
+            sonata_simulation_config (pathlib.Path): path to Sonata simulation config
+        """
+        self.path = pathlib.Path(cache_dir) / HOLDING_CURRENT
+        self.digest = config_digest(sonata_simulation_config)
+        self.mechanisms = mechanisms_digest()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, post_gid, hold_V, post_ttx):
+        key = [
+            self.digest,
+            self.mechanisms,
+            post_gid.population,
+            int(post_gid.id),
+            float(hold_V),
+            bool(post_ttx),
+        ]
+        return self.path / f"{hash_key(key)}.json"
+
+    def get(self, post_gid, hold_V, post_ttx):
+        """Get the cached holding current [nA], or None if it is not cached."""
+        try:
+            with self._entry_path(post_gid, hold_V, post_ttx).open(encoding="utf-8") as f:
+                hold_i = json.load(f)["hold_I"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return hold_i
+
+    def put(self, post_gid, hold_V, post_ttx, hold_I):
+        """Store the holding current [nA]."""
+        _write_json_atomic(
+            self._entry_path(post_gid, hold_V, post_ttx),
+            {
+                "config": self.digest,
+                "mechanisms": self.mechanisms,
+                "post_population": post_gid.population,
+                "post_id": int(post_gid.id),
+                "hold_V": float(hold_V),
+                "post_ttx": bool(post_ttx),
+                "hold_I": float(hold_I),
+            },
+        )
+
+    def log_stats(self):
+        """Log the hit / miss statistics."""
+        L.info("Holding current cache: %d hit(s), %d miss(es)", self.hits, self.misses)
+
+
+class SimulationCache:
+    """Cache of the results of the pair simulation trials.
+
+    Each entry is a compressed NumPy file with the (params, time, current, voltage) result of a
+    trial, named after the hash of the config and mechanisms digests and of all the inputs of the
+    trial (pre and post nodes, stimulus, holding, seed, time steps...).
+
+    The least recently used entries are removed once the cache exceeds `max_size`.
+
+    With `background`, the entries are compressed and written in a background thread, so that
+    `put` does not hold the thread collecting the simulation results; closing the cache (also
+    when used as a context manager) writes the pending entries. An error raised in the
+    background thread is raised again by the next call to `put` or `close`.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        sonata_simulation_config,
+        max_size=DEFAULT_SIMULATION_CACHE_MAX_SIZE,
+        background=False,
+    ):
+        """The SimulationCache constructor.
+
+        Args:
+            cache_dir (pathlib.Path): path to the cache directory
+            sonata_simulation_config (pathlib.Path): path to Sonata simulation config
+            max_size (float): size limit of the simulation cache [MB] (None for no limit)
+            background (bool): write the entries in a background thread
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.path = self.cache_dir / SIMULATION
+        self.digest = hash_key(
+            [SIMULATION_CACHE_VERSION, config_digest(sonata_simulation_config), mechanisms_digest()]
+        )
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._queue = None
+        self._thread = None
+        self._error = None
+        if background:
+            self._queue = queue.Queue(maxsize=SIMULATION_CACHE_MAX_PENDING)
+            self._thread = threading.Thread(
+                target=self._run, name="simulation-cache-writer", daemon=True
+            )
+            self._thread.start()
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *_):
+        """Write the pending entries when exiting the context."""
+        self.close()
+
+    def _run(self):
+        while (args := self._queue.get()) is not None:
+            # after an error, the remaining entries are dropped, to never block `put`
+            if self._error is None:
+                try:
+                    self._write(*args)
+                except Exception as e:  # noqa: BLE001 (raised again by `put` or `close`)
+                    L.exception("Could not write to the simulation cache %s", self.path)
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise PSPError(f"Could not write to the simulation cache {self.path}") from self._error
+
+    def _entry_path(self, trial):
+        return self.path / f"{hash_key([self.digest, sorted(trial.items())])}.npz"
+
+    def get(self, trial):
+        """Get the cached result of a trial, or None if it is not cached.
+
+        Args:
+            trial (dict): all the inputs of the trial
+
+        Returns:
+            (params, time, current, voltage) tuple, as returned by the simulation
+        """
+        path = self._entry_path(trial)
+        try:
+            with np.load(path) as data:
+                result = (
+                    json.loads(str(data["params"])),
+                    data["time"],
+                    data["current"][()] if data["current"].ndim == 0 else data["current"],
+                    data["voltage"],
+                )
+            # the modification time of the entries tells the least recently used ones
+            path.touch()
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, trial, result):
+        """Store the result of a trial.
+
+        With `background`, the result is queued to be written, and its arrays must not be
+        modified once queued.
+
+        Args:
+            trial (dict): all the inputs of the trial
+            result (tuple): (params, time, current, voltage) tuple, as returned by the simulation
+        """
+        if self._thread is None:
+            self._write(trial, result)
+            return
+        self._raise_error()
+        self._queue.put((trial, result))
+
+    def _write(self, trial, result):
+        """Write the entry of a trial, and prune the cache beyond its size limit."""
+        params, time, current, voltage = result
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            params=json.dumps(params, default=_json_default),
+            time=time,
+            current=current,
+            voltage=voltage,
+        )
+
+        path = self._entry_path(trial)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            f.write(buffer.getbuffer())
+        pathlib.Path(f.name).replace(path)
+
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = get_cache_info(self.cache_dir)[SIMULATION]["size"]
+            else:
+                self._size += buffer.getbuffer().nbytes
+            if self._size > self.max_size * 1024**2:
+                prune_cache(self.cache_dir, self.max_size)
+                self._size = get_cache_info(self.cache_dir)[SIMULATION]["size"]
+
+    def close(self):
+        """Write the pending entries, and stop the background thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def log_stats(self):
+        """Log the hit / miss statistics."""
+        L.info("Simulation cache: %d hit(s), %d miss(es)", self.hits, self.misses)
+
+
+class NoiseBank:
+    """Bank of the OU noise added to the trials of the pairs by `cv-validation calibrate`.
+
+    Each entry is a NumPy file with the (trials x T) float32 noise of a pair, named after the hash
+    of the pair, its base seed, the number of time samples, the time step and the OU parameters.
+    An entry is generated once and read memory-mapped, so that the trial i of a pair gets the same
+    noise for all the NRRP values (common random numbers) and for the next calibrations.
+
+    The noise of a trial does not depend on the number of trials: an entry with fewer trials than
+    needed is generated again with more trials, and the noise of the first ones is unchanged.
+    """
+
+    def __init__(self, cache_dir):
+        """The NoiseBank constructor.
+
+        Args:
+            cache_dir (pathlib.Path): path to the cache directory
+        """
+        self.path = pathlib.Path(cache_dir) / NOISE
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, pair, base_seed, n_samples, dt, ou_params):
+        key = [NOISE_BANK_VERSION, pair, int(base_seed), int(n_samples), float(dt), ou_params]
+        return self.path / f"{hash_key(key)}.npy"
+
+    def get(self, pair, base_seed, n_trials, t, protocol):
+        """Get the noise of the trials of a pair, generating it if it is not in the bank.
+
+        Args:
+            pair (str): name of the pair
+            base_seed (int): base seed of the pair
+            n_trials (int): minimum number of trials
+            t (np.ndarray): time of the traces of the pair
+            protocol (dict): protocol of the pathway, with the `tau`, `sigma` and `ou_method`
+                (default: "euler") of the noise
+
+        Returns:
+            read-only memory-mapped array of the noise, with at least `n_trials` rows and a column
+            per time sample (the noise of the trial i of the pair is the row i)
+        """
+        # scipy is only required by cv-validation
+        from psp_validation.cv_validation.ou_generator import ou_noise  # noqa: PLC0415
+
+        dt = t[1] - t[0]
+        ou_params = [
+            float(protocol["tau"]),
+            float(protocol["sigma"]),
+            protocol.get("ou_method", "euler"),
+        ]
+        path = self._entry_path(pair, base_seed, len(t), dt, ou_params)
+        try:
+            noise = np.load(path, mmap_mode="r")
+            if len(noise) >= n_trials:
+                self.hits += 1
+                return noise
+        except (OSError, ValueError):
+            pass
+
+        self.misses += 1
+        # independent of the generator of the random resamples, seeded by the base seed
+        rng = np.random.default_rng(np.random.SeedSequence(int(base_seed), spawn_key=(0,)))
+        tau, sigma, method = ou_params
+        noise = ou_noise((n_trials, len(t)), dt, tau, sigma, rng, method=method)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            np.save(f, noise)
+        pathlib.Path(f.name).replace(path)
+        return np.load(path, mmap_mode="r")
+
+    def log_stats(self):
+        """Log the hit / miss statistics."""
+        L.info("Noise bank: %d hit(s), %d miss(es)", self.hits, self.misses)
+
+
+def get_cache_info(cache_dir):
+    """Get the number of entries and the size [bytes] of each cache section."""
+    cache_dir = pathlib.Path(cache_dir)
+    info = {}
+    for section in SECTIONS:
+        files = [path for path in (cache_dir / section).glob("*") if path.is_file()]
+        info[section] = {
+            "entries": len(files),
+            "size": sum(path.stat().st_size for path in files),
+        }
+    return info
+
+
+def clear_cache(cache_dir, sections=SECTIONS):
+    """Remove all the entries of the given cache sections."""
+    cache_dir = pathlib.Path(cache_dir)
+    for section in sections:
+        if (cache_dir / section).exists():
+            L.info("Clearing %s cache in %s", section, cache_dir)
+            shutil.rmtree(cache_dir / section)
+
+
+def prune_cache(cache_dir, max_size, sections=(SIMULATION,)):
+    """Remove the least recently used entries of the cache sections, down to `max_size` [MB].
+
+    Returns:
+        (int, int): number of removed entries, and their size [bytes]
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    entries = sorted(
+        (path.stat().st_mtime_ns, path.stat().st_size, path)
+        for section in sections
+        for path in (cache_dir / section).glob("*")
+        if path.is_file()
+    )
+    size = sum(entry[1] for entry in entries)
+    removed, freed = 0, 0
+    for _, entry_size, path in entries:
+        if size - freed <= max_size * 1024**2:
+            break
+        path.unlink(missing_ok=True)
+        removed += 1
+        freed += entry_size
+
+    if removed:
+        L.info("Pruned %d cache entries (%.1f MB) in %s", removed, freed / 1024**2, cache_dir)
+    return removed, freed
@@ -0,0 +1,147 @@
+"""Checkpoints of `psp run`, to resume an interrupted run without simulating the pairs again.
+
+The checkpoint of a pathway is a JSON lines file: the first line is a header with the parameters
+of the run and the sampled pairs, and each following line records a completed pair (its PSP
+amplitude and the data needed for the summary), in the order the pairs were processed.
+Lines are flushed to disk as soon as they are written; a partially written last line (e.g. if the
+process was killed) is ignored when the checkpoint is loaded.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import signal
+import tempfile
+import threading
+
+import numpy as np
+
+from psp_validation import PSPError
+
+L = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = "1.0"
+
+
+class Terminated(SystemExit):
+    """Raised in the main thread when the process receives SIGTERM (see `handle_sigterm`)."""
+
+    def __init__(self):
+        """Exit with the status of a process killed by SIGTERM."""
+        super().__init__(128 + signal.SIGTERM)
+
+
+def _raise_terminated(*_):
+    # the results in flight are written on the way out: later SIGTERMs must not interrupt that
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    L.warning("SIGTERM received, writing the results already simulated before exiting...")
+    raise Terminated
+
+
+@contextlib.contextmanager
+def handle_sigterm():
+    """Raise `Terminated` in the main thread when SIGTERM is received, in this context.
+
+    Unlike the default behavior (exiting at once), this lets the context managers and the
+    `except Terminated` clauses on the way out write the results, as on KeyboardInterrupt.
+    Outside of the main thread, the handler can not be installed and nothing is done.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    previous = signal.signal(signal.SIGTERM, _raise_terminated)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def _json_default(value):
+    """Serialize the NumPy scalars and arrays of the checkpoints."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _dumps(data):
+    return json.dumps(data, default=_json_default)
+
+
+def normalize(data):
+    """Get `data` as it is read back from a checkpoint (e.g. tuples as lists)."""
+    return json.loads(_dumps(data))
+
+
+def load_checkpoint(path):
+    """Load a checkpoint.
+
+    Args:
+        path (pathlib.Path): path to the checkpoint
+
+    Returns:
+        (header, records): the header dict, and the list of the records of the completed pairs
+    """
+    lines = pathlib.Path(path).read_text(encoding="utf-8").splitlines()
+
+    try:
+        header = json.loads(lines[0])
+    except (IndexError, json.JSONDecodeError) as e:
+        raise PSPError(f"Invalid checkpoint: {path}") from e
+    if header.get("version") != CHECKPOINT_VERSION:
+        raise PSPError(f"Unsupported checkpoint version: {header.get('version')}")
+
+    records = []
+    for number, line in enumerate(lines[1:], 2):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            if number < len(lines):
+                raise PSPError(f"Invalid checkpoint: {path}, line {number}") from e
+            L.warning("Ignoring the partially written last record of %s", path)
+
+    return header, records
+
+
+class CheckpointWriter:
+    """Record the completed pairs of a pathway in a checkpoint."""
+
+    def __init__(self, path, header, records=()):
+        """Create the checkpoint, or overwrite the existing one.
+
+        The header and the `records` kept from a previous run are written to a temporary file
+        first, that replaces the checkpoint at once.
+
+        Args:
+            path (pathlib.Path): path to the checkpoint
+            header (dict): parameters of the run and sampled pairs
+            records (list): records of the pairs already completed
+        """
+        self.path = pathlib.Path(path)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.path.parent, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as f:
+            for data in [{**header, "version": CHECKPOINT_VERSION}, *records]:
+                f.write(_dumps(data) + "\n")
+        pathlib.Path(f.name).replace(self.path)
+        self._file = self.path.open("a", encoding="utf-8")
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the checkpoint when exiting the context."""
+        self.close()
+
+    def write(self, record):
+        """Record a completed pair, and flush it to disk."""
+        self._file.write(_dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """Close the checkpoint."""
+        self._file.close()
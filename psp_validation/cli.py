@@ -1,8 +1,11 @@
 """PSP analysis toolkit.
 
-* `psp run`     Run pair simulations for given pathway(s)
-* `psp summary` Collect `psp run` summary output
-* `psp plot`    Plot voltage / current traces obtained with `psp run`
+* `psp run`       Run pair simulations for given pathway(s)
+* `psp reanalyze` Extract PSP amplitudes from the traces dumped by `psp run`
+* `psp merge`     Combine the results of the shards of `psp run --shard`
+* `psp summary`   Collect `psp run` summary output
+* `psp plot`      Plot voltage / current traces obtained with `psp run`
+* `psp cache`     Inspect / prune / clear the cache of `psp run`
 """
 
 import logging
@@ -10,10 +13,26 @@ import logging
 import click
 
 from psp_validation import setup_logging
+from psp_validation.cache import DEFAULT_SIMULATION_CACHE_MAX_SIZE
+from psp_validation.executors import DEFAULT_MAX_RSS, LOCAL_BACKENDS, SIMULATION_BACKENDS
+from psp_validation.pathways import DEFAULT_MIN_TRIALS
 from psp_validation.utils import CLICK_DIR, CLICK_FILE, load_yaml
 from psp_validation.version import __version__
 
 
+def _parse_shard(_ctx, _param, value):
+    """Parse a K/N shard option into a (K, N) tuple."""
+    if value is None:
+        return None
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter(f"expected K/N, got {value}") from None
+    if not 0 <= index < count:
+        raise click.BadParameter(f"expected 0 <= K < N, got {value}")
+    return index, count
+
+
 @click.group()
 @click.version_option(version=__version__)
 @click.option("-v", "--verbose", count=True, help="-v for INFO, -vv for DEBUG")
@@ -44,7 +63,11 @@ def cli(verbose=0):
     "-n", "--num-pairs", type=int, required=True, help="Sample NUM_PAIRS pairs from each pathway"
 )
 @click.option(
-    "-r", "--num-trials", type=int, required=True, help="Run NUM_TRIALS simulations for each pair"
+    "-r",
+    "--num-trials",
+    type=int,
+    required=True,
+    help="Run NUM_TRIALS simulations for each pair (at most, with --adaptive-tolerance)",
 )
 @click.option(
     "-e", "--edge-population", type=str, required=True, help="Edge population for the pathway"
@@ -75,6 +98,139 @@ def cli(verbose=0):
         "setting to 0 would use all available CPUs)"
     ),
 )
+@click.option(
+    "--settle-margin",
+    type=float,
+    default=None,
+    help=(
+        "Settle each pair once until SETTLE_MARGIN ms before the stimulus and restore "
+        "the settled state for every trial "
+        "(if not specified, every trial is simulated from the start)"
+    ),
+)
+@click.option(
+    "--max-worker-rss",
+    type=float,
+    default=DEFAULT_MAX_RSS,
+    help="Recycle a simulation worker once its resident memory exceeds MAX_WORKER_RSS MB",
+    show_default=True,
+)
+@click.option(
+    "--cache-dir",
+    type=CLICK_DIR,
+    default=None,
+    help="Path to the cache folder (if not specified, OUTPUT_DIR/.psp-cache is used)",
+)
+@click.option(
+    "--cache-connectivity",
+    is_flag=True,
+    default=False,
+    help=(
+        "Store the connectivity table of each pathway in the cache folder, and sample the pairs "
+        "from it (the sampled pairs differ from the ones sampled without this flag)"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--sample-edges",
+    is_flag=True,
+    default=False,
+    help=(
+        "Sample the pairs by drawing random edges, instead of iterating over all the "
+        "connections of each pathway (the sampled pairs differ from the ones sampled without "
+        "this flag)"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--amplitude-backend",
+    type=click.Choice(["efel", "numpy"]),
+    default="efel",
+    help=(
+        "Backend used to extract the PSP amplitudes: 'numpy' computes the same features as "
+        "'efel' for all the traces of a pair at once"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--cache-simulations",
+    is_flag=True,
+    default=False,
+    help=(
+        "Store the results of the simulation trials in the cache folder, and reuse them when "
+        "a trial with the same inputs is run again"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--cache-max-size",
+    type=float,
+    default=DEFAULT_SIMULATION_CACHE_MAX_SIZE,
+    help=(
+        "Size limit of the cached simulation results [MB]; "
+        "the least recently used ones are removed beyond it"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help=(
+        "Resume an interrupted run with the same parameters and output folder: the pairs "
+        "recorded as completed in the checkpoints of the output folder are not simulated again"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--shard",
+    callback=_parse_shard,
+    default=None,
+    metavar="K/N",
+    help=(
+        "Sample all the pairs, but simulate only the shard K (0 <= K < N) of the N shards "
+        "of the pairs of each pathway; combine the shards with `psp merge`"
+    ),
+)
+@click.option(
+    "--backend",
+    type=click.Choice(SIMULATION_BACKENDS),
+    default="local",
+    help=(
+        "Backend running the simulations: JOBS long-lived worker processes ('local'), a "
+        "process pool of JOBS workers ('process', 'loky'), the current process ('serial', e.g. "
+        "to debug), or all the MPI ranks but the first one ('mpi', requires mpi4py: run the "
+        "command with mpirun or srun)"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--adaptive-tolerance",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help=(
+        "Run the trials of each pair in batches of MIN_TRIALS, until the 95% confidence "
+        "interval of its PSP amplitude is narrower than TOL times the amplitude, or NUM_TRIALS "
+        "trials are run (current clamp only)"
+    ),
+    metavar="TOL",
+)
+@click.option(
+    "--min-trials",
+    type=click.IntRange(min=2),
+    default=DEFAULT_MIN_TRIALS,
+    help="Number of trials run at once for a pair, with --adaptive-tolerance",
+    show_default=True,
+)
+@click.option(
+    "--cache-holding-currents/--no-cache-holding-currents",
+    default=True,
+    help=(
+        "Store the holding currents in the cache folder, and reuse them for the same post node, "
+        "holding voltage, mechanisms and bluecellulab version"
+    ),
+    show_default=True,
+)
 def run(  # noqa: PLR0913,PLR0917 too many args / positional args
     pathway_files,
     sonata_simulation_config,
@@ -88,6 +244,20 @@ def run(  # noqa: PLR0913,PLR0917 too many args / positional args
     dump_amplitudes,
     seed,
     jobs,
+    settle_margin,
+    max_worker_rss,
+    cache_dir,
+    cache_connectivity,
+    sample_edges,
+    amplitude_backend,
+    cache_simulations,
+    cache_max_size,
+    resume,
+    shard,
+    backend,
+    adaptive_tolerance,
+    min_trials,
+    cache_holding_currents,
 ):
     """Obtain PSP amplitudes; derive scaling factors"""
     from psp_validation import psp
@@ -107,9 +277,106 @@ def run(  # noqa: PLR0913,PLR0917 too many args / positional args
         dump_amplitudes,
         seed,
         jobs,
+        settle_margin,
+        max_worker_rss,
+        cache_dir,
+        cache_connectivity,
+        sample_edges,
+        amplitude_backend,
+        cache_simulations,
+        cache_max_size,
+        resume,
+        shard,
+        backend,
+        adaptive_tolerance,
+        min_trials,
+        cache_holding_currents,
+    )
+
+
+@cli.command()
+@click.argument("pathway_files", nargs=-1, type=CLICK_FILE, required=True)
+@click.option(
+    "-i",
+    "--traces-dir",
+    type=CLICK_DIR,
+    required=True,
+    help="Path to the folder with the traces dumped by `psp run --dump-traces`",
+)
+@click.option("-o", "--output-dir", type=CLICK_DIR, required=True, help="Path to output folder")
+@click.option(
+    "--dump-amplitudes", is_flag=True, default=False, help="Dump PSP amplitudes", show_default=True
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help=(
+        "Number of pathways to process in parallel "
+        "(if not specified, pathways are processed sequentially; "
+        "setting to 0 would use all available CPUs)"
+    ),
+)
+@click.option(
+    "--amplitude-backend",
+    type=click.Choice(["efel", "numpy"]),
+    default="efel",
+    help=(
+        "Backend used to extract the PSP amplitudes: 'numpy' computes the same features as "
+        "'efel' for all the traces of a pair at once"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--backend",
+    type=click.Choice(LOCAL_BACKENDS),
+    default="loky",
+    help="Backend running the JOBS workers processing the pathways (see `psp run --help`)",
+    show_default=True,
+)
+def reanalyze(
+    pathway_files, traces_dir, output_dir, dump_amplitudes, jobs, amplitude_backend, backend
+):
+    """Obtain PSP amplitudes from dumped traces, without simulating; derive scaling factors
+
+    The traces of each pathway X are read from TRACES_DIR/X.traces.h5, and analyzed with the
+    current pathway file (amplitude thresholds, spike threshold, reference).
+    """
+    from psp_validation import psp
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    psp.reanalyze(
+        pathway_files, traces_dir, output_dir, dump_amplitudes, jobs, amplitude_backend, backend
     )
 
 
+@cli.command()
+@click.argument("pathway_files", nargs=-1, type=CLICK_FILE, required=True)
+@click.option(
+    "-i",
+    "--input-dir",
+    type=CLICK_DIR,
+    required=True,
+    help="Path to the output folder of the shards run with `psp run --shard`",
+)
+@click.option("-o", "--output-dir", type=CLICK_DIR, required=True, help="Path to output folder")
+@click.option(
+    "--dump-amplitudes", is_flag=True, default=False, help="Dump PSP amplitudes", show_default=True
+)
+def merge(pathway_files, input_dir, output_dir, dump_amplitudes):
+    """Combine the results of the shards of `psp run --shard`; derive scaling factors
+
+    The outputs of each pathway are the same as the ones of an unsharded run.
+    """
+    from psp_validation import psp
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    psp.merge(pathway_files, input_dir, output_dir, dump_amplitudes)
+
+
 @cli.command()
 @click.argument("summary_files", nargs=-1, type=CLICK_FILE)
 @click.option("-s", "--style", type=click.Choice(["default", "jira"]), help="Table style")
@@ -157,3 +424,43 @@ def plot(traces_files, output_dir):
     from psp_validation.plot import voltage_traces
 
     voltage_traces(traces_files, output_dir)
+
+
+@cli.group()
+def cache():
+    """Inspect / prune / clear the cache of `psp run`"""
+
+
+@cache.command()
+@click.argument("cache_dir", type=CLICK_DIR)
+def info(cache_dir):
+    """Print the number of entries and the size of the cache"""
+    from psp_validation.cache import get_cache_info
+
+    for section, section_info in get_cache_info(cache_dir).items():
+        print(section, section_info["entries"], f"{section_info['size'] / 1024:.1f} KiB", sep="\t")
+
+
+@cache.command()
+@click.argument("cache_dir", type=CLICK_DIR)
+@click.option(
+    "--max-size",
+    type=float,
+    required=True,
+    help="Remove the least recently used simulation results, down to MAX_SIZE MB",
+)
+def prune(cache_dir, max_size):
+    """Remove the least recently used simulation results"""
+    from psp_validation.cache import prune_cache
+
+    removed, freed = prune_cache(cache_dir, max_size)
+    print(f"Removed {removed} entries ({freed / 1024**2:.1f} MB)")
+
+
+@cache.command()
+@click.argument("cache_dir", type=CLICK_DIR)
+def clear(cache_dir):
+    """Remove all the cache entries"""
+    from psp_validation.cache import clear_cache
+
+    clear_cache(cache_dir)
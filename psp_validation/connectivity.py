@@ -0,0 +1,197 @@
+"""Connectivity tables of the pathways.
+
+A connectivity table lists all the connections of a pathway, with their synapse count and the
+soma position differences of the connected cells, so that pairs can be sampled from it for any
+seed, number of pairs and constraints without iterating over the edges again.
+"""
+
+import hashlib
+import itertools
+import logging
+import os
+import pathlib
+import tempfile
+
+import attr
+import h5py
+import numpy as np
+from bluepysnap.circuit_ids import CircuitNodeId
+
+from psp_validation.cache import CONNECTIVITY, hash_key
+
+L = logging.getLogger(__name__)
+
+# number of postsynaptic cells whose afferent edges are loaded at once
+POST_CHUNK_SIZE = 10000
+
+TABLE_VERSION = "1.0"
+
+
+@attr.s
+class ConnectivityTable:
+    """All the connections of a pathway."""
+
+    source = attr.ib(type=str)
+    target = attr.ib(type=str)
+    pre_ids = attr.ib(type=np.ndarray)
+    post_ids = attr.ib(type=np.ndarray)
+    nsyn = attr.ib(type=np.ndarray)
+    delta = attr.ib(type=np.ndarray)
+
+    def __len__(self):
+        """Number of connections."""
+        return len(self.pre_ids)
+
+    @classmethod
+    def from_edge_population(cls, edge_population, pre, post):
+        """Build the connectivity table of a pathway.
+
+        Args:
+            edge_population: bluepysnap.edges.EdgePopulation instance
+            pre: presynaptic node set
+            post: postsynaptic node set
+        """
+        pre_ids = np.unique(edge_population.source.ids(pre))
+        post_ids = np.unique(edge_population.target.ids(post))
+        n_target = edge_population.target.size
+
+        keys, counts = [], []
+        for start in range(0, len(post_ids), POST_CHUNK_SIZE):
+            selection = edge_population.to_libsonata.afferent_edges(
+                post_ids[start : start + POST_CHUNK_SIZE]
+            )
+            sources = edge_population.to_libsonata.source_nodes(selection).astype(np.uint64)
+            targets = edge_population.to_libsonata.target_nodes(selection).astype(np.uint64)
+            mask = np.isin(sources, pre_ids)
+            # a unique key for each (source, target) pair
+            chunk_keys, chunk_counts = np.unique(
+                sources[mask] * np.uint64(n_target) + targets[mask], return_counts=True
+            )
+            keys.append(chunk_keys)
+            counts.append(chunk_counts)
+
+        keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.uint64)
+        table_pre_ids = (keys // np.uint64(n_target)).astype(np.int64)
+        table_post_ids = (keys % np.uint64(n_target)).astype(np.int64)
+
+        # node ids of a SONATA population are contiguous, starting from 0
+        delta = np.abs(
+            edge_population.source.positions().to_numpy()[table_pre_ids]
+            - edge_population.target.positions().to_numpy()[table_post_ids]
+        )
+
+        return cls(
+            source=edge_population.source.name,
+            target=edge_population.target.name,
+            pre_ids=table_pre_ids,
+            post_ids=table_post_ids,
+            nsyn=np.concatenate(counts).astype(np.uint32) if counts else np.empty(0, np.uint32),
+            delta=delta.astype(np.float32),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load a connectivity table from an HDF5 file."""
+        with h5py.File(path, "r") as h5f:
+            return cls(
+                source=h5f.attrs["source"],
+                target=h5f.attrs["target"],
+                pre_ids=h5f["pre_id"][:],
+                post_ids=h5f["post_id"][:],
+                nsyn=h5f["nsyn"][:],
+                delta=h5f["delta"][:],
+            )
+
+    def save(self, path):
+        """Save the connectivity table to an HDF5 file.
+
+        The file is written to a temporary file first, so that concurrent runs never read a
+        partially written table.
+        """
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        with h5py.File(tmp_path, "w") as h5f:
+            h5f.attrs["version"] = TABLE_VERSION
+            h5f.attrs["source"] = self.source
+            h5f.attrs["target"] = self.target
+            h5f.create_dataset("pre_id", data=self.pre_ids, compression="gzip")
+            h5f.create_dataset("post_id", data=self.post_ids, compression="gzip")
+            h5f.create_dataset("nsyn", data=self.nsyn, compression="gzip")
+            h5f.create_dataset("delta", data=self.delta, compression="gzip")
+        pathlib.Path(tmp_path).replace(path)
+
+    def sample(self, num_pairs, connection_filter):
+        """Sample connected pairs uniformly, without replacement.
+
+        Args:
+            num_pairs: number of pairs to return
+            connection_filter: `psp_validation.pathways.ConnectionFilter` applied to the pairs
+
+        Returns:
+            List of `n` (pre_gid, post_gid) pairs (or fewer if could not find enough)
+        """
+        order = np.random.permutation(len(self))
+        if connection_filter.requires_synapse_count or connection_filter.requires_positions:
+            order = order[connection_filter.mask(self.nsyn[order], self.delta[order])]
+
+        pairs = (
+            (CircuitNodeId(self.source, int(pre_id)), CircuitNodeId(self.target, int(post_id)))
+            for pre_id, post_id in zip(self.pre_ids[order], self.post_ids[order], strict=True)
+        )
+        if connection_filter.used_gids is None:
+            return list(itertools.islice(pairs, num_pairs))
+
+        result = []
+        for pair in pairs:
+            if len(result) == num_pairs:
+                break
+            result.extend(connection_filter.unique([pair]))
+        return result
+
+
+def _get_table_key(edge_population, pre, post):
+    """Get the cache key of the connectivity table of a pathway.
+
+    The key depends on the edge file (path, size and modification time) and on the node ids of
+    the pre- and post- synaptic node sets, whatever the way they are defined.
+    """
+    edges_file = pathlib.Path(edge_population.h5_filepath).resolve()
+    stat = edges_file.stat()
+    pre_ids = np.unique(edge_population.source.ids(pre)).astype(np.int64)
+    post_ids = np.unique(edge_population.target.ids(post)).astype(np.int64)
+    return [
+        TABLE_VERSION,
+        str(edges_file),
+        stat.st_size,
+        stat.st_mtime_ns,
+        edge_population.name,
+        hashlib.sha256(pre_ids.tobytes()).hexdigest(),
+        hashlib.sha256(post_ids.tobytes()).hexdigest(),
+    ]
+
+
+def get_connectivity_table(cache_dir, edge_population, pre, post):
+    """Get the connectivity table of a pathway, from the cache if it was already built.
+
+    Args:
+        cache_dir (pathlib.Path): path to the cache directory
+        edge_population: bluepysnap.edges.EdgePopulation instance
+        pre: presynaptic node set
+        post: postsynaptic node set
+    """
+    path = (
+        pathlib.Path(cache_dir)
+        / CONNECTIVITY
+        / f"{hash_key(_get_table_key(edge_population, pre, post))}.h5"
+    )
+    if path.exists():
+        L.info("Loading connectivity table from %s", path)
+        return ConnectivityTable.load(path)
+
+    L.info("Building connectivity table...")
+    table = ConnectivityTable.from_edge_population(edge_population, pre, post)
+    L.info("Writing connectivity table (%d connections) to %s", len(table), path)
+    table.save(path)
+    return table
@@ -5,17 +5,25 @@ Loads traces from HDF5 dump, adds OU noise, extract peak PSP amplitudes and calc
 see Barros-Zulaica et al 2019
 """
 
+import itertools
 import logging
+import math
+from functools import partial
 
 import h5py
-import joblib
 import numpy as np
 from tqdm import tqdm
 
-from psp_validation.cv_validation.ou_generator import add_ou_noise
+from psp_validation.cv_validation.ou_generator import add_ou_noise, ou_filter
+from psp_validation.executors import get_n_workers, worker_pool
 from psp_validation.features import get_peak_amplitudes
 
 SPIKE_TH = -30  # (mV) NEURON's built in spike threshold
+RESAMPLING_METHODS = ("jackknife", "bootstrap")
+# number of resamples of the bootstrap, and maximum number of subsets of the delete-d jackknife
+DEFAULT_N_RESAMPLES = 1000
+# maximum number of samples (pairs x trials x time points) of the traces analyzed at once
+MAX_BATCH_SAMPLES = 2**25
 L = logging.getLogger(__name__)
 
 
@@ -40,10 +48,16 @@ def _filter_traces(t, traces, t_stim):
     return non_spiking_traces if non_spiking_traces.size > 0 else None
 
 
-def get_noisy_traces(h5f, protocol, clamp):
-    """Loads in traces, filters out the spiking ones and adds OU noise to them"""
+def get_noisy_traces(h5f, protocol, clamp, rng=None):
+    """Loads in traces, filters out the spiking ones and adds OU noise to them
+
+    The noise of all the trials is generated at once by `rng` (if None, a generator seeded with
+    the base seed of the pair), with the `ou_method` of the protocol ("euler" by default, or
+    "exact").
+    """
     t, traces = _load_traces(h5f, clamp)
-    np.random.seed(h5f.attrs["base_seed"])
+    if rng is None:
+        rng = np.random.default_rng(h5f.attrs["base_seed"])
     t_stim = protocol["t_stim"]
     filtered_traces = _filter_traces(t, traces, t_stim) if clamp == "current" else traces
 
@@ -52,98 +66,459 @@ def get_noisy_traces(h5f, protocol, clamp):
 
     tau = protocol["tau"]
     sigma = protocol["sigma"]
-    noisy_traces = add_ou_noise(t, filtered_traces, tau, sigma)
+    noisy_traces = add_ou_noise(
+        t, filtered_traces, tau, sigma, rng=rng, method=protocol.get("ou_method", "euler")
+    )
 
     return t, noisy_traces
 
 
-def _get_cvs_and_jk_cvs_worker(pre_post_syn_type, h5_path, protocol):
-    """Worker function for getting the CVs and JK CVs for given pair."""
-    bad_pair = cv = jk_cv = None
-    pre_population, pre_id, post_population, post_id, syn_type = pre_post_syn_type
-    pair = f"{pre_population}-{pre_id}_{post_population}-{post_id}"
-
-    with h5py.File(h5_path, "r") as h5:
-        clamp = h5.attrs.get("clamp")
-        t, noisy_traces = get_noisy_traces(h5[pair], protocol, clamp)
+def _stack_pair_traces(t, batch):
+    """Stacks the traces of the pairs of a batch into a (pairs x trials x T) array.
 
-    if noisy_traces is not None and noisy_traces.shape[0] >= protocol["min_good_trials"]:
-        cv = calc_cv(t, noisy_traces, syn_type, protocol["t_stim"], clamp, jk=False)
-        jk_cv = calc_cv(t, noisy_traces, syn_type, protocol["t_stim"], clamp, jk=True)
-    else:
-        bad_pair = pair
+    The pairs with fewer trials than the others are padded with NaN traces.
+    """
+    n_trials = max(len(traces) for _, traces in batch)
+    stacked = np.full((len(batch), n_trials, len(t)), np.nan, dtype=np.float32)
+    for row, (_, traces) in enumerate(batch):
+        stacked[row, : len(traces)] = traces
+    return t, [index for index, _ in batch], stacked
 
-    return cv, jk_cv, bad_pair
 
+def _iter_pair_batches(h5, pair_names, clamp, max_samples=MAX_BATCH_SAMPLES):
+    """Loads the traces of consecutive pairs sharing the same time, in batches.
 
-def get_cvs_and_jk_cvs(pairs, h5_path, protocol, n_jobs=None):
-    """Gets the CVs and Jackknife sampled CVs of the psp amplitudes for given pairs."""
-    pre_post_syn_type = pairs[
-        ["pre_population", "pre_id", "post_population", "post_id", "synapse_type"]
-    ].itertuples(index=False, name=None)
+    Yields:
+        (t, indices, traces): the time of the traces, the indices of the pairs of the batch in
+        `pair_names` and their (pairs x trials x T) traces (see `_stack_pair_traces`), with at
+        most `max_samples` samples unless a single pair has more
+    """
+    batch = []
+    batch_t = None
+    for index, name in enumerate(pair_names):
+        t, traces = _load_traces(h5[name], clamp)
+        n_trials = max([len(traces)] + [len(batch_traces) for _, batch_traces in batch])
+        if batch and (
+            not np.array_equal(t, batch_t) or (len(batch) + 1) * n_trials * len(t) > max_samples
+        ):
+            yield _stack_pair_traces(batch_t, batch)
+            batch = []
+        if not batch:
+            batch_t = t
+        batch.append((index, traces))
+
+    if batch:
+        yield _stack_pair_traces(batch_t, batch)
+
+
+def _get_batch_amplitudes(t, traces, syn_types, t_stim, clamp, backend):
+    """Gets the peak amplitudes of the traces of several pairs, with one call per synapse type."""
+    amplitudes = np.empty(len(traces))
+    for syn_type in np.unique(syn_types):
+        mask = syn_types == syn_type
+        amplitudes[mask] = _get_peak_amplitudes(t, traces[mask], t_stim, syn_type, clamp, backend)
+    return amplitudes
+
+
+def _get_resampled_cvs(
+    t, pair_traces, rngs, syn_types, protocol, clamp, backend, max_samples=MAX_BATCH_SAMPLES
+):
+    """Gets the CVs of the resamples of the trials of several pairs (see `calc_resampled_cv`).
+
+    The resampled traces of consecutive pairs are analyzed at once, up to `max_samples` samples.
+    """
+    method = protocol.get("jk_method", "jackknife")
+    delete = protocol.get("jk_delete", 1)
+    n_resamples = protocol.get("jk_resamples")
+
+    cvs = []
+    chunk = []
+    for index, (traces, rng) in enumerate(zip(pair_traces, rngs, strict=True)):
+        chunk.append(_get_resampled_traces(traces, method, delete, n_resamples, rng))
+        if index == len(pair_traces) - 1 or sum(map(np.size, chunk)) >= max_samples:
+            counts = [len(resampled) for resampled in chunk]
+            first = len(cvs)
+            amplitudes = _get_batch_amplitudes(
+                t,
+                np.concatenate(chunk),
+                np.repeat(syn_types[first : first + len(chunk)], counts),
+                protocol["t_stim"],
+                clamp,
+                backend,
+            )
+            for row, pair_amplitudes in enumerate(np.split(amplitudes, np.cumsum(counts)[:-1])):
+                n_trials = len(pair_traces[first + row])
+                cvs.append(_get_resampled_cv(pair_amplitudes, n_trials, method, delete))
+            chunk = []
+
+    return cvs
+
+
+def _get_batch_cvs(  # noqa: PLR0913,PLR0917 too many args / positional args
+    t,
+    traces,
+    rngs,
+    syn_types,
+    protocol,
+    clamp,
+    backend="efel",
+    max_samples=MAX_BATCH_SAMPLES,
+    noises=None,
+):
+    """Gets the CVs and Jackknife sampled CVs of a batch of pairs at once.
+
+    The spiking trials of all the pairs are filtered out at once, and the OU noise of their good
+    trials is generated by a single filter, from random elements drawn by the generator of each
+    pair (the same as `get_noisy_traces`), or taken from the trials of the same rank in `noises`;
+    the amplitudes of all the trials are then extracted at once.
+
+    Args:
+        t: numpy array - time of the traces
+        traces: numpy array - (pairs x trials x T) traces, padded with NaN (overwritten)
+        rngs: list - `numpy.random.Generator` of each pair
+        syn_types: numpy array - synapse type of each pair
+        protocol: dict - protocol of the pathway
+        clamp: str - clamp type (current or voltage)
+        backend: str - backend extracting the amplitudes
+        max_samples: int - maximum number of samples of the resampled traces analyzed at once
+        noises: list - (trials x T) noise of each pair (see `psp_validation.cache.NoiseBank`),
+            or None to generate it
+
+    Returns:
+        (analyzed, cvs, jk_cvs): mask of the pairs with at least `min_good_trials` good trials,
+        and their CVs and Jackknife sampled CVs
+    """
+    t_stim = protocol["t_stim"]
+    good = ~np.isnan(traces[:, :, 0])
+    if clamp == "current":
+        # same as `_filter_traces`, for all the trials at once
+        good &= np.all(traces[:, :, t > t_stim] <= SPIKE_TH, axis=2)
+    n_good = good.sum(axis=1)
+    analyzed = (n_good > 0) & (n_good >= protocol["min_good_trials"])
+    if not analyzed.any():
+        return analyzed, np.array([]), np.array([])
+    good &= analyzed[:, np.newaxis]
+    n_good[~analyzed] = 0
+
+    # the good trials of each pair are consecutive rows
+    good_traces = traces[good]
+    offsets = np.cumsum(n_good)
+    if noises is not None:
+        for row in np.flatnonzero(analyzed):
+            rows = slice(offsets[row] - n_good[row], offsets[row])
+            good_traces[rows] += noises[row][np.flatnonzero(good[row])]
+    else:
+        random_element = np.empty_like(good_traces)
+        for row in np.flatnonzero(analyzed):
+            rows = slice(offsets[row] - n_good[row], offsets[row])
+            random_element[rows, 1:] = rngs[row].standard_normal(
+                (n_good[row], len(t) - 1), dtype=traces.dtype
+            )
+        good_traces += ou_filter(
+            random_element,
+            t[1] - t[0],
+            protocol["tau"],
+            protocol["sigma"],
+            method=protocol.get("ou_method", "euler"),
+        )
+        del random_element
+
+    row_pairs = np.repeat(np.arange(len(traces)), n_good)
+    amplitudes = np.full(good.shape, np.nan)
+    amplitudes[good] = _get_batch_amplitudes(
+        t, good_traces, syn_types[row_pairs], t_stim, clamp, backend
+    )
+    cvs = np.std(amplitudes[analyzed], axis=1, where=good[analyzed]) / np.mean(
+        amplitudes[analyzed], axis=1, where=good[analyzed]
+    )
 
-    if n_jobs is None:
-        n_jobs = 1
-    elif n_jobs <= 0:
-        n_jobs = -1
+    jk_cvs = _get_resampled_cvs(
+        t,
+        np.split(good_traces, offsets[analyzed][:-1]),
+        [rngs[row] for row in np.flatnonzero(analyzed)],
+        syn_types[analyzed],
+        protocol,
+        clamp,
+        backend,
+        max_samples=max_samples,
+    )
+    return analyzed, cvs, np.asarray(jk_cvs)
+
+
+def _get_pair_names(pairs):
+    """Gets the names of the HDF5 groups of the pairs."""
+    return [
+        f"{pre_population}-{pre_id}_{post_population}-{post_id}"
+        for pre_population, pre_id, post_population, post_id in pairs[
+            ["pre_population", "pre_id", "post_population", "post_id"]
+        ].itertuples(index=False, name=None)
+    ]
+
+
+def get_cvs_and_jk_cvs(
+    pairs,
+    h5_path,
+    protocol,
+    amplitude_backend="efel",
+    max_samples=MAX_BATCH_SAMPLES,
+    noise_bank=None,
+):
+    """Gets the CVs and Jackknife sampled CVs of the psp amplitudes for given pairs.
+
+    The traces of the pairs are loaded from the HDF5 file in batches of (pairs x trials x T)
+    arrays of at most `max_samples` samples, and each batch is analyzed at once (see
+    `_get_batch_cvs`). The JK CVs are computed with the `jk_method` ("jackknife" by default, or
+    "bootstrap"), `jk_delete` and `jk_resamples` of the protocol (see `calc_resampled_cv`).
+
+    With a `noise_bank` (`psp_validation.cache.NoiseBank`), the noise of the trials of each pair
+    is read from the bank instead of being generated, so that the same trials of a pair get the
+    same noise for all the NRRP values.
+
+    Returns:
+        (cvs, jk_cvs, bad_pairs): the CVs and JK CVs of the pairs with enough good trials, and
+        the names of the other pairs
+    """
+    pair_names = _get_pair_names(pairs)
+    syn_types = pairs["synapse_type"].to_numpy()
+    analyzed = np.zeros(len(pair_names), dtype=bool)
+    cvs = np.full(len(pair_names), np.nan)
+    jk_cvs = np.full(len(pair_names), np.nan)
 
-    worker = joblib.delayed(_get_cvs_and_jk_cvs_worker)
-    results = joblib.Parallel(n_jobs=n_jobs, backend="loky")(
-        [
-            worker(
-                pre_post_syn_type=sample,
-                h5_path=h5_path,
-                protocol=protocol,
+    with h5py.File(h5_path, "r") as h5:
+        clamp = h5.attrs.get("clamp")
+        for t, indices, traces in _iter_pair_batches(h5, pair_names, clamp, max_samples):
+            # the same generator draws the noise and the random resamples of each pair
+            rngs = [np.random.default_rng(h5[pair_names[i]].attrs["base_seed"]) for i in indices]
+            noises = None
+            if noise_bank is not None:
+                noises = [
+                    noise_bank.get(name, h5[name].attrs["base_seed"], len(h5[name]), t, protocol)
+                    for name in (pair_names[i] for i in indices)
+                ]
+            batch_analyzed, batch_cvs, batch_jk_cvs = _get_batch_cvs(
+                t,
+                traces,
+                rngs,
+                syn_types[indices],
+                protocol,
+                clamp,
+                amplitude_backend,
+                max_samples=max_samples,
+                noises=noises,
             )
-            for sample in pre_post_syn_type
-        ]
-    )
+            batch_indices = np.asarray(indices)[batch_analyzed]
+            analyzed[batch_indices] = True
+            cvs[batch_indices] = batch_cvs
+            jk_cvs[batch_indices] = batch_jk_cvs
 
-    return [[value for value in group if value is not None] for group in zip(*results)]
+    bad_pairs = [name for name, done in zip(pair_names, analyzed, strict=True) if not done]
+    return list(cvs[analyzed]), list(jk_cvs[analyzed]), bad_pairs
 
 
-def _get_peak_amplitudes(t, traces, t_stim, syn_type, clamp):
+def _get_peak_amplitudes(t, traces, t_stim, syn_type, clamp, backend="efel"):
     """Gets peak PSC/PSP amplitudes for all trials."""
-    t = np.tile(t, (len(traces), 1))
+    if backend == "efel":
+        t = np.tile(t, (len(traces), 1))
 
-    return get_peak_amplitudes(t, traces, t_stim, syn_type, clamp)
+    return get_peak_amplitudes(t, traces, t_stim, syn_type, clamp, backend=backend)
 
 
 def _get_jackknife_traces(traces):
-    """Performs 0-axis-wise Jackknife resampling for input array"""
-    return np.vstack([np.mean(np.delete(traces, i, 0), axis=0) for i in range(traces.shape[0])])
+    """Performs 0-axis-wise Jackknife resampling for input array
 
+    The mean of all the rows but row i is (SUM - traces[i]) / (N - 1), for all i at once.
+    """
+    total = np.sum(traces, axis=0, dtype=np.float64)
+    return ((total - traces) / (traces.shape[0] - 1)).astype(traces.dtype, copy=False)
 
-def calc_cv(t, noisy_traces, syn_type, t_stim, clamp, jk):
+
+def _get_delete_d_subsets(n, delete, n_resamples, rng):
+    """Gets the indices of the rows deleted by each resample of the delete-d Jackknife.
+
+    All the subsets of `delete` rows are returned if there are at most `n_resamples` of them,
+    and `n_resamples` random subsets otherwise.
+    """
+    if math.comb(n, delete) <= n_resamples:
+        return np.array(list(itertools.combinations(range(n), delete)))
+    return np.argsort(rng.random((n_resamples, n)), axis=1)[:, :delete]
+
+
+def _get_delete_d_jackknife_traces(traces, delete, n_resamples, rng):
+    """Performs 0-axis-wise delete-d Jackknife resampling for input array
+
+    The mean of the rows not in subset s is (SUM - SUM(traces[s])) / (N - d), for all s at once.
+    """
+    subsets = _get_delete_d_subsets(traces.shape[0], delete, n_resamples, rng)
+    total = np.sum(traces, axis=0, dtype=np.float64)
+    deleted = np.sum(traces[subsets], axis=1, dtype=np.float64)
+    return ((total - deleted) / (traces.shape[0] - delete)).astype(traces.dtype, copy=False)
+
+
+def _get_bootstrap_traces(traces, n_resamples, rng):
+    """Performs 0-axis-wise bootstrap resampling for input array
+
+    The mean of each resample is computed from the number of times each row is drawn, with a
+    single matrix product for all the resamples.
+    """
+    n = traces.shape[0]
+    counts = rng.multinomial(n, np.full(n, 1 / n), size=n_resamples)
+    return (counts @ traces.astype(np.float64) / n).astype(traces.dtype, copy=False)
+
+
+def _get_resampled_traces(traces, method, delete, n_resamples, rng):
+    """Gets the mean traces of the resamples of the trials (see `calc_resampled_cv`)."""
+    if n_resamples is None:
+        n_resamples = DEFAULT_N_RESAMPLES
+
+    if method == "bootstrap":
+        return _get_bootstrap_traces(traces, n_resamples, rng)
+    if method != "jackknife":
+        raise ValueError(
+            f"Unknown resampling method: {method} (expected one of {RESAMPLING_METHODS})"
+        )
+    if delete == 1:
+        return _get_jackknife_traces(traces)
+    if 1 < delete < traces.shape[0]:
+        return _get_delete_d_jackknife_traces(traces, delete, n_resamples, rng)
+    raise ValueError(f"Can't leave out {delete} trials out of {traces.shape[0]}")
+
+
+def _get_resampled_cv(amplitudes, n_trials, method, delete):
+    """Gets the CV of the amplitudes of the resampled traces of `n_trials` trials."""
+    mean_amplitude = np.mean(amplitudes)
+    sum_of_squared_diff = np.sum((amplitudes - mean_amplitude) ** 2)
+
+    if method == "bootstrap":
+        std = np.sqrt(sum_of_squared_diff / (len(amplitudes) - 1))
+    else:
+        # Since delete-d JK variance is Var = (N-d)/d * [MEAN_OF_SQUARED_DIFF] (i.e.
+        # (N-1)/N * [SUM_OF_SQUARED_DIFF] for d = 1), we can't use np.std()
+        std = np.sqrt((n_trials - delete) / delete * sum_of_squared_diff / len(amplitudes))
+    return std / mean_amplitude
+
+
+def calc_resampled_cv(  # noqa: PLR0913,PLR0917 too many args / positional args
+    t,
+    noisy_traces,
+    syn_type,
+    t_stim,
+    clamp,
+    method="jackknife",
+    delete=1,
+    n_resamples=None,
+    rng=None,
+    backend="efel",
+):
+    """Calculates CV of PSPs from the amplitudes of the mean traces of resamples of the trials.
+
+    With the "jackknife" `method`, the resamples leave out `delete` trials: all the N trials in
+    turn if `delete` is 1, or all the subsets of `delete` trials (at most `n_resamples` random
+    ones). With the "bootstrap" `method`, `n_resamples` resamples of N trials are drawn with
+    replacement. The mean traces of all the resamples are computed at once, from the sum of the
+    trials.
+
+    Args:
+        t: numpy array - time of the traces
+        noisy_traces: numpy array - one row per trial
+        syn_type: str - synapse type (EXC or INH)
+        t_stim: float - time of the stimulus
+        clamp: str - clamp type (current or voltage)
+        method: str - "jackknife" or "bootstrap"
+        delete: int - number of trials left out by each Jackknife resample
+        n_resamples: int - number of random resamples (default: `DEFAULT_N_RESAMPLES`)
+        rng: numpy.random.Generator - generator of the random resamples
+        backend: str - backend extracting the amplitudes
+            (see `psp_validation.features.get_peak_amplitudes`)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    resampled_traces = _get_resampled_traces(noisy_traces, method, delete, n_resamples, rng)
+    amplitudes = _get_peak_amplitudes(t, resampled_traces, t_stim, syn_type, clamp, backend)
+    n_trials = len(amplitudes) if method == "jackknife" and delete == 1 else len(noisy_traces)
+    return _get_resampled_cv(amplitudes, n_trials, method, delete)
+
+
+def calc_cv(t, noisy_traces, syn_type, t_stim, clamp, jk, backend="efel"):
     """Calculates CV (coefficient of variation std/mean) of PSPs.
 
     Optionally done with Jackknife resampling which averages noise and gets an unbiased
-    estimate of the std.
+    estimate of the std (see `calc_resampled_cv`). The amplitudes are computed with the given
+    `backend` (see `psp_validation.features.get_peak_amplitudes`).
     """
     if jk:
-        jk_traces = _get_jackknife_traces(noisy_traces)
-        amplitudes = _get_peak_amplitudes(t, jk_traces, t_stim, syn_type, clamp)
+        return calc_resampled_cv(t, noisy_traces, syn_type, t_stim, clamp, backend=backend)
 
-        n = len(amplitudes)
-        mean_amplitude = np.mean(amplitudes)
+    amplitudes = _get_peak_amplitudes(t, noisy_traces, t_stim, syn_type, clamp, backend)
+    return np.std(amplitudes) / np.mean(amplitudes)
 
-        # Since JK variance is Var = (N-1)/N * [SUM_OF_SQUARED_DIFF], we can't use np.std()
-        jk_std = np.sqrt((n - 1) / n * np.sum((amplitudes - mean_amplitude) ** 2))
-        return jk_std / mean_amplitude
 
-    amplitudes = _get_peak_amplitudes(t, noisy_traces, t_stim, syn_type, clamp)
-    return np.std(amplitudes) / np.mean(amplitudes)
+def _fill_noise_bank(noise_bank, h5_paths, pairs, protocol):
+    """Generates the noise of the pairs missing from the bank, before analyzing the NRRP values.
 
+    The noise of a pair is generated for its largest number of trials in the HDF5 files, so that
+    the workers analyzing the NRRP values only read it.
+    """
+    pair_names = _get_pair_names(pairs)
+    n_trials = dict.fromkeys(pair_names, 0)
+    for h5_path in h5_paths:
+        with h5py.File(h5_path, "r") as h5:
+            for name in pair_names:
+                n_trials[name] = max(n_trials[name], len(h5[name]))
+
+    # the pairs have the same base seed and time in all the HDF5 files
+    with h5py.File(h5_paths[0], "r") as h5:
+        for name in pair_names:
+            t = h5[name][next(iter(h5[name]))]["time"][:]
+            noise_bank.get(name, h5[name].attrs["base_seed"], n_trials[name], t, protocol)
+
+
+def get_all_cvs(
+    out_dir,
+    pairs,
+    nrrp,
+    protocol,
+    n_jobs=None,
+    amplitude_backend="efel",
+    backend="loky",
+    noise_bank=None,
+):
+    """Calculates CVs w/ and w/o Jackknife resampling for all pairs and all NRRP values
+
+    The NRRP values are analyzed in parallel by `n_jobs` workers of `backend`, each one analyzing
+    all the pairs of an NRRP value at once (see `get_cvs_and_jk_cvs`).
+
+    With a `noise_bank` (`psp_validation.cache.NoiseBank`), the noise of the pairs missing from
+    the bank is generated first, and is then read by all the NRRP values.
+    """
+    nrrps = list(range(nrrp[0], nrrp[1] + 1))
+    h5_paths = [out_dir / f"simulation_nrrp{nrrp_}.h5" for nrrp_ in nrrps]
+    if noise_bank is not None:
+        _fill_noise_bank(noise_bank, h5_paths, pairs, protocol)
+        noise_bank.log_stats()
+
+    results = {}
+    with worker_pool(backend, get_n_workers(n_jobs)) as pool:
+        for index, result in tqdm(
+            pool.map_as_completed(
+                partial(
+                    get_cvs_and_jk_cvs,
+                    pairs,
+                    protocol=protocol,
+                    amplitude_backend=amplitude_backend,
+                    noise_bank=noise_bank,
+                ),
+                h5_paths,
+            ),
+            total=len(nrrps),
+            desc="Iterating over NRRP",
+        ):
+            results[nrrps[index]] = result
 
-def get_all_cvs(out_dir, pairs, nrrp, protocol, n_jobs=None):
-    """Calculates CVs w/ and w/o Jackknife resampling for all pairs and all NRRP values"""
     all_cvs = {}
     n_bad_pairs = 0
-
-    for nrrp_ in tqdm(range(nrrp[0], nrrp[1] + 1), desc="Iterating over NRRP"):
-        h5_path = out_dir / f"simulation_nrrp{nrrp_}.h5"
-
-        cvs, jk_cvs, bad_pairs = get_cvs_and_jk_cvs(pairs, h5_path, protocol, n_jobs=n_jobs)
+    for nrrp_ in nrrps:
+        cvs, jk_cvs, bad_pairs = results[nrrp_]
         all_cvs[f"nrrp{nrrp_}"] = {"CV": np.asarray(cvs), "JK_CV": np.asarray(jk_cvs)}
         if bad_pairs:
             n_bad_pairs += len(bad_pairs)
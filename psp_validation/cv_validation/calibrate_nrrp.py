@@ -11,55 +11,88 @@ See Barros-Zulaica et al 2019
 import logging
 
 import numpy as np
-from scipy.stats import poisson
 
 from psp_validation.cv_validation.analyze_traces import get_all_cvs
 from psp_validation.cv_validation.plots import plot_cv_regression, plot_lambdas
 from psp_validation.cv_validation.utils import read_simulation_pairs
 
 N_REPS = 50  # number of repetitions for random NRRP generation
+N_PERMUTATIONS = 1000  # number of random permutations of the CVs of each NRRP sampled from
 logging.basicConfig(level=logging.INFO)
 L = logging.getLogger(__name__)
 
 
-def _sample_cvs(unique_nrrps, counts, all_cvs):
-    """Helper function to sample the cvs for each unique nrrp."""
-    cvs = []
-    jk_cvs = []
+def _sample_mean_cvs(nrrps, cvs, rng):
+    """Helper function to sample the cvs for each nrrp of each row of `nrrps`, and average them.
 
-    for nrrp, count in zip(unique_nrrps, counts):
-        cvs.extend(np.random.choice(all_cvs[f"nrrp{nrrp}"]["CV"], size=count, replace=False))
-        jk_cvs.extend(np.random.choice(all_cvs[f"nrrp{nrrp}"]["JK_CV"], size=count, replace=False))
+    For each row, as many CVs as there are pairs with a given NRRP are drawn without replacement
+    from the CVs of the pairs simulated with this NRRP. The draws of all the rows are done at once
+    for each NRRP: the drawn CVs are the first ones of one of `N_PERMUTATIONS` random
+    permutations of the CVs, picked at random for each row, and their sum is read from the
+    precomputed cumulative sums of the permuted CVs.
 
-    return np.mean(cvs), np.mean(jk_cvs)
+    Args:
+        nrrps: numpy array - (samples x pairs) NRRP of each pair
+        cvs: dict - CVs of the pairs simulated with each NRRP
+        rng: numpy.random.Generator - generator of the permutations
 
-
-def scan_lambdas(all_cvs, nrrp_range, n_pairs, n_reps=None):
+    Returns:
+        numpy array with the mean of the CVs sampled for each row
+    """
+    total = np.zeros(len(nrrps))
+    for nrrp, nrrp_cvs in cvs.items():
+        counts = np.count_nonzero(nrrps == nrrp, axis=1)
+        rows = np.flatnonzero(counts)
+        if len(rows) == 0:
+            continue
+        max_count = counts[rows].max()
+        if max_count > len(nrrp_cvs):
+            raise ValueError(
+                f"Can't sample {max_count} CVs out of the {len(nrrp_cvs)} pairs with NRRP={nrrp}"
+            )
+
+        n_permutations = min(len(rows), N_PERMUTATIONS)
+        permutations = rng.permuted(np.tile(np.arange(len(nrrp_cvs)), (n_permutations, 1)), axis=1)[
+            :, :max_count
+        ]
+        sums = np.zeros((n_permutations, max_count + 1))
+        np.cumsum(np.asarray(nrrp_cvs)[permutations], axis=1, out=sums[:, 1:])
+        total[rows] += sums[rng.integers(n_permutations, size=len(rows)), counts[rows]]
+
+    return total / nrrps.shape[1]
+
+
+def scan_lambdas(all_cvs, nrrp_range, n_pairs, n_reps=None, rng=None):
     """Generates random Poisson samples with different lambdas.
 
     'lambda' is a mean of Poisson distribution that's behind NRRP values (which are always ints).
     For each individual point in the generated distribution the function samples CVs calculated
     from pairs run with the same NRRP value, and returns the mean of the sample NRRPs (which are
     technically a lambdas again as they're floats) and the mean of the corresponding sampled CVs.
+
+    The NRRPs of all the lambdas and repetitions are drawn at once, and the CVs are sampled for
+    all of them at once for each NRRP value (see `_sample_mean_cvs`), with `rng`.
     """
     if n_reps is None:
         n_reps = N_REPS
+    if rng is None:
+        rng = np.random.default_rng()
 
     lambdas = np.arange(nrrp_range[0], nrrp_range[1] + 0.1, 0.1)
-    mean_nrrps = []
-    mean_cvs = []
-
-    for lambda_ in lambdas:
-        for _ in range(n_reps):
-            nrrps = poisson.rvs(lambda_ - 1, size=n_pairs, loc=1)  # generate random samples
-            unique_nrrps, counts = np.unique(nrrps, return_counts=True)
-            # don't go outside of simulated range
-            unique_nrrps[unique_nrrps > lambdas[-1]] = lambdas[-1]
-            mean_cvs.append(_sample_cvs(unique_nrrps, counts, all_cvs))
-            mean_nrrps.append(np.mean(nrrps))
-
-    mean_cvs = np.asarray(mean_cvs).T
-    return np.asarray(mean_nrrps), mean_cvs[0], mean_cvs[1]
+    # (lambdas x reps x pairs) random samples
+    nrrps = 1 + rng.poisson(
+        lambdas[:, np.newaxis, np.newaxis] - 1, size=(len(lambdas), n_reps, n_pairs)
+    )
+    mean_nrrps = nrrps.mean(axis=2).ravel()
+
+    # don't go outside of simulated range
+    nrrps = np.clip(nrrps, nrrp_range[0], nrrp_range[1]).reshape(-1, n_pairs)
+    nrrp_values = range(nrrp_range[0], nrrp_range[1] + 1)
+    mean_cvs = _sample_mean_cvs(nrrps, {i: all_cvs[f"nrrp{i}"]["CV"] for i in nrrp_values}, rng)
+    mean_jk_cvs = _sample_mean_cvs(
+        nrrps, {i: all_cvs[f"nrrp{i}"]["JK_CV"] for i in nrrp_values}, rng
+    )
+    return mean_nrrps, mean_cvs, mean_jk_cvs
 
 
 def _flatten_cvs(all_cvs, nrrp):
@@ -144,8 +177,22 @@ def calibrate(fig_dir, all_cvs, target_cv, nrrp, n_pairs, n_reps):
     )
 
 
-def run_calibration(output_dir, pathways, nrrp, n_pairs=None, n_reps=None, n_jobs=None):
-    """Run the calibration for given nrrp range"""
+def run_calibration(  # noqa: PLR0913,PLR0917 too many args / positional args
+    output_dir,
+    pathways,
+    nrrp,
+    n_pairs=None,
+    n_reps=None,
+    n_jobs=None,
+    amplitude_backend="efel",
+    backend="loky",
+    noise_bank=None,
+):
+    """Run the calibration for given nrrp range
+
+    The CVs are computed by `n_jobs` workers of `backend` (see `psp_validation.executors`), with
+    the OU noise of `noise_bank` if not None (see `psp_validation.cache.NoiseBank`).
+    """
     pairs = read_simulation_pairs(output_dir)
     n_simulated_pairs = len(pairs)
 
@@ -159,6 +206,15 @@ def run_calibration(output_dir, pathways, nrrp, n_pairs=None, n_reps=None, n_job
 
     # precalculate CVs from all simulations
     target_cv = pathways["reference"]["cv"]
-    all_cvs = get_all_cvs(output_dir, pairs, nrrp, pathways["protocol"], n_jobs=n_jobs)
+    all_cvs = get_all_cvs(
+        output_dir,
+        pairs,
+        nrrp,
+        pathways["protocol"],
+        n_jobs=n_jobs,
+        amplitude_backend=amplitude_backend,
+        backend=backend,
+        noise_bank=noise_bank,
+    )
 
     calibrate(output_dir, all_cvs, target_cv, nrrp, n_pairs, n_reps)
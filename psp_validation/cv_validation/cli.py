@@ -6,10 +6,19 @@ import click
 import numpy as np
 
 from psp_validation import setup_logging
+from psp_validation.cache import DEFAULT_CACHE_DIRNAME, HoldingCurrentCache, NoiseBank
 from psp_validation.cv_validation.calibrate_nrrp import run_calibration
 from psp_validation.cv_validation.setsim import setup_simulation
 from psp_validation.cv_validation.simulator import run_simulation
 from psp_validation.cv_validation.utils import get_pathway_outdir, read_simulation_pairs
+from psp_validation.executors import (
+    DEFAULT_MAX_RSS,
+    LOCAL_BACKENDS,
+    SIMULATION_BACKENDS,
+    get_n_workers,
+    worker_pool,
+)
+from psp_validation.simulation import init_worker
 from psp_validation.utils import CLICK_DIR, CLICK_FILE, load_config, load_yaml
 from psp_validation.version import __version__
 
@@ -54,14 +63,52 @@ def cli(verbose=0):
     default=None,
     help="Seed used to initialize the Numpy random number generator.",
 )
-def setup(simulation_config, output_dir, pathways, targets, edge_population, num_pairs, seed):
+@click.option(
+    "--cache-dir",
+    type=CLICK_DIR,
+    default=None,
+    help="Path to the cache folder (if not specified, OUTPUT_DIR/.psp-cache is used)",
+)
+@click.option(
+    "--cache-connectivity",
+    is_flag=True,
+    default=False,
+    help="Store the connectivity table of the pathway in the cache folder, and sample from it",
+)
+@click.option(
+    "--sample-edges",
+    is_flag=True,
+    default=False,
+    help="Sample the pairs by drawing random edges, instead of iterating over all connections",
+)
+def setup(  # noqa: PLR0913,PLR0917 too many args / positional args
+    simulation_config,
+    output_dir,
+    pathways,
+    targets,
+    edge_population,
+    num_pairs,
+    seed,
+    cache_dir,
+    cache_connectivity,
+    sample_edges,
+):
     """Set up the pairs to simulate."""
+    if cache_dir is None:
+        cache_dir = output_dir / DEFAULT_CACHE_DIRNAME
     pathways, output_dir = _parse_pathways_and_output_dir(pathways, output_dir)
     if seed is not None:
         np.random.seed(seed)
 
     setup_simulation(
-        simulation_config, edge_population, output_dir, pathways, load_yaml(targets), num_pairs
+        simulation_config,
+        edge_population,
+        output_dir,
+        pathways,
+        load_yaml(targets),
+        num_pairs,
+        cache_dir if cache_connectivity else None,
+        sample_edges,
     )
 
 
@@ -99,23 +146,90 @@ def setup(simulation_config, output_dir, pathways, targets, edge_population, num
         "setting to 0 would use all available CPUs)"
     ),
 )
-def run(simulation_config, output_dir, pathways, num_trials, nrrp, clamp, jobs):
+@click.option(
+    "--max-worker-rss",
+    type=float,
+    default=DEFAULT_MAX_RSS,
+    help="Recycle a simulation worker once its resident memory exceeds MAX_WORKER_RSS MB",
+    show_default=True,
+)
+@click.option(
+    "--cache-dir",
+    type=CLICK_DIR,
+    default=None,
+    help="Path to the cache folder (if not specified, OUTPUT_DIR/.psp-cache is used)",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(SIMULATION_BACKENDS),
+    default="local",
+    help=(
+        "Backend running the simulations: JOBS long-lived worker processes ('local'), a "
+        "process pool of JOBS workers ('process', 'loky'), the current process ('serial', e.g. "
+        "to debug), or all the MPI ranks but the first one ('mpi', requires mpi4py: run the "
+        "command with mpirun or srun)"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--cache-holding-currents/--no-cache-holding-currents",
+    default=True,
+    help=(
+        "Store the holding currents in the cache folder, and reuse them for the same post node, "
+        "holding voltage, mechanisms and bluecellulab version"
+    ),
+    show_default=True,
+)
+def run(  # noqa: PLR0913,PLR0917 too many args / positional args
+    simulation_config,
+    output_dir,
+    pathways,
+    num_trials,
+    nrrp,
+    clamp,
+    jobs,
+    max_worker_rss,
+    cache_dir,
+    backend,
+    cache_holding_currents,
+):
     """Run the simulation with the data configured in setup."""
+    if cache_dir is None:
+        cache_dir = output_dir / DEFAULT_CACHE_DIRNAME
     pathways, output_dir = _parse_pathways_and_output_dir(pathways, output_dir)
     pre_post_seeds = read_simulation_pairs(output_dir)
+    holding_current_cache = (
+        HoldingCurrentCache(cache_dir, simulation_config) if cache_holding_currents else None
+    )
+
+    with worker_pool(
+        backend,
+        get_n_workers(jobs),
+        max_rss=max_worker_rss,
+        initializer=init_worker,
+        initargs=(simulation_config, logging.getLogger(__name__).getEffectiveLevel()),
+    ) as pool:
+        if pool is None:
+            # MPI worker rank, done running the simulations
+            return
 
-    for nrrp_ in range(nrrp[0], nrrp[1] + 1):
-        for row in pre_post_seeds.itertuples():
-            run_simulation(
-                simulation_config,
-                row,
-                num_trials,
-                nrrp_,
-                pathways["protocol"],
-                output_dir,
-                clamp,
-                jobs,
-            )
+        for nrrp_ in range(nrrp[0], nrrp[1] + 1):
+            for row in pre_post_seeds.itertuples():
+                run_simulation(
+                    simulation_config,
+                    row,
+                    num_trials,
+                    nrrp_,
+                    pathways["protocol"],
+                    output_dir,
+                    clamp,
+                    jobs,
+                    pool=pool,
+                    holding_current_cache=holding_current_cache,
+                )
+
+    if holding_current_cache is not None:
+        holding_current_cache.log_stats()
 
 
 @cli.command()
@@ -143,12 +257,69 @@ def run(simulation_config, output_dir, pathways, num_trials, nrrp, clamp, jobs):
     "--jobs",
     type=int,
     help=(
-        "Number of trials to run in parallel"
-        "(if not specified, trials are run sequentially; "
+        "Number of NRRP values to analyze in parallel "
+        "(if not specified, they are analyzed sequentially; "
         "setting to 0 would use all available CPUs)"
     ),
 )
-def calibrate(output_dir, pathways, nrrp, num_pairs, num_reps, jobs):
+@click.option(
+    "--amplitude-backend",
+    type=click.Choice(["efel", "numpy"]),
+    default="efel",
+    help=(
+        "Backend used to extract the PSP amplitudes: 'numpy' computes the same features as "
+        "'efel' for all the traces of a pair at once"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--backend",
+    type=click.Choice(LOCAL_BACKENDS),
+    default="loky",
+    help="Backend running the JOBS workers analyzing the NRRP values (see `cv-validation run`)",
+    show_default=True,
+)
+@click.option(
+    "--noise-bank",
+    is_flag=True,
+    default=False,
+    help=(
+        "Store the OU noise of the trials of each pair in the cache folder, and add the same "
+        "noise to the trials of a pair for all the NRRP values and the next calibrations; this "
+        "changes the noise realizations (and the CVs), and uses 4 bytes per pair, trial and time "
+        "sample of disk space"
+    ),
+)
+@click.option(
+    "--cache-dir",
+    type=CLICK_DIR,
+    default=None,
+    help="Path to the cache folder (if not specified, OUTPUT_DIR/.psp-cache is used)",
+)
+def calibrate(  # noqa: PLR0913,PLR0917 too many args / positional args
+    output_dir,
+    pathways,
+    nrrp,
+    num_pairs,
+    num_reps,
+    jobs,
+    amplitude_backend,
+    backend,
+    noise_bank,
+    cache_dir,
+):
     """Analyse the simulation results."""
+    if cache_dir is None:
+        cache_dir = output_dir / DEFAULT_CACHE_DIRNAME
     pathways, output_dir = _parse_pathways_and_output_dir(pathways, output_dir)
-    run_calibration(output_dir, pathways, nrrp, n_pairs=num_pairs, n_reps=num_reps, n_jobs=jobs)
+    run_calibration(
+        output_dir,
+        pathways,
+        nrrp,
+        n_pairs=num_pairs,
+        n_reps=num_reps,
+        n_jobs=jobs,
+        amplitude_backend=amplitude_backend,
+        backend=backend,
+        noise_bank=NoiseBank(cache_dir) if noise_bank else None,
+    )
@@ -6,6 +6,9 @@ author: András Ecker
 """
 
 import numpy as np
+from scipy.signal import lfilter
+
+OU_METHODS = ("euler", "exact")
 
 
 def ou_generator(time, tau, sigma, initial_noise=0):
@@ -32,8 +35,73 @@ def ou_generator(time, tau, sigma, initial_noise=0):
     return noise
 
 
-def add_ou_noise(time, traces, tau, sigma):
-    """Adds noise to current/voltage traces (see also `ou_generator()`)"""
-    for i in range(traces.shape[0]):
-        traces[i, :] += ou_generator(time, tau, sigma)
+def ou_noise(shape, dt, tau, sigma, rng, initial_noise=0, method="euler", dtype=np.float32):
+    """Generates OU noise for a batch of traces at once.
+
+    The recurrence of `ou_generator` (noise[i] = decay * noise[i - 1] + random_element[i - 1],
+    around `initial_noise`) is run by a linear filter along the last axis, instead of a Python
+    loop over the time samples.
+
+    Args:
+        shape: tuple - (number of traces, number of time samples)
+        dt: float - time step of the traces
+        tau: float - tau parameter of OU noise (extracted from in vitro traces)
+        sigma: float - sigma parameter of OU noise (extracted from in vitro traces)
+        rng: numpy.random.Generator - generator of the random elements
+        initial_noise: float - mean/initial value of the noise
+        method: str - "euler" for the forward Euler scheme of `ou_generator`, or "exact" for the
+            exact discretization of the OU process (stationary std = sigma for any dt)
+        dtype: numpy dtype of the noise (float32 or float64)
+
+    Returns:
+        numpy array of the given shape with the noise of each trace
+    """
+    n_traces, n_samples = shape
+    random_element = np.empty(shape, dtype=dtype)
+    random_element[:, 1:] = rng.standard_normal((n_traces, n_samples - 1), dtype=dtype)
+    return ou_filter(random_element, dt, tau, sigma, initial_noise=initial_noise, method=method)
+
+
+def ou_filter(random_element, dt, tau, sigma, initial_noise=0, method="euler"):
+    """Generates OU noise from standard normal random elements, along the last axis.
+
+    The noise of sample i > 0 of a trace is driven by random_element[..., i], so that the random
+    elements of traces of any shape can be drawn beforehand (e.g. by a generator per pair) and
+    filtered at once (see `ou_noise()` for the arguments). `random_element` is overwritten.
+
+    Returns:
+        numpy array of the shape and dtype of `random_element`, with the noise of each trace
+    """
+    if method == "euler":
+        decay = 1 - dt / tau
+        scale = sigma * np.sqrt(2 * dt / tau)
+    elif method == "exact":
+        decay = np.exp(-dt / tau)
+        scale = sigma * np.sqrt(1 - decay**2)
+    else:
+        raise ValueError(f"Unknown OU method: {method} (expected one of {OU_METHODS})")
+
+    random_element[..., 0] = 0
+    random_element *= scale
+    noise = lfilter([1], [1, -decay], random_element, axis=-1).astype(
+        random_element.dtype, copy=False
+    )
+    noise += initial_noise
+    return noise
+
+
+def add_ou_noise(time, traces, tau, sigma, rng=None, method="euler"):
+    """Adds noise to current/voltage traces (see also `ou_noise()`)
+
+    The noise of all the traces is generated at once with `rng` (a `numpy.random.Generator`);
+    without `rng`, the traces are looped over with `ou_generator()` and the global NumPy RNG.
+    """
+    if rng is None:
+        for i in range(traces.shape[0]):
+            traces[i, :] += ou_generator(time, tau, sigma)
+        return traces
+
+    traces += ou_noise(
+        traces.shape, time[1] - time[0], tau, sigma, rng, method=method, dtype=traces.dtype
+    )
     return traces
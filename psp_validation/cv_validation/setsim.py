@@ -12,14 +12,27 @@ from psp_validation.pathways import get_pairs
 L = logging.getLogger(__name__)
 
 
-def write_pairs_and_seeds(pathway, targets, edge_population, n_pairs, output_dir):
-    """Gets desired number of pairs and seeds for the pathway and saves them to a file."""
+def write_pairs_and_seeds(
+    pathway, targets, edge_population, n_pairs, output_dir, cache_dir=None, sample_edges=False
+):
+    """Gets desired number of pairs and seeds for the pathway and saves them to a file.
+
+    If `cache_dir` is given, the pairs are sampled from the connectivity table cached there.
+    If `sample_edges` is True, the pairs are sampled by drawing random edges.
+    """
     L.info("Setting pairs and seeds for simulation...")
 
     pre = targets.get(pathway["pre"], pathway["pre"])
     post = targets.get(pathway["post"], pathway["post"])
 
-    pairs = get_pairs(edge_population, pre, post, num_pairs=n_pairs)
+    pairs = get_pairs(
+        edge_population,
+        pre,
+        post,
+        num_pairs=n_pairs,
+        cache_dir=cache_dir,
+        sample_edges=sample_edges,
+    )
 
     # Arbitrary random value range for seeds
     seeds = np.random.randint(1, 99999999 + 1, len(pairs))
@@ -28,9 +41,20 @@ def write_pairs_and_seeds(pathway, targets, edge_population, n_pairs, output_dir
     write_simulation_pairs(output_dir, pairs, seeds, syn_type)
 
 
-def setup_simulation(simulation_config, edge_population, output_dir, pathway, targets, num_pairs):
+def setup_simulation(
+    simulation_config,
+    edge_population,
+    output_dir,
+    pathway,
+    targets,
+    num_pairs,
+    cache_dir=None,
+    sample_edges=False,
+):
     """Entry point for setting up the simulation directory, pairs etc."""
     L.info("Setting up directories and files for simulation...")
     edge_population = Simulation(simulation_config).circuit.edges[edge_population]
-    write_pairs_and_seeds(pathway["pathway"], targets, edge_population, num_pairs, output_dir)
+    write_pairs_and_seeds(
+        pathway["pathway"], targets, edge_population, num_pairs, output_dir, cache_dir, sample_edges
+    )
     L.info("Done")
@@ -4,15 +4,16 @@ author: Giuseppe Chindemi
 + minor modifications by András Ecker for bluecellulab compatibility
 """
 
+import contextlib
 import logging
 import time
 
 import h5py
-import joblib
 import numpy as np
 from bluepysnap.circuit_ids import CircuitNodeId
 
 from psp_validation import PSPError
+from psp_validation.executors import get_n_workers, worker_pool
 from psp_validation.simulation import get_holding_current, run_pair_simulation
 from psp_validation.utils import ensure_list, isolate
 
@@ -23,24 +24,38 @@ DOC_REF = (
 )
 
 
-def _resolve_holding_current(hold_v, post_gid, simulation_config, post_ttx):
+def _resolve_holding_current(
+    hold_v, post_gid, simulation_config, post_ttx, holding_current_cache=None
+):
     if hold_v is None:
         L.warning(f"'hold_V' is None. 'hold_I' will be set to 0. See: {DOC_REF}")
         return 0
 
-    return get_holding_current(
+    if holding_current_cache is not None:
+        hold_i = holding_current_cache.get(post_gid, hold_v, post_ttx)
+        if hold_i is not None:
+            return hold_i
+
+    hold_i = get_holding_current(
         log_level=100,
         hold_V=hold_v,
         post_gid=post_gid,
         sonata_simulation_config=simulation_config,
         post_ttx=post_ttx,
     )
+    if holding_current_cache is not None:
+        holding_current_cache.put(post_gid, hold_v, post_ttx, hold_i)
+    return hold_i
 
 
 def resolve_holding_current_and_voltage(
-    protocol, clamp, post_gid, simulation_config, post_ttx=None
+    protocol, clamp, post_gid, simulation_config, post_ttx=None, holding_current_cache=None
 ):
-    """Resolve the holding current and voltage based on the config."""
+    """Resolve the holding current and voltage based on the config.
+
+    If `holding_current_cache` (a `psp_validation.cache.HoldingCurrentCache`) is given, the
+    holding current is looked up in it before being computed.
+    """
     if ("hold_V" in protocol) == ("hold_I" in protocol):
         raise PSPError(f"Either 'hold_V' or 'hold_I' should be specified. See: {DOC_REF}")
 
@@ -50,7 +65,9 @@ def resolve_holding_current_and_voltage(
             hold_v = None
         else:
             hold_v = protocol["hold_V"]
-            hold_i = _resolve_holding_current(hold_v, post_gid, simulation_config, post_ttx)
+            hold_i = _resolve_holding_current(
+                hold_v, post_gid, simulation_config, post_ttx, holding_current_cache
+            )
     else:
         hold_i = None
         hold_v = protocol["hold_V"]
@@ -58,51 +75,75 @@ def resolve_holding_current_and_voltage(
     return hold_i, hold_v
 
 
-def run_sim_handler(
-    sonata_simulation_config, input_params, nrrp, protocol, seeds, clamp, n_jobs=None
+def run_sim_handler(  # noqa: PLR0913,PLR0917 too many args / positional args
+    sonata_simulation_config,
+    input_params,
+    nrrp,
+    protocol,
+    seeds,
+    clamp,
+    n_jobs=None,
+    pool=None,
+    holding_current_cache=None,
+    backend="loky",
 ):
-    """Apply func to all items in it, using a process pool"""
+    """Run a simulation for each seed, using a process pool.
+
+    If `pool` (see `psp_validation.executors.worker_pool`) is given, the simulations are run by
+    its workers; otherwise each simulation is isolated in its own process and `n_jobs` of the
+    `backend` are used.
+    The holding current is shared by all the NRRP values if `holding_current_cache` is given.
+    """
     t_stim = protocol["t_stim"]
     post_gid = CircuitNodeId(id=input_params.post_id, population=input_params.post_population)
 
     hold_i, hold_v = resolve_holding_current_and_voltage(
-        protocol, clamp, post_gid, sonata_simulation_config
+        protocol,
+        clamp,
+        post_gid,
+        sonata_simulation_config,
+        holding_current_cache=holding_current_cache,
     )
 
-    if n_jobs is None:
-        n_jobs = 1
-    elif n_jobs <= 0:
-        n_jobs = -1
-
-    worker = joblib.delayed(isolate(run_pair_simulation))
-    results = joblib.Parallel(n_jobs=n_jobs, backend="loky")(
-        [
-            worker(
-                sonata_simulation_config=sonata_simulation_config,
-                pre_gid=CircuitNodeId(
-                    id=input_params.pre_id,
-                    population=input_params.pre_population,
-                ),
-                post_gid=post_gid,
-                t_stop=t_stim + 200,
-                t_stim=t_stim,
-                hold_I=hold_i,
-                hold_V=hold_v,
-                record_dt=None,
-                base_seed=seed,
-                nrrp=nrrp,
-                log_level=L.getEffectiveLevel(),
-            )
-            for seed in seeds
-        ],
-    )
+    kwargs = {
+        "sonata_simulation_config": sonata_simulation_config,
+        "pre_gid": CircuitNodeId(id=input_params.pre_id, population=input_params.pre_population),
+        "post_gid": post_gid,
+        "t_stop": t_stim + 200,
+        "t_stim": t_stim,
+        "hold_I": hold_i,
+        "hold_V": hold_v,
+        "record_dt": None,
+        "nrrp": nrrp,
+        "log_level": L.getEffectiveLevel(),
+    }
+
+    if pool is None:
+        func = isolate(run_pair_simulation)
+        pool_context = worker_pool(backend, get_n_workers(n_jobs))
+    else:
+        func = run_pair_simulation
+        pool_context = contextlib.nullcontext(pool)
+
+    with pool_context as jobs_pool:
+        futures = [jobs_pool.submit(func, base_seed=seed, **kwargs) for seed in seeds]
+        results = [future.result() for future in futures]
 
     # return only time, current and voltage for each simulation
     return [r[1:] for r in results]
 
 
-def run_simulation(
-    simulation, input_params, num_trials, nrrp, protocol, out_dir, clamp="current", n_jobs=None
+def run_simulation(  # noqa: PLR0913,PLR0917 too many args / positional args
+    simulation,
+    input_params,
+    num_trials,
+    nrrp,
+    protocol,
+    out_dir,
+    clamp="current",
+    n_jobs=None,
+    pool=None,
+    holding_current_cache=None,
 ):
     """Run the simulation with the provided arguments.
 
@@ -115,6 +156,8 @@ def run_simulation(
         out_dir: path to the output directory
         clamp: clamping to apply (either 'current' or 'voltage')
         n_jobs: number of parallel jobs
+        pool: pool of `psp_validation.executors.worker_pool` running the simulations
+        holding_current_cache: `psp_validation.cache.HoldingCurrentCache` of the holding currents
     """
     assert clamp in {"current", "voltage"}
     L.info("Starting simulation")
@@ -138,10 +181,18 @@ def run_simulation(
         start_time = time.perf_counter()
         L.debug("### DEBUG MODE ###")
         time_current_voltage = run_sim_handler(
-            simulation, input_params, nrrp, protocol, seeds, clamp, n_jobs=n_jobs
+            simulation,
+            input_params,
+            nrrp,
+            protocol,
+            seeds,
+            clamp,
+            n_jobs=n_jobs,
+            pool=pool,
+            holding_current_cache=holding_current_cache,
         )
-        for _seed, (time_, current, voltage) in zip(seeds, time_current_voltage):
-            seed_group = pair_group.create_group(f"seed{_seed}")
+        for seed, (time_, current, voltage) in zip(seeds, time_current_voltage, strict=True):
+            seed_group = pair_group.create_group(f"seed{seed}")
             seed_group.create_dataset(
                 "time", data=time_, chunks=True, compression="gzip", compression_opts=9
             )
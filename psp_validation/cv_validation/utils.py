@@ -9,7 +9,10 @@ PAIRS_FILENAME = "pairs.csv"
 def write_simulation_pairs(simulation_dir, pairs, seeds, synapse_type):
     """Saves the pairs (and seeds) selected for the simulation."""
     pre_populations, pre_ids, post_populations, post_ids = list(
-        zip(*[(pre.population, pre.id, post.population, post.id) for pre, post in pairs]),
+        zip(
+            *[(pre.population, pre.id, post.population, post.id) for pre, post in pairs],
+            strict=True,
+        ),
     )
 
     pairs_df = pd.DataFrame(
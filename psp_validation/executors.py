@@ -0,0 +1,891 @@
+"""Executors running the simulations."""
+
+import collections
+import contextlib
+import logging
+import multiprocessing
+import os
+import pathlib
+import pickle
+import queue
+import resource
+import signal
+import sys
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from functools import partial
+
+from joblib.externals.loky import get_reusable_executor
+
+from psp_validation import PSPError
+
+L = logging.getLogger(__name__)
+
+DEFAULT_MAX_RSS = 2048  # [MB]
+
+# backends of `worker_pool`:
+#   "serial": the tasks are run in the current process when they are submitted (e.g. to debug)
+#   "thread": threads of the current process (only for tasks releasing the GIL)
+#   "process": a `concurrent.futures.ProcessPoolExecutor`
+#   "loky": the reusable process pool of joblib, that serializes the tasks with cloudpickle
+#   "local": a `WorkerPool` of long-lived worker processes, recycled above an RSS ceiling
+#   "mpi": the MPI ranks, on any number of nodes (`MPIPool`)
+BACKENDS = ("serial", "thread", "process", "loky", "local", "mpi")
+# NEURON is not thread-safe: the simulations can not be run by threads
+SIMULATION_BACKENDS = tuple(backend for backend in BACKENDS if backend != "thread")
+# backends running the tasks on the current node, that can be used by a single process
+LOCAL_BACKENDS = tuple(backend for backend in BACKENDS if backend != "mpi")
+
+# interval between two polls of the MPI results by the dispatcher of `MPIPool` [s]
+MPI_POLL_INTERVAL = 0.01
+# one rank planning the tasks, and at least one running them
+_MIN_MPI_RANKS = 2
+_MPI_TASK_TAG = 1
+_MPI_RESULT_TAG = 2
+_MPI_STOP_TAG = 3
+
+_READY = "ready"
+_DONE = "done"
+_RETIRED = "retired"
+
+
+class WorkerLostError(PSPError):
+    """Raised when a worker process dies while running a task."""
+
+
+class _RemoteTracebackError(Exception):
+    """Traceback of an exception raised in a worker process."""
+
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def get_n_workers(n_jobs):
+    """Get the number of workers from the `--jobs` convention.
+
+    None runs the tasks sequentially (i.e. in one worker), non-positive values use all CPUs.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs <= 0:
+        return os.cpu_count()
+    return n_jobs
+
+
+def get_rss():
+    """Get the resident set size of the current process [MB]."""
+    try:
+        statm = pathlib.Path("/proc/self/statm").read_text(encoding="utf-8")
+        return int(statm.split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except OSError:
+        # no procfs: fall back to the peak RSS (KB on Linux, bytes on macOS)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+def _picklable_exception(exc):
+    """Get an exception that can be sent back to the parent process."""
+    tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    try:
+        pickle.dumps(exc)
+    except Exception:
+        exc = RuntimeError(repr(exc))
+    exc.__cause__ = _RemoteTracebackError(f'\n"""\n{tb}"""')
+    return exc
+
+
+def _run_task(payload):
+    """Run a pickled task.
+
+    Returns:
+        (success, result or exception, duration of the task [s])
+    """
+    start = time.perf_counter()
+    try:
+        func, args, kwargs = pickle.loads(payload)
+        result = (True, func(*args, **kwargs))
+    except BaseException as exc:
+        result = (False, _picklable_exception(exc))
+    return (*result, time.perf_counter() - start)
+
+
+def _worker(task_queue, result_queue, max_rss, initializer, initargs):
+    """Main loop of a worker process.
+
+    The tasks are sent one at a time by the parent process, on the `task_queue` of the worker.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+
+    pid = os.getpid()
+    result_queue.put((_READY, None, pid, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        task_id, payload = task
+        result = _run_task(payload)
+        if max_rss is not None and (rss := get_rss()) > max_rss:
+            L.debug(
+                "Worker %d RSS above the ceiling (%.0f > %.0f MB), recycling", pid, rss, max_rss
+            )
+            result_queue.put((_RETIRED, task_id, pid, result))
+            break
+        result_queue.put((_DONE, task_id, pid, result))
+
+
+def chain(future, func):
+    """Get a future of `func(future.result())`.
+
+    If `func` returns a future, the returned future is resolved with its result, which allows to
+    submit dependent tasks without blocking. `func` is called by the thread completing `future`.
+    """
+    chained = Future()
+    chained.set_running_or_notify_cancel()
+
+    def _callback(done):
+        try:
+            result = func(done.result())
+        except BaseException as exc:
+            chained.set_exception(exc)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(partial(_copy_future, target=chained))
+        else:
+            chained.set_result(result)
+
+    future.add_done_callback(_callback)
+    return chained
+
+
+def gather(futures):
+    """Get a future of the list of results of `futures`, failing as soon as one of them fails."""
+    gathered = Future()
+    gathered.set_running_or_notify_cancel()
+    futures = list(futures)
+    if not futures:
+        gathered.set_result([])
+        return gathered
+
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def _callback(done):
+        with lock:
+            if gathered.done():
+                return
+            if (exc := _get_exception(done)) is not None:
+                gathered.set_exception(exc)
+                return
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                gathered.set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(_callback)
+    return gathered
+
+
+def _get_exception(future):
+    """Get the exception of a completed future, including the cancellation."""
+    if future.cancelled():
+        return CancelledError()
+    return future.exception()
+
+
+def _copy_future(source, target):
+    if (exc := _get_exception(source)) is not None:
+        target.set_exception(exc)
+    else:
+        target.set_result(source.result())
+
+
+class TaskStats:
+    """Durations of the tasks run by a pool, to compare the backends."""
+
+    def __init__(self):
+        """The TaskStats constructor, starting the wall clock of the pool."""
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """Record the duration of a task [s]."""
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+
+    def log_stats(self, name, n_workers):
+        """Log the number and mean / max duration of the tasks, and the use of the workers."""
+        if self.count == 0:
+            return
+        wall_time = time.perf_counter() - self._start
+        L.info(
+            "%s backend: %d task(s) in %.1f s, %.3f s per task (max: %.3f s), "
+            "workers busy %.0f%% of the time",
+            name,
+            self.count,
+            wall_time,
+            self.total / self.count,
+            self.max,
+            100 * self.total / (wall_time * n_workers),
+        )
+
+
+class BasePool(ABC):
+    """Interface of the pools of `worker_pool`.
+
+    The pools implement `n_workers`, `submit` and `shutdown`, and record the duration of the
+    tasks in `stats`.
+    """
+
+    def __init__(self):
+        """The BasePool constructor."""
+        self.stats = TaskStats()
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        """Shut the pool down, cancelling the pending tasks on errors."""
+        self.shutdown(wait=exc_type is None)
+
+    @property
+    @abstractmethod
+    def n_workers(self):
+        """Number of workers."""
+
+    @abstractmethod
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` and return a `concurrent.futures.Future`."""
+
+    @abstractmethod
+    def shutdown(self, wait=True):
+        """Stop the workers.
+
+        Args:
+            wait (bool): wait for the submitted tasks to complete; pending tasks are cancelled
+                otherwise.
+        """
+
+    def map(self, func, *iterables):
+        """Return the list of results of `func` applied to the items of `iterables`."""
+        futures = [self.submit(func, *args) for args in zip(*iterables, strict=False)]
+        return [future.result() for future in futures]
+
+    def map_as_completed(self, func, *iterables):
+        """Apply `func` to the items of `iterables`, yielding the results as soon as they are done.
+
+        Yields:
+            (index, result): index of the items in `iterables`, and result of `func`
+        """
+        futures = {
+            self.submit(func, *args): index
+            for index, args in enumerate(zip(*iterables, strict=False))
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+class SerialPool(BasePool):
+    """Pool running the tasks in the current process when they are submitted (e.g. to debug)."""
+
+    def __init__(self, initializer=None, initargs=()):
+        """The SerialPool constructor.
+
+        Args:
+            initializer (function): function called in the current process
+            initargs (tuple): arguments passed to `initializer`
+        """
+        super().__init__()
+        self._shutdown = False
+        if initializer is not None:
+            initializer(*initargs)
+
+    @property
+    def n_workers(self):
+        """Number of workers, i.e. the current process."""
+        return 1
+
+    def submit(self, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` and return its completed `concurrent.futures.Future`."""
+        if self._shutdown:
+            raise RuntimeError("Cannot submit tasks after shutdown")
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        self.stats.add(time.perf_counter() - start)
+        return future
+
+    def shutdown(self, wait=True):  # noqa: ARG002 (the tasks are already done)
+        """Prevent new tasks from being submitted."""
+        self._shutdown = True
+
+
+def _run_timed(func, *args, **kwargs):
+    """Run `func(*args, **kwargs)`.
+
+    Returns:
+        (success, result or exception, duration of the task [s])
+    """
+    start = time.perf_counter()
+    try:
+        result = (True, func(*args, **kwargs))
+    except Exception as exc:
+        result = (False, _picklable_exception(exc))
+    return (*result, time.perf_counter() - start)
+
+
+class ExecutorPool(BasePool):
+    """Pool running the tasks with a `concurrent.futures.Executor` (see `worker_pool`)."""
+
+    def __init__(self, executor, n_workers):
+        """The ExecutorPool constructor.
+
+        Args:
+            executor (concurrent.futures.Executor): executor running the tasks
+            n_workers (int): number of workers of `executor`
+        """
+        super().__init__()
+        self._executor = executor
+        self._n_workers = n_workers
+        self._lock = threading.Lock()
+        self._tasks = set()
+
+    @property
+    def n_workers(self):
+        """Number of workers of the executor."""
+        return self._n_workers
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` and return a `concurrent.futures.Future`."""
+        future = Future()
+        task = self._executor.submit(_run_timed, func, *args, **kwargs)
+        with self._lock:
+            self._tasks.add(task)
+        task.add_done_callback(partial(self._set_result, future=future))
+        future.add_done_callback(lambda done: done.cancelled() and task.cancel())
+        return future
+
+    def _set_result(self, task, future):
+        with self._lock:
+            self._tasks.discard(task)
+        if task.cancelled():
+            future.cancel()
+        elif not future.set_running_or_notify_cancel():
+            return
+        elif (exc := task.exception()) is not None:
+            # e.g. a worker process died
+            future.set_exception(exc)
+        else:
+            success, value, duration = task.result()
+            self.stats.add(duration)
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def shutdown(self, wait=True):
+        """Stop the workers.
+
+        Args:
+            wait (bool): wait for the submitted tasks to complete; pending tasks are cancelled
+                otherwise.
+        """
+        if not wait:
+            with self._lock:
+                tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+        self._executor.shutdown(wait=wait)
+
+
+def _get_executor(backend, n_workers, initializer, initargs):
+    """Get the `concurrent.futures.Executor` of the "thread", "process" or "loky" backend."""
+    if backend == "thread":
+        return ThreadPoolExecutor(n_workers, initializer=initializer, initargs=initargs)
+    if backend == "process":
+        return ProcessPoolExecutor(
+            n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+    return get_reusable_executor(n_workers, initializer=initializer, initargs=initargs)
+
+
+class WorkerPool(BasePool):
+    """Pool of long-lived worker processes.
+
+    Unlike `multiprocessing.Pool(1, maxtasksperchild=1)`, the workers are reused across tasks,
+    so that the import of heavy modules and any state built by the `initializer` are shared by
+    all the tasks a worker runs.
+    A worker is recycled (i.e. replaced by a fresh one) once its resident memory exceeds
+    `max_rss` after a task, which keeps memory leaking tasks (e.g. NEURON simulations) in check.
+
+    Tasks are run in the order of submission. Each task is sent to an idle worker on its own
+    queue, so that the task of a worker dying at any time is known and failed.
+
+    The workers are not daemonic, so that the tasks can start child processes: the pool must be
+    shut down (e.g. used as a context manager) for the workers to exit.
+    """
+
+    def __init__(self, n_workers=1, max_rss=DEFAULT_MAX_RSS, initializer=None, initargs=()):
+        """The WorkerPool constructor.
+
+        Args:
+            n_workers (int): number of worker processes
+            max_rss (float): RSS ceiling of a worker [MB] (None to never recycle the workers)
+            initializer (function): function called in each worker when it starts
+            initargs (tuple): arguments passed to `initializer`
+        """
+        super().__init__()
+        self._context = multiprocessing.get_context("spawn")
+        self._result_queue = self._context.Queue()
+        self._max_rss = max_rss
+        self._initializer = initializer
+        self._initargs = initargs
+
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._pending = collections.deque()
+        self._idle = collections.deque()
+        self._running = {}
+        self._workers = {}
+        self._task_queues = {}
+        self._ready = set()
+        self._next_task_id = 0
+        self._shutdown = False
+        self._broken = None
+
+        for _ in range(n_workers):
+            self._spawn_worker()
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    @property
+    def n_workers(self):
+        """Number of worker processes."""
+        return len(self._workers)
+
+    def _spawn_worker(self):
+        task_queue = self._context.Queue()
+        # not daemonic, so that the tasks can start processes of their own (e.g. the isolated
+        # process of `bluecellulab.tools.holding_current`): the workers are reaped by `shutdown`
+        process = self._context.Process(
+            target=_worker,
+            args=(
+                task_queue,
+                self._result_queue,
+                self._max_rss,
+                self._initializer,
+                self._initargs,
+            ),
+            daemon=False,
+        )
+        process.start()
+        self._workers[process.pid] = process
+        self._task_queues[process.pid] = task_queue
+
+    def _remove_worker(self, pid):
+        """Forget a worker that exited (must be called with the lock held)."""
+        del self._workers[pid]
+        task_queue = self._task_queues.pop(pid)
+        # the tasks left in the queue of a dead worker are failed by `_check_workers`
+        task_queue.cancel_join_thread()
+        task_queue.close()
+        with contextlib.suppress(ValueError):
+            self._idle.remove(pid)
+
+    def _dispatch(self):
+        """Send the pending tasks to the idle workers (must be called with the lock held)."""
+        while self._idle and self._pending:
+            task_id, payload = self._pending.popleft()
+            future = self._futures.get(task_id)
+            if future is None or not future.set_running_or_notify_cancel():
+                L.debug("Task %d was cancelled", task_id)
+                self._futures.pop(task_id, None)
+                continue
+            pid = self._idle.popleft()
+            self._running[pid] = task_id
+            self._task_queues[pid].put((task_id, payload))
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` and return a `concurrent.futures.Future`."""
+        # pickle here rather than in the queue feeder thread, so that errors are raised here
+        payload = pickle.dumps((func, args, kwargs))
+        with self._lock:
+            if self._broken is not None:
+                raise self._broken
+            if self._shutdown:
+                raise RuntimeError("Cannot submit tasks after shutdown")
+
+            future = Future()
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._futures[task_id] = future
+            self._pending.append((task_id, payload))
+            self._dispatch()
+
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the workers.
+
+        Args:
+            wait (bool): wait for the submitted tasks to complete; pending tasks are cancelled
+                and the workers terminated otherwise.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            futures = list(self._futures.values())
+
+        if wait:
+            for future in futures:
+                with contextlib.suppress(Exception):
+                    future.exception()  # only waiting for completion
+            with self._lock:
+                processes = list(self._workers.values())
+                for task_queue in self._task_queues.values():
+                    task_queue.put(None)
+            for process in processes:
+                process.join()
+        else:
+            for future in futures:
+                future.cancel()
+            with self._lock:
+                self._pending.clear()
+                processes = list(self._workers.values())
+            for process in processes:
+                process.terminate()
+                process.join()
+
+        self._collector.join()
+        with self._lock:
+            for task_queue in self._task_queues.values():
+                task_queue.close()
+        self._result_queue.close()
+
+    def _collect(self):
+        """Collect the results sent by the workers and watch over the workers."""
+        while True:
+            try:
+                message, task_id, pid, result = self._result_queue.get(timeout=0.1)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                return
+
+            if message in {_DONE, _RETIRED}:
+                self._set_result(task_id, result)
+            if message is not None:
+                with self._lock:
+                    self._running.pop(pid, None)
+                    self._ready.add(pid)
+                    if message == _RETIRED:
+                        self._workers[pid].join()
+                        self._remove_worker(pid)
+                        if not self._shutdown:
+                            self._spawn_worker()
+                    elif pid in self._workers:
+                        # ready to run its first task, or done with its task
+                        self._idle.append(pid)
+                        self._dispatch()
+
+            if not self._check_workers():
+                return
+
+    def _set_result(self, task_id, result):
+        with self._lock:
+            future = self._futures.pop(task_id, None)
+        if future is None or future.cancelled():
+            return
+        success, value, duration = result
+        if duration is not None:
+            self.stats.add(duration)
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _check_workers(self):
+        """Replace the workers that died unexpectedly.
+
+        Returns:
+            False if the collector should stop, True otherwise.
+        """
+        with self._lock:
+            workers = list(self._workers.items())
+
+        for pid, process in workers:
+            # a worker exiting normally is either retiring or shutting down
+            if process.exitcode is None or process.exitcode == 0:
+                continue
+
+            with self._lock:
+                self._remove_worker(pid)
+                task_id = self._running.pop(pid, None)
+                ready = pid in self._ready
+            error = WorkerLostError(
+                f"Worker {pid} died unexpectedly (exit code: {process.exitcode})"
+            )
+            if not ready:
+                # died before being ready to run tasks (e.g. failing initializer): don't respawn
+                self._break(error)
+                return False
+
+            if task_id is not None:
+                L.warning("%s while running task %d", error, task_id)
+                self._set_result(task_id, (False, error, None))
+            else:
+                L.warning("%s while idle", error)
+            with self._lock:
+                if not self._shutdown:
+                    self._spawn_worker()
+
+        with self._lock:
+            alive = any(process.exitcode is None for process in self._workers.values())
+            return alive or not self._shutdown
+
+    def _break(self, error):
+        """Fail all the pending tasks."""
+        with self._lock:
+            self._broken = error
+            futures, self._futures = self._futures, {}
+            self._pending.clear()
+        for future in futures.values():
+            if not future.cancelled():
+                future.set_exception(error)
+
+
+def _import_mpi():
+    """Import the `mpi4py.MPI` module, an optional dependency."""
+    try:
+        from mpi4py import MPI  # noqa: PLC0415 optional dependency
+    except ImportError as e:
+        raise PSPError("The MPI backend requires mpi4py: pip install psp-validation[mpi]") from e
+    return MPI
+
+
+def _get_mpi_comm():
+    """Get the MPI world communicator."""
+    return _import_mpi().COMM_WORLD
+
+
+def _mpi_worker(comm, initializer, initargs):
+    """Main loop of an MPI worker rank: run the tasks sent by the rank 0 until it stops."""
+    mpi = _import_mpi()
+
+    # on SIGTERM (e.g. Slurm time limit), the rank 0 records the results before stopping the
+    # workers, which finish their current task instead of dying under its feet
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+    status = mpi.Status()
+    while True:
+        task = comm.recv(source=0, tag=mpi.ANY_TAG, status=status)
+        if status.Get_tag() == _MPI_STOP_TAG:
+            break
+
+        task_id, payload = task
+        success, value, duration = _run_task(payload)
+        try:
+            payload = pickle.dumps((success, value, duration))
+        except Exception as exc:
+            payload = pickle.dumps((False, _picklable_exception(exc), duration))
+        comm.send((task_id, payload), dest=0, tag=_MPI_RESULT_TAG)
+
+
+class MPIPool(BasePool):
+    """Pool of the MPI ranks, with the same interface as `WorkerPool`.
+
+    The rank 0 plans the tasks and processes their results, and the other ranks run the tasks
+    (see `worker_pool`). The tasks are dispatched by a thread of the rank 0 to the ranks as soon
+    as they are idle, so that the load is balanced dynamically over all the nodes, and the
+    results are set to the futures as soon as they are received.
+
+    Unlike the ones of a `WorkerPool`, the workers are not recycled, and the running tasks can
+    not be interrupted: they are waited for on shutdown.
+    """
+
+    def __init__(self, comm):
+        """The MPIPool constructor.
+
+        Args:
+            comm: MPI communicator (the tasks are run by all the ranks but the rank 0)
+        """
+        if comm.Get_size() < _MIN_MPI_RANKS:
+            raise PSPError("The MPI backend needs at least 2 ranks")
+
+        super().__init__()
+        self._comm = comm
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = collections.deque()
+        self._futures = {}
+        self._running = {}
+        self._idle = list(range(comm.Get_size() - 1, 0, -1))
+        self._next_task_id = 0
+        self._shutdown = False
+
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def n_workers(self):
+        """Number of worker ranks."""
+        return self._comm.Get_size() - 1
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` and return a `concurrent.futures.Future`."""
+        payload = pickle.dumps((func, args, kwargs))
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit tasks after shutdown")
+
+            future = Future()
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._futures[task_id] = future
+            self._pending.append((task_id, payload))
+
+        self._wakeup.set()
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the worker ranks, once the running tasks are done.
+
+        Args:
+            wait (bool): wait for the submitted tasks to complete; pending tasks are cancelled
+                otherwise.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            if not wait:
+                for task_id, _ in self._pending:
+                    self._futures.pop(task_id).cancel()
+                self._pending.clear()
+
+        self._wakeup.set()
+        self._dispatcher.join()
+
+    def _dispatch(self):
+        """Send the tasks to the idle ranks and collect the results, until shutdown."""
+        mpi = _import_mpi()
+
+        status = mpi.Status()
+        while True:
+            with self._lock:
+                tasks = []
+                while self._idle and self._pending:
+                    task_id, payload = self._pending.popleft()
+                    if self._futures[task_id].set_running_or_notify_cancel():
+                        tasks.append((self._idle.pop(), task_id, payload))
+                    else:
+                        del self._futures[task_id]
+                done = self._shutdown and not self._pending and not self._running and not tasks
+
+            if done:
+                break
+
+            for rank, task_id, payload in tasks:
+                self._running[rank] = task_id
+                self._comm.send((task_id, payload), dest=rank, tag=_MPI_TASK_TAG)
+
+            if self._comm.iprobe(source=mpi.ANY_SOURCE, tag=_MPI_RESULT_TAG, status=status):
+                rank = status.Get_source()
+                task_id, payload = self._comm.recv(source=rank, tag=_MPI_RESULT_TAG)
+                del self._running[rank]
+                with self._lock:
+                    self._idle.append(rank)
+                    future = self._futures.pop(task_id)
+                success, value, duration = pickle.loads(payload)
+                self.stats.add(duration)
+                if success:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            elif not tasks:
+                self._wakeup.wait(MPI_POLL_INTERVAL)
+                self._wakeup.clear()
+
+        for rank in range(1, self._comm.Get_size()):
+            self._comm.send(None, dest=rank, tag=_MPI_STOP_TAG)
+
+
+@contextlib.contextmanager
+def worker_pool(
+    backend="local", n_workers=1, max_rss=DEFAULT_MAX_RSS, initializer=None, initargs=()
+):
+    """Create the pool of workers of a backend (see `BACKENDS`).
+
+    All the pools have the interface of `BasePool`, and the statistics of their tasks are logged
+    once they are shut down.
+
+    With the "mpi" backend, the context must be entered by all the MPI ranks (e.g. by running
+    the same command with `mpirun` or `srun`): the rank 0 gets an `MPIPool`, while the other
+    ranks run its tasks until it is shut down, then get None and must not do anything else.
+
+    Args:
+        backend (str): one of `BACKENDS`
+        n_workers (int): number of workers of the "thread", "process", "loky" and "local"
+            backends (the "serial" backend has one worker, and the "mpi" one a worker per rank)
+        max_rss (float): RSS ceiling of a worker of the "local" backend [MB]
+        initializer (function): function called in each worker when it starts
+        initargs (tuple): arguments passed to `initializer`
+
+    Yields:
+        the pool, or None in the worker ranks of the "mpi" backend
+    """
+    if backend == "serial":
+        pool = SerialPool(initializer, initargs)
+    elif backend in {"thread", "process", "loky"}:
+        pool = ExecutorPool(_get_executor(backend, n_workers, initializer, initargs), n_workers)
+    elif backend == "local":
+        pool = WorkerPool(n_workers, max_rss, initializer, initargs)
+    elif backend == "mpi":
+        comm = _get_mpi_comm()
+        if comm.Get_rank() != 0:
+            _mpi_worker(comm, initializer, initargs)
+            yield None
+            return
+        L.info("Running the tasks on %d MPI ranks", comm.Get_size() - 1)
+        pool = MPIPool(comm)
+    else:
+        raise PSPError(f"Unknown backend: {backend}")
+
+    with pool:
+        n_workers = pool.n_workers
+        yield pool
+    pool.stats.log_stats(backend, n_workers)
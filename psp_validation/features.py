@@ -1,10 +1,28 @@
 """Features extractions definitions."""
 
+import threading
+import warnings
+
 import efel
 import numpy as np
 
 from psp_validation import PSPError
 
+AMPLITUDE_BACKENDS = ("efel", "numpy")
+
+# efel settings used by the "numpy" backend of `get_peak_amplitudes`
+EFEL_INTERP_STEP = 0.1
+EFEL_VOLTAGE_BASE_START_PERC = 0.9
+EFEL_VOLTAGE_BASE_END_PERC = 1.0
+EFEL_PRECISION_THRESHOLD = 1e-10
+
+# efel keeps the trace being analyzed in a global state: the calls from several threads (e.g.
+# the checks of the adaptive trials, see `psp_validation.pathways`) are serialized
+_EFEL_LOCK = threading.Lock()
+
+# z-score of the two-sided 95% confidence interval of a mean
+Z_95 = 1.959963984540054
+
 
 def check_syn_type(syn_type):
     """Check that synapse type is valid."""
@@ -12,32 +30,53 @@ def check_syn_type(syn_type):
         raise AttributeError(f"syn_type must be one of EXC or INH, not: {syn_type}")
 
 
-def old_school_trace(simu_results):
-    """Get the traces as it was before."""
-    return np.array([(voltage_array, simu_results.time) for voltage_array in simu_results.voltages])
+def select_traces(time, voltages, trace_filters):
+    """Select the traces passing all the trace filters.
+
+    Each filter is applied to the traces selected by the previous ones only.
 
+    Args:
+        time (np.ndarray): array of the T measurement times, shared by all the traces
+        voltages (np.ndarray): N x T array of voltages
+        trace_filters (list): list of BaseTraceFilter
 
-def mean_pair_voltage_from_traces(vts, trace_filters):
+    Returns:
+        (np.ndarray, dict): (boolean mask of the selected traces,
+            number of traces rejected by each filter, by filter class name)
+    """
+    selected = np.ones(len(voltages), dtype=bool)
+    rejected = {}
+    for trace_filter in trace_filters:
+        index = np.flatnonzero(selected)
+        keep = trace_filter.mask(time, voltages[index])
+        selected[index[~keep]] = False
+        name = type(trace_filter).__name__
+        rejected[name] = rejected.get(name, 0) + int(np.count_nonzero(~keep))
+
+    return selected, rejected
+
+
+def mean_pair_voltage_from_traces(time, voltages, trace_filters):
     """Perform some filtering and calculate mean V over repetitions.
 
     Args:
-        vts (np.ndarray): N x 2 x T array of traces
+        time (np.ndarray): array of the T measurement times, shared by all the traces
+        voltages (np.ndarray): N x T array of voltages
         trace_filters (list): list of BaseTraceFilter
 
     Returns:
         (float, np.ndarray, np.ndarray): (v_mean, array of times, array of selected voltages)
     """
-    for trace_filter in trace_filters:
-        vts = trace_filter(vts)
-    if len(vts) == 0:
+    voltages = np.asarray(voltages)
+    if len(voltages) == 0:
         return None, None, []
 
-    vts = np.array(vts)
+    selected, _ = select_traces(time, voltages, trace_filters)
+    if not np.any(selected):
+        return None, None, []
 
-    # keep the first time series (they are all the same)
-    time = vts[0, 1]
+    vs = voltages[selected]
     # calculate element-wise mean v (over reps)
-    vs = vts[:, 0]
     v_mean = np.mean(vs, axis=0)
 
     return v_mean, time, vs
@@ -57,6 +96,9 @@ def _check_numpy_ndarrays(*args):
 def get_peak_voltage(time, voltage, t_stim, syn_type):
     """Return the peak voltage after time t_stim.
 
+    Deprecated: the trace filters find the spikes of all the traces of a pair at once
+    (see `psp_validation.trace_filters.SpikeFilter.mask`).
+
     Args:
     time: numpy.ndarray containing time measurements
     voltage: numpy.ndarray containing voltage measurements
@@ -73,6 +115,11 @@ def get_peak_voltage(time, voltage, t_stim, syn_type):
             other than a numpy.ndarray. This is because this situation
             could result in silently returning the wrong value.
     """
+    warnings.warn(
+        "get_peak_voltage is deprecated and will be removed in a future version",
+        DeprecationWarning,
+        stacklevel=2,
+    )
     _check_numpy_ndarrays(time, voltage)
     check_syn_type(syn_type)
     fun = np.max if syn_type == "EXC" else np.min
@@ -90,7 +137,7 @@ def efel_traces(times, traces, t_stim):
             "stim_start": [t_stim],
             "stim_end": [np.max(times)],
         }
-        for time, trace in zip(times, traces)
+        for time, trace in zip(times, traces, strict=True)
     ]
 
 
@@ -113,22 +160,94 @@ def _get_peak(syn_type, clamp):
     return "minimum_voltage" if xor_exc_current else "maximum_voltage"
 
 
-def get_peak_amplitudes(time, voltage, t_stim, syn_type, clamp="current"):
+def _efel_time(time):
+    """Get the time points at which efel interpolates the traces.
+
+    Like efel, the interpolation step is accumulated from the first time point (`np.cumsum` adds
+    the steps one after the other), and one more point is added if the last one is before the end
+    of the traces.
+    """
+    n_points = int(np.ceil((time[-1] - time[0]) / EFEL_INTERP_STEP))
+    efel_time = np.cumsum(np.concatenate([[time[0]], np.full(n_points - 1, EFEL_INTERP_STEP)]))
+    if efel_time[-1] < time[-1]:
+        efel_time = np.append(efel_time, efel_time[-1] + EFEL_INTERP_STEP)
+    return efel_time
+
+
+def _interpolate(time, voltage, new_time):
+    """Linearly interpolate all the N x T `voltage` traces sharing the same `time`, like efel."""
+    index = np.clip(np.searchsorted(time, new_time, side="left") - 1, 0, len(time) - 2)
+    slope = (voltage[:, index + 1] - voltage[:, index]) / (time[index + 1] - time[index])
+    result = voltage[:, index] + slope * (new_time - time[index])
+    result[:, new_time > time[-1]] = voltage[:, [-1]]
+    return result
+
+
+def _get_peak_amplitudes_numpy(time, voltage, t_stim, peak):
+    """Get the peak amplitudes of the traces sharing the same time, like efel does.
+
+    The traces are interpolated at the same time points as efel, and `voltage_base` (mean before
+    the stimulus) and `peak` (extremum after the stimulus) are computed on the same windows as
+    efel, for all the traces at once.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    if time.ndim > 1:
+        if not np.all(time == time[0]):
+            raise PSPError("The numpy backend requires all the traces to share the same time")
+        time = time[0]
+    voltage = np.asarray(voltage, dtype=np.float64).reshape(-1, len(time))
+
+    efel_time = _efel_time(time)
+    if t_stim > efel_time[-1]:
+        raise PSPError(f"t_stim={t_stim} is after the end of the traces")
+
+    # the end of the baseline window is tolerant to the precision loss of the time points
+    base_start = np.searchsorted(efel_time, EFEL_VOLTAGE_BASE_START_PERC * t_stim, side="left")
+    base_end = np.searchsorted(
+        efel_time - EFEL_VOLTAGE_BASE_END_PERC * t_stim, EFEL_PRECISION_THRESHOLD, side="left"
+    )
+    base_time = efel_time[base_start:base_end]
+    if len(base_time) == 0:
+        voltage_base = np.full(len(voltage), np.nan)
+    else:
+        voltage_base = _interpolate(time, voltage, base_time).mean(axis=1)
+
+    # the end of the peak window is excluded, unless the window would be empty
+    peak_start = np.searchsorted(efel_time, t_stim, side="left")
+    peak_end = np.searchsorted(efel_time, min(time.max(), efel_time[-1]), side="left")
+    peak_time = efel_time[peak_start : max(peak_end, peak_start + 1)]
+    fun = np.min if peak == "minimum_voltage" else np.max
+    peaks = fun(_interpolate(time, voltage, peak_time), axis=1)
+
+    return list(np.abs(peaks - voltage_base))
+
+
+def get_peak_amplitudes(time, voltage, t_stim, syn_type, clamp="current", backend="efel"):
     """Get the peak amplitudes in time series.
 
     Args:
-        time: N x T array holding T time measurements for N traces
+        time: N x T array holding T time measurements for N traces (with the "numpy" backend,
+            it can also be the T time measurements shared by all the traces)
         voltage: N x T array holding T voltage measurements for N traces
         t_stim: time of the stimulus
         syn_type: type of synapse ("EXC" or "INH")
         clamp: clamp mode ('current' or 'voltage')
+        backend: "efel" to compute the features with efel, or "numpy" to compute the same
+            features for all the traces at once with NumPy (faster, but requires all the traces
+            to share the same time)
 
     Return:
         Absolute difference between calculated mean v/c and peak v/c (clamp: current/voltage)
     """
     peak = _get_peak(syn_type, clamp)
+    if backend == "numpy":
+        return _get_peak_amplitudes_numpy(time, voltage, t_stim, peak)
+    if backend != "efel":
+        raise PSPError(f"backend must be one of {AMPLITUDE_BACKENDS}, not: {backend}")
+
     traces = efel_traces(time, voltage, t_stim)
-    traces_results = efel.get_feature_values(traces, [peak, "voltage_base"])
+    with _EFEL_LOCK:
+        traces_results = efel.get_feature_values(traces, [peak, "voltage_base"])
 
     return [abs(res[peak][0] - res["voltage_base"][0]) for res in traces_results]
 
@@ -144,7 +263,8 @@ def resting_potential(time, voltage, t_start, t_stim):
         }
     ]
 
-    feature_value = efel.get_feature_values(traces, ["voltage_base"])
+    with _EFEL_LOCK:
+        feature_value = efel.get_feature_values(traces, ["voltage_base"])
 
     if feature_value is None:
         raise PSPError("Something went wrong when computing efel voltage_base")
@@ -182,3 +302,15 @@ def get_synapse_type(node_population, node_group):
         return synapse_types[0]
 
     return "EXC"
+
+
+def relative_ci_width(values):
+    """Get the width of the 95% confidence interval of the mean of `values`, relative to the mean.
+
+    The NaN values are ignored; inf is returned if there are fewer than 2 values or the mean is 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) <= 1 or (mean := np.mean(values)) == 0:
+        return np.inf
+    return 2 * Z_95 * np.std(values, ddof=1) / np.sqrt(len(values)) / abs(mean)
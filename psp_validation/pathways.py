@@ -1,25 +1,70 @@
 """Repository for pathway queries."""
 
+import contextlib
 import itertools
+import json
 import logging
+import operator
+import re
 
+import attr
 import h5py
+import libsonata
 import numpy as np
+from bluepysnap.circuit_ids import CircuitNodeId
 
+from psp_validation import PSPError
+from psp_validation.checkpoint import CheckpointWriter, Terminated, load_checkpoint, normalize
+from psp_validation.connectivity import get_connectivity_table
+from psp_validation.executors import chain
 from psp_validation.features import (
     compute_scaling,
     get_peak_amplitudes,
     get_synapse_type,
-    mean_pair_voltage_from_traces,
-    old_school_trace,
+    relative_ci_width,
     resting_potential,
+    select_traces,
 )
-from psp_validation.persistencyutils import dump_pair_traces
+from psp_validation.persistencyutils import (
+    BackgroundTraceWriter,
+    TraceWriter,
+    count_pair_traces,
+    iter_pair_traces,
+    read_pair_traces,
+)
+from psp_validation.simulation import SimulationResult, concatenate_results
 from psp_validation.trace_filters import AmplitudeFilter, NullFilter, SpikeFilter
 from psp_validation.utils import load_config
 
 L = logging.getLogger(__name__)
 
+# voltage [mV] above which a trace is considered spiking after the stimulus, and filtered out
+DEFAULT_SPIKE_THRESHOLD = -20.0
+
+# trials run at once for a pair by the adaptive mode (see `AdaptiveTrials`)
+DEFAULT_MIN_TRIALS = 5
+
+# edges drawn at once by `sample_pairs_from_edges`
+DRAW_BATCH_SIZE = 1000
+# maximum number of edges drawn by `sample_pairs_from_edges` for each pair
+MAX_DRAWS_PER_PAIR = 10000
+# maximum number of draws by `sample_pairs_from_edges` for each candidate edge: beyond that,
+# iterating over all the connections is cheaper
+MAX_DRAWS_PER_EDGE = 10
+
+
+@attr.s(frozen=True)
+class AdaptiveTrials:
+    """Parameters of the adaptive number of trials of the pairs.
+
+    The trials of a pair are run in batches of `min_trials`, until the 95% confidence interval of
+    the mean PSP amplitude of its selected trials is narrower than `tolerance` times the mean
+    (or the maximum number of trials is reached).
+    """
+
+    tolerance = attr.ib(type=float)
+    min_trials = attr.ib(type=int, default=DEFAULT_MIN_TRIALS)
+
 
 class ConnectionFilter:
     """Filter (pre_gid, post_gid, [nsyn]) tuples by different criteria."""
@@ -60,6 +105,8 @@ class ConnectionFilter:
             self.used_gids = set()
         else:
             self.used_gids = None
+        self._source_positions = None
+        self._target_positions = None
 
     def __call__(self, connection):  # noqa: C901,PLR0911 too-complex,too-many-returns
         """Apply filtering"""
@@ -97,8 +144,182 @@ class ConnectionFilter:
         """If filter uses synapse count."""
         return (self.min_nsyn is not None) or (self.max_nsyn is not None)
 
+    @property
+    def requires_positions(self):
+        """If filter uses soma positions."""
+        return any(dist is not None for dist in (self.max_dist_x, self.max_dist_y, self.max_dist_z))
+
+    def _load_positions(self):
+        """Load the soma positions of the source and target populations, indexed by node id."""
+        if self._source_positions is None:
+            # node ids of a SONATA population are contiguous, starting from 0
+            self._source_positions = self.edge_population.source.positions().to_numpy()
+            self._target_positions = self.edge_population.target.positions().to_numpy()
+        return self._source_positions, self._target_positions
+
+    def mask(self, nsyn=None, delta=None):
+        """Get the mask of the connections passing the synapse count and distance criteria.
+
+        Args:
+            nsyn (numpy.ndarray): synapse count of each connection
+                (only used if `requires_synapse_count`)
+            delta (numpy.ndarray): N x 3 absolute soma position differences between the pre- and
+                post- synaptic cells (only used if `requires_positions`)
+        """
+        size = len(nsyn) if nsyn is not None else len(delta)
+        mask = np.ones(size, dtype=bool)
+        if self.min_nsyn is not None:
+            mask &= nsyn >= self.min_nsyn
+        if self.max_nsyn is not None:
+            mask &= nsyn <= self.max_nsyn
+        if self.requires_positions:
+            max_dist = np.array(
+                [
+                    np.inf if dist is None else dist
+                    for dist in (self.max_dist_x, self.max_dist_y, self.max_dist_z)
+                ]
+            )
+            mask &= ~np.any(delta > max_dist, axis=1)
+        return mask
+
+    def unique(self, connections):
+        """Apply the `unique_gids` criterion to the connections, in turn."""
+        if self.used_gids is None:
+            return list(connections)
+
+        result = []
+        for connection in connections:
+            pre_gid, post_gid = connection[:2]
+            if (pre_gid in self.used_gids) or (post_gid in self.used_gids):
+                continue
+            self.used_gids.add(pre_gid)
+            self.used_gids.add(post_gid)
+            result.append(connection)
+        return result
+
+    def filter(self, connections):
+        """Apply filtering to a block of connections at once.
+
+        Equivalent to `[connection for connection in connections if self(connection)]`, with
+        the synapse count and distance criteria evaluated with NumPy on the whole block, and
+        only the `unique_gids` criterion evaluated on each remaining connection in turn.
+        """
+        connections = list(connections)
+        nsyn = delta = None
+        if self.requires_synapse_count:
+            nsyn = np.array([connection[2] for connection in connections])
+        if self.requires_positions:
+            source_positions, target_positions = self._load_positions()
+            pre_ids = np.array([connection[0].id for connection in connections], dtype=int)
+            post_ids = np.array([connection[1].id for connection in connections], dtype=int)
+            delta = np.abs(source_positions[pre_ids] - target_positions[post_ids])
+
+        if nsyn is not None or delta is not None:
+            mask = self.mask(nsyn, delta)
+            connections = [
+                connection for connection, keep in zip(connections, mask, strict=True) if keep
+            ]
+
+        return self.unique(connections)
+
+
+def _iter_pairs(edge_population, pre, post, num_pairs, connection_filter):
+    """Sample the pairs while iterating over the shuffled connections of the pathway."""
+    iter_connections = edge_population.iter_connections(
+        pre, post, shuffle=True, return_edge_count=connection_filter.requires_synapse_count
+    )
+
+    pairs = []
+    while len(pairs) < num_pairs:
+        # Reading no more candidates than the pairs still needed, the connections (and thus the
+        # random numbers used to shuffle them) are the same as with a one by one filtering.
+        block = list(itertools.islice(iter_connections, num_pairs - len(pairs)))
+        if not block:
+            break
+        pairs.extend(connection[:2] for connection in connection_filter.filter(block))
+
+    return pairs
+
+
+def sample_pairs_from_edges(  # noqa: PLR0914 too many locals
+    edge_population, pre, post, num_pairs, connection_filter, max_draws=None
+):
+    """Sample the pairs by drawing random edges of the pathway.
+
+    Edges are drawn uniformly from the afferent edges of the postsynaptic cells (or the efferent
+    edges of the presynaptic cells, whichever are fewer), and the ones that do not belong to the
+    pathway are rejected. A connection being drawn with a probability proportional to its
+    synapse count, it is accepted with a probability 1 / nsyn, so that the connections are
+    sampled uniformly. Unlike `_iter_pairs`, only the index of the edges is read, and the
+    sampling stops as soon as `num_pairs` pairs are accepted.
+
+    Args:
+        edge_population: bluepysnap.edges.EdgePopulation instance
+        pre: presynaptic node set
+        post: postsynaptic node set
+        num_pairs: number of pairs to return
+        connection_filter: `ConnectionFilter` applied to the pairs
+        max_draws: maximum number of edges drawn (default: `MAX_DRAWS_PER_PAIR` * `num_pairs`,
+            capped to `MAX_DRAWS_PER_EDGE` times the number of candidate edges)
+
+    Returns:
+        List of `num_pairs` (pre_gid, post_gid) pairs, or None if they could not be found in
+        `max_draws` draws (e.g. if the pathway has fewer connections).
+    """
+    if num_pairs <= 0:
+        return []
+
+    edges = edge_population.to_libsonata
+    pre_ids = np.unique(edge_population.source.ids(pre))
+    post_ids = np.unique(edge_population.target.ids(post))
+    afferent = edges.afferent_edges(post_ids)
+    efferent = edges.efferent_edges(pre_ids)
+    selection = afferent if afferent.flat_size <= efferent.flat_size else efferent
+    if selection.flat_size == 0:
+        return None
+    if max_draws is None:
+        max_draws = min(MAX_DRAWS_PER_PAIR * num_pairs, MAX_DRAWS_PER_EDGE * selection.flat_size)
+
+    ranges = np.array(selection.ranges, dtype=np.int64).reshape(-1, 2)
+    offsets = np.cumsum(ranges[:, 1] - ranges[:, 0])
+
+    pairs, seen, n_draws = [], set(), 0
+    while len(pairs) < num_pairs and n_draws < max_draws:
+        batch_size = min(DRAW_BATCH_SIZE, max_draws - n_draws)
+        n_draws += batch_size
+
+        # draw the edges, and read the nodes they connect
+        flat_ids = np.random.randint(selection.flat_size, size=batch_size)
+        range_index = np.searchsorted(offsets, flat_ids, side="right")
+        edge_ids, inverse = np.unique(
+            ranges[range_index, 1] - (offsets[range_index] - flat_ids), return_inverse=True
+        )
+        sources = edges.source_nodes(libsonata.Selection(edge_ids))[inverse]
+        targets = edges.target_nodes(libsonata.Selection(edge_ids))[inverse]
+        in_pathway = np.isin(sources, pre_ids) & np.isin(targets, post_ids)
+
+        for source, target in zip(sources[in_pathway], targets[in_pathway], strict=True):
+            if (source, target) in seen:
+                continue
+            nsyn = edges.connecting_edges([source], [target]).flat_size
+            if np.random.random() * nsyn >= 1:
+                continue
+            seen.add((source, target))
+            connection = (
+                CircuitNodeId(edge_population.source.name, int(source)),
+                CircuitNodeId(edge_population.target.name, int(target)),
+                nsyn,
+            )
+            pairs.extend(connection[:2] for connection in connection_filter.filter([connection]))
+            if len(pairs) == num_pairs:
+                return pairs
+
+    return None
 
-def get_pairs(edge_population, pre, post, num_pairs, constraints=None):
+
+def get_pairs(
+    edge_population, pre, post, num_pairs, constraints=None, cache_dir=None, sample_edges=False
+):
     """Get 'n_pairs' connected pairs specified by `query` and optional `constraints`.
 
     Args:
@@ -107,20 +328,40 @@ def get_pairs(edge_population, pre, post, num_pairs, constraints=None):
         post: postsynaptic node set
         num_pairs: number of pairs to return
         constraints: dict passed as kwargs to `ConnectionFilter`
+        cache_dir: if not None, sample the pairs uniformly from the connectivity table of the
+            pathway, cached in this directory (see `psp_validation.connectivity`)
+        sample_edges: if True, sample the pairs uniformly by drawing random edges
+            (see `sample_pairs_from_edges`)
 
     Returns:
         List of `n` (pre_gid, post_gid) pairs (or fewer if could not find enough)
     """
     L.info("Sampling pairs for pathway...")
     constraints = constraints or {}
-    connection_filter = ConnectionFilter(edge_population, **constraints)
-
-    iter_connections = edge_population.iter_connections(
-        pre, post, shuffle=True, return_edge_count=connection_filter.requires_synapse_count
-    )
 
-    iter_connections = filter(connection_filter, iter_connections)
-    pairs = [connection[:2] for connection in itertools.islice(iter_connections, num_pairs)]
+    if cache_dir is not None:
+        table = get_connectivity_table(cache_dir, edge_population, pre, post)
+        pairs = table.sample(num_pairs, ConnectionFilter(edge_population, **constraints))
+    elif sample_edges:
+        pairs = sample_pairs_from_edges(
+            edge_population, pre, post, num_pairs, ConnectionFilter(edge_population, **constraints)
+        )
+        if pairs is None:
+            L.warning(
+                "Could not sample %d pairs from random edges, iterating over all connections",
+                num_pairs,
+            )
+            pairs = _iter_pairs(
+                edge_population,
+                pre,
+                post,
+                num_pairs,
+                ConnectionFilter(edge_population, **constraints),
+            )
+    else:
+        pairs = _iter_pairs(
+            edge_population, pre, post, num_pairs, ConnectionFilter(edge_population, **constraints)
+        )
 
     if not pairs:
         L.warning("Could not find pairs for the pathway")
@@ -128,6 +369,64 @@ def get_pairs(edge_population, pre, post, num_pairs, constraints=None):
     return pairs
 
 
+def get_shard_suffix(shard):
+    """Get the suffix of the output files of a shard (K, N) of the pairs ("" if None)."""
+    return "" if shard is None else f".shard-{shard[0]}-of-{shard[1]}"
+
+
+def _load_shards(input_dir, title):
+    """Load the checkpoints of all the shards of a pathway, and check they are complete.
+
+    Returns:
+        list of (checkpoint path, header, records) of each shard, ordered by shard
+    """
+    shards = {}
+    pattern = re.compile(rf"{re.escape(title)}\.shard-(\d+)-of-(\d+)\.checkpoint\.jsonl")
+    for path in sorted(input_dir.glob(f"{title}.shard-*-of-*.checkpoint.jsonl")):
+        if match := pattern.fullmatch(path.name):
+            shards[int(match[1]), int(match[2])] = path
+    if not shards:
+        raise PSPError(f"No shards of '{title}' pathway in {input_dir}")
+
+    n_shards = {n_shards for _, n_shards in shards}
+    if len(n_shards) > 1:
+        raise PSPError(f"Shards of '{title}' pathway from runs with different numbers of shards")
+    n_shards = n_shards.pop()
+    if missing := sorted(set(range(n_shards)) - {index for index, _ in shards}):
+        raise PSPError(
+            f"Missing shards of '{title}' pathway: {', '.join(f'{k}/{n_shards}' for k in missing)}"
+        )
+
+    loaded = []
+    for (index, _), path in sorted(shards.items()):
+        header, records = load_checkpoint(path)
+        if loaded and (header["run"], header["pairs"]) != (
+            loaded[0][1]["run"],
+            loaded[0][1]["pairs"],
+        ):
+            raise PSPError(
+                f"{path} was written by a run with other parameters than the other shards"
+            )
+        expected = set(range(index, len(header["pairs"]), n_shards))
+        if {record["index"] for record in records} != expected:
+            raise PSPError(
+                f"Shard {index}/{n_shards} of '{title}' pathway is not complete "
+                f"({len(records)} out of {len(expected)} pairs): run it again with --resume"
+            )
+        loaded.append((path, header, records))
+    return loaded
+
+
+def _has_result(future):
+    """Check if a future is done, with a result."""
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+def _format_rejected_traces(rejected):
+    """Format the number of traces rejected by each trace filter, for logging."""
+    return ", ".join(f"{name}: {count}" for name, count in rejected.items() if count > 0)
+
+
 class Pathway:
     """Pathway specific parameters.
 
@@ -145,18 +444,20 @@ class Pathway:
     def __init__(self, pathway_config_path, sim_runner, protocol_params, edge_population):
         """The pathway constructor.
 
-        The simulation is run only when ``run`` method is called.
+        The pairs are sampled here, but the simulation is run only when ``run`` method is called
+        (or when the pairs are submitted with ``submit_pair`` and processed with ``process``).
 
         Args:
             pathway_config_path (pathlib.Path): path to a pathway file
-            sim_runner (function): a callable to run the simulation
+            sim_runner (function): a callable submitting the simulation of a pair, and returning
+                a `concurrent.futures.Future` of its `SimulationResult`
             protocol_params (ProtocolParameters): the parameters to used
             edge_population (str): edge population name
 
-        Attrs:
+        Attributes:
             title: the pathway name, taken from the basename of the pathway file
             config: the config
-            sim_runner: a callable that will run the simulation and return traces
+            sim_runner: a callable that will submit the simulation and return a future of traces
             protocol_params: the parameters describing the experimental protocol
             pathway: a dictionary with the pathway specific information
             pairs: the list of gid pairs
@@ -164,6 +465,11 @@ class Pathway:
             t_start: the simulation start time
             trace_filters: list of filters to filter out voltage traces
             resting_potentials: the resting potentials
+            completed: the records of the completed pairs, by pair index
+
+        If `protocol_params.resume` and the checkpoint of a previous run of the pathway exists,
+        the pairs are read from it instead of being sampled, and the pairs it records as
+        completed are not simulated again.
         """
         self.title = pathway_config_path.stem
         self.config = load_config(pathway_config_path)
@@ -179,15 +485,109 @@ class Pathway:
 
         self.edge_population = circuit.edges[edge_population]
 
-        self.pairs = get_pairs(
-            self.edge_population,
-            pre,
-            post,
-            num_pairs=protocol_params.num_pairs,
-            constraints=self.pathway.get("constraints"),
+        checkpoint = self._load_checkpoint() if protocol_params.resume else None
+        if checkpoint is None:
+            self.pairs = get_pairs(
+                self.edge_population,
+                pre,
+                post,
+                num_pairs=protocol_params.num_pairs,
+                constraints=self.pathway.get("constraints"),
+                cache_dir=protocol_params.connectivity_cache_dir,
+                sample_edges=protocol_params.sample_edges,
+            )
+        else:
+            self.pairs = [
+                (CircuitNodeId(*pre_gid), CircuitNodeId(*post_gid))
+                for pre_gid, post_gid in checkpoint[0]["pairs"]
+            ]
+
+        self._init_analysis(get_synapse_type(self.edge_population.source, pre))
+        if checkpoint is not None:
+            self._restore_pairs(checkpoint[1])
+
+    @classmethod
+    def from_traces_dump(cls, pathway_config_path, protocol_params, traces_path):
+        """Create a pathway to analyze again the traces dumped by a previous run.
+
+        The pairs and the synapse type are read from the trace dump, no simulation can be run.
+
+        Args:
+            pathway_config_path (pathlib.Path): path to a pathway file
+            protocol_params (ProtocolParameters): the parameters to used
+            traces_path (pathlib.Path): path to the trace dump of the pathway
+        """
+        with h5py.File(traces_path, "r") as h5f:
+            if "pre_syn_type" not in h5f.attrs:
+                raise PSPError(
+                    f"{traces_path} lacks the synapse type: it was written by an older version"
+                )
+            pre_syn_type = h5f.attrs["pre_syn_type"]
+
+        return cls._from_config(pathway_config_path, protocol_params, pre_syn_type)
+
+    @classmethod
+    def from_shards(cls, pathway_config_path, protocol_params, input_dir):
+        """Create a pathway to merge the results of the shards of a sharded run (see `merge`).
+
+        The pairs, the synapse type and the parameters of the run (e.g. clamp) are read from the
+        checkpoints of the shards in `input_dir`, which must all be complete.
+
+        Args:
+            pathway_config_path (pathlib.Path): path to a pathway file
+            protocol_params (ProtocolParameters): the parameters to used (for the outputs)
+            input_dir (pathlib.Path): path to the output folder of the shards
+        """
+        shards = _load_shards(input_dir, pathway_config_path.stem)
+        header = shards[0][1]
+        # inverse of `_get_run_params`
+        run_params = dict(header["run"])
+        config = run_params.pop("config")
+        adaptive_trials = run_params.pop("adaptive_trials", None)
+        protocol_params = attr.evolve(
+            protocol_params,
+            clamp=run_params.pop("clamp"),
+            num_pairs=run_params.pop("num_pairs"),
+            num_trials=run_params.pop("num_trials"),
+            adaptive_trials=None if adaptive_trials is None else AdaptiveTrials(**adaptive_trials),
+            dump_traces=run_params.pop("dump_traces"),
+            shard=None,
+            run_params=run_params,
         )
 
-        self.pre_syn_type = get_synapse_type(self.edge_population.source, pre)
+        pathway = cls._from_config(pathway_config_path, protocol_params, header["pre_syn_type"])
+        if normalize(pathway.config) != config:
+            raise PSPError(f"{pathway_config_path} was modified since the shards were run")
+        pathway.pairs = [
+            (CircuitNodeId(*pre_gid), CircuitNodeId(*post_gid))
+            for pre_gid, post_gid in header["pairs"]
+        ]
+        # the records are restored in the order of the pairs, as processed by an unsharded run
+        pathway._restore_pairs(  # noqa: SLF001 private member access
+            sorted(
+                (record for _, _, records in shards for record in records),
+                key=operator.itemgetter("index"),
+            )
+        )
+        pathway.shards = shards
+        return pathway
+
+    @classmethod
+    def _from_config(cls, pathway_config_path, protocol_params, pre_syn_type):
+        """Create a pathway without pairs, that can not run simulations."""
+        pathway = cls.__new__(cls)
+        pathway.title = pathway_config_path.stem
+        pathway.config = load_config(pathway_config_path)
+        pathway.sim_runner = None
+        pathway.protocol_params = protocol_params
+        pathway.pathway = pathway.config["pathway"]
+        pathway.pairs = []
+        pathway._init_analysis(pre_syn_type)  # noqa: SLF001 private member access
+        return pathway
+
+    def _init_analysis(self, pre_syn_type):
+        """Initialize the parameters of the analysis of the simulation results."""
+        self.pre_syn_type = pre_syn_type
 
         self.min_ampl = self.config.get("min_amplitude", 0.0)
         self.min_trace_ampl = self.config.get("min_trace_amplitude", 0.0)  # NSETM-1166
@@ -200,26 +600,288 @@ class Pathway:
         self.t_start = self.t_stim - 10.0
         self.trace_filters = [
             NullFilter(),
-            SpikeFilter(t_start=self.t_start, v_max=-20),
+            SpikeFilter(
+                t_start=self.t_start,
+                v_max=self.config.get("spike_threshold", DEFAULT_SPIKE_THRESHOLD),
+            ),
             AmplitudeFilter(
                 t_stim=self.t_stim,
                 min_trace_amplitude=self.min_trace_ampl,
                 syn_type=self.pre_syn_type,
+                backend=self.protocol_params.amplitude_backend,
             ),
         ]
         self.resting_potentials = []
+        # number of traces rejected by each trace filter, by filter class name
+        self.rejected_traces = {}
+        self.completed = {}
+
+    def _get_checkpoint_path(self):
+        suffix = get_shard_suffix(self.protocol_params.shard)
+        return self.protocol_params.output_dir / f"{self.title}{suffix}.checkpoint.jsonl"
+
+    def _get_traces_path(self):
+        suffix = get_shard_suffix(self.protocol_params.shard)
+        return self.protocol_params.output_dir / f"{self.title}{suffix}.traces.h5"
+
+    def _get_run_params(self):
+        """Get the parameters of the run that the results of the pairs depend on."""
+        return normalize(
+            {
+                **self.protocol_params.run_params,
+                "clamp": self.protocol_params.clamp,
+                "num_pairs": self.protocol_params.num_pairs,
+                "num_trials": self.protocol_params.num_trials,
+                "adaptive_trials": (
+                    None
+                    if self.protocol_params.adaptive_trials is None
+                    else attr.asdict(self.protocol_params.adaptive_trials)
+                ),
+                "dump_traces": self.protocol_params.dump_traces,
+                "config": self.config,
+            }
+        )
+
+    def _load_checkpoint(self):
+        """Load the checkpoint of a previous run, to resume it.
+
+        Returns:
+            (header, records) of the checkpoint, or None if there is no checkpoint
+        """
+        path = self._get_checkpoint_path()
+        if not path.exists():
+            L.info("No checkpoint for '%s' pathway, starting from scratch", self.title)
+            return None
+
+        header, records = load_checkpoint(path)
+        if header["run"] != self._get_run_params() or header.get("shard") != normalize(
+            self.protocol_params.shard
+        ):
+            raise PSPError(
+                f"{path} was written by a run with other parameters: "
+                "run without --resume, or remove the checkpoint"
+            )
+        if self.protocol_params.dump_traces:
+            # the traces are written in the background: the last pairs recorded in the
+            # checkpoint may be missing from the dump if the process was killed
+            records = records[: count_pair_traces(self._get_traces_path())]
+
+        L.info(
+            "Resuming '%s' pathway: %d out of %d pairs completed",
+            self.title,
+            len(records),
+            len(header["pairs"]),
+        )
+        return header, records
+
+    def _restore_pairs(self, records):
+        """Restore the results of the pairs completed by a previous run."""
+        for record in records:
+            self.completed[record["index"]] = record
+            if record["resting_potential"] is not None:
+                self.resting_potentials.append(record["resting_potential"])
+            for name, count in record["rejected"].items():
+                self.rejected_traces[name] = self.rejected_traces.get(name, 0) + count
+
+    def _init_checkpoint(self):
+        """Create the checkpoint of the pathway, with the pairs already completed."""
+        header = {
+            "pathway": self.title,
+            "run": self._get_run_params(),
+            "shard": self.protocol_params.shard,
+            "pre_syn_type": self.pre_syn_type,
+            "pairs": [
+                [[pre_gid.population, pre_gid.id], [post_gid.population, post_gid.id]]
+                for pre_gid, post_gid in self.pairs
+            ],
+        }
+        # the records are kept in the order of the traces in the dump
+        return CheckpointWriter(self._get_checkpoint_path(), header, self.completed.values())
+
+    @property
+    def pair_cost(self):
+        """Estimate of the cost of simulating one pair: the total simulated time [ms]."""
+        return self.protocol_params.num_trials * self.config["protocol"]["t_stop"]
+
+    @property
+    def pending_pairs(self):
+        """Indices of the pairs to simulate, i.e. the ones not completed by a previous run.
+
+        With a shard (K, N) of the pairs, only the pairs K, K + N, K + 2N... are simulated.
+        """
+        start, step = self.protocol_params.shard or (0, 1)
+        return [
+            index for index in range(start, len(self.pairs), step) if index not in self.completed
+        ]
 
     def run(self):
         """Run the simulation for the given pathway."""
-        traces_path = self._init_traces_dump() if self.protocol_params.dump_traces else None
+        # submit all the pairs at once, so that the workers are never idle between pairs
+        futures = [None] * len(self.pairs)
+        for index in self.pending_pairs:
+            futures[index] = self.submit_pair(self.pairs[index])
+        self.process(futures)
 
-        if not self.pairs:
-            L.warning("No pairs to run.")
+    def process(self, futures):
+        """Process the simulation results of the pathway and write the outputs.
+
+        If the process is terminated (see `psp_validation.checkpoint.handle_sigterm`), the pairs
+        already simulated are processed before `Terminated` is raised again.
+
+        Args:
+            futures (list): futures of the `SimulationResult` of each pair (same order as pairs,
+                None for the pairs already completed)
+        """
+        # the traces are written in the background; on errors (or Ctrl-C), the traces of the
+        # pairs already processed are still written before the dump is closed
+        with (
+            self._init_traces_dump()
+            if self.protocol_params.dump_traces
+            else contextlib.nullcontext()
+        ) as trace_writer:
+            if not self.pairs:
+                L.warning("No pairs to run.")
+                return
+
+            with self._init_checkpoint() as checkpoint:
+                try:
+                    # the pairs are processed in order, while the simulations of the next ones
+                    # go on
+                    for index in self.pending_pairs:
+                        self._complete_pair(
+                            index, futures[index].result(), trace_writer, checkpoint
+                        )
+                except Terminated:
+                    self._complete_done_pairs(futures, trace_writer, checkpoint)
+                    raise
+
+        if self.protocol_params.shard is not None:
+            L.info(
+                "Shard %d/%d of '%s' pathway done: run `psp merge` once all the shards are done",
+                *self.protocol_params.shard,
+                self.title,
+            )
             return
 
+        self._write_completed_outputs()
+
+    def merge(self):
+        """Write the trace dump, checkpoint and outputs of the shards merged by `from_shards`.
+
+        The outputs are the same as the ones of an unsharded run.
+        """
+        if self.protocol_params.dump_traces:
+            with (
+                self._init_traces_dump(keep_pairs=0) as trace_writer,
+                contextlib.ExitStack() as stack,
+            ):
+                # the rows of the dump of a shard are in the order of the records of its
+                # checkpoint
+                rows = {}
+                for checkpoint_path, _, records in self.shards:
+                    traces_path = checkpoint_path.with_name(
+                        checkpoint_path.name.replace(".checkpoint.jsonl", ".traces.h5")
+                    )
+                    if count_pair_traces(traces_path) < len(records):
+                        raise PSPError(f"Missing traces in {traces_path}")
+                    h5f = stack.enter_context(h5py.File(traces_path, "r"))
+                    rows.update((record["index"], (h5f, row)) for row, record in enumerate(records))
+
+                for index in range(len(self.pairs)):
+                    pre_gid, post_gid, time, trials, average = read_pair_traces(*rows[index])
+                    trace_writer.write(
+                        time, trials, average, pre_gid, post_gid, self.completed[index]["params"]
+                    )
+
+        self._init_checkpoint().close()
+        self._write_completed_outputs()
+
+    def _write_completed_outputs(self):
+        """Write the outputs, once all the pairs are completed."""
+        records = [self.completed[index] for index in range(len(self.pairs))]
+        self._write_outputs(records[-1]["params"], [record["amplitude"] for record in records])
+
+    def flush(self, futures):
+        """Process the pairs already simulated, without waiting for the other ones.
+
+        The outputs are not written: this is used when the run is terminated, so that the sampled
+        pairs and the ones already simulated are recorded in the checkpoint (and the trace dump),
+        to be resumed.
+
+        Args:
+            futures (list): futures of the `SimulationResult` of each pair (same order as pairs,
+                None for the pairs already completed)
+        """
+        with (
+            self._init_traces_dump()
+            if self.protocol_params.dump_traces
+            else contextlib.nullcontext() as trace_writer,
+            self._init_checkpoint() as checkpoint,
+        ):
+            self._complete_done_pairs(futures, trace_writer, checkpoint)
+
+    def _complete_done_pairs(self, futures, trace_writer, checkpoint):
+        """Process the pending pairs whose simulation is done."""
+        done = [index for index in self.pending_pairs if _has_result(futures[index])]
+        L.warning("Recording %d simulated pairs of '%s' pathway", len(done), self.title)
+        for index in done:
+            self._complete_pair(index, futures[index].result(), trace_writer, checkpoint)
+
+    def _complete_pair(self, index, sim_results, trace_writer, checkpoint):
+        """Process the simulation results of a pair, and record the pair in the checkpoint."""
+        resting_count = len(self.resting_potentials)
+        rejected = dict(self.rejected_traces)
+        amplitudes = []
+        params = self._process_one_pair(self.pairs[index], sim_results, amplitudes, trace_writer)
+
+        record = {
+            "index": index,
+            "amplitude": amplitudes[0] if amplitudes else None,
+            "resting_potential": (
+                self.resting_potentials[resting_count]
+                if len(self.resting_potentials) > resting_count
+                else None
+            ),
+            "rejected": {
+                name: count - rejected.get(name, 0)
+                for name, count in self.rejected_traces.items()
+                if count > rejected.get(name, 0)
+            },
+            "n_trials": len(sim_results.voltages),
+            "params": params,
+        }
+        checkpoint.write(record)
+        self.completed[index] = record
+
+    def reanalyze(self, traces_path):
+        """Extract the amplitudes of the traces dumped by a previous run, and write the outputs.
+
+        Args:
+            traces_path (pathlib.Path): path to the trace dump of the pathway
+        """
         all_amplitudes = []
-        for pair in self.pairs:
-            params = self._run_one_pair(pair, all_amplitudes, traces_path)
+        with h5py.File(traces_path, "r") as h5f:
+            params = json.loads(h5f.attrs.get("params", "{}"))
+            for pre_gid, post_gid, time, trials, _ in iter_pair_traces(h5f):
+                self.pairs.append((pre_gid, post_gid))
+                self._post_run(
+                    pre_gid, post_gid, SimulationResult(params, time, None, trials), all_amplitudes
+                )
+
+        if not self.pairs:
+            L.warning("No pairs in %s", traces_path)
+            return
+
+        self._write_outputs(params, all_amplitudes)
+
+    def _write_outputs(self, params, all_amplitudes):
+        """Log the traces filtered out, and write the amplitudes and the summary of the pathway."""
+        if any(self.rejected_traces.values()):
+            L.info(
+                "Traces filtered out for pathway %s: %s",
+                self.title,
+                _format_rejected_traces(self.rejected_traces),
+            )
 
         if self.protocol_params.clamp != "current":
             return
@@ -241,36 +903,114 @@ class Pathway:
 
         return (edge_type, pre_type, post_type) == ("chemical", "virtual", "biophysical")
 
-    def _run_one_pair(self, pair, all_amplitudes, traces_path):
-        """Run the simulation for a given pair.
+    def submit_pair(self, pair):
+        """Submit the simulation of a given pair.
 
-        Also, extract the peak amplitude and write the trace to disk if protocol_params.dump_traces.
+        With `protocol_params.adaptive_trials`, the trials are run in batches until the PSP
+        amplitude of the pair converges (see `AdaptiveTrials`), and `protocol_params.num_trials`
+        is the maximum number of trials.
 
         Args:
-            pair (int): a pair of node ids
-            all_amplitudes: a list that will store all amplitudes
-            traces_path: the trace path
+            pair (tuple): a pair of node ids
+
+        Returns:
+            `concurrent.futures.Future` of the `SimulationResult`
         """
+        if self.protocol_params.adaptive_trials is None:
+            return self._submit_trials(pair)
+        return self._submit_adaptive_trials(pair)
+
+    def _submit_trials(self, pair, **kwargs):
+        """Submit the simulation of the trials of a pair, with `kwargs` passed to `sim_runner`."""
         pre_gid, post_gid = pair
-        sim_results = self.sim_runner(
+        return self.sim_runner(
             pre_gid=pre_gid,
             post_gid=post_gid,
             add_projections=self._has_projections(),
             **self.config["protocol"],
+            **kwargs,
         )
 
-        traces, average = self._post_run(pre_gid, post_gid, sim_results, all_amplitudes)
+    def _submit_adaptive_trials(self, pair, sim_results=None):
+        """Submit the next batch of trials of a pair, unless its PSP amplitude has converged.
 
-        if self.protocol_params.dump_traces:
-            with h5py.File(traces_path, "a") as h5f:
-                dump_pair_traces(h5f, traces, average, pre_gid, post_gid)
+        Args:
+            pair (tuple): a pair of node ids
+            sim_results (SimulationResult): the results of the trials already run (None if none)
+
+        Returns:
+            `concurrent.futures.Future` of the `SimulationResult` of all the trials of the pair,
+            or that `SimulationResult` if no more trials are needed
+        """
+        adaptive = self.protocol_params.adaptive_trials
+        max_trials = self.protocol_params.num_trials
+        n_trials = 0 if sim_results is None else len(sim_results.voltages)
+        if n_trials > 0:
+            ci_width = self._get_amplitude_ci_width(sim_results)
+            if ci_width <= adaptive.tolerance or n_trials >= max_trials:
+                L.debug(
+                    "%s-%s: %d trials, relative width of the amplitude CI: %.3g",
+                    *pair,
+                    n_trials,
+                    ci_width,
+                )
+                return sim_results
+
+        # the callback is run by the thread completing the batch, and submits the next one
+        return chain(
+            self._submit_trials(
+                pair,
+                first_trial=n_trials,
+                n_trials=min(adaptive.min_trials, max_trials - n_trials),
+            ),
+            lambda batch: self._submit_adaptive_trials(
+                pair, batch if sim_results is None else concatenate_results(sim_results, batch)
+            ),
+        )
+
+    def _get_amplitude_ci_width(self, sim_results):
+        """Get the relative width of the 95% CI of the PSP amplitude of the selected trials."""
+        t = np.asarray(sim_results.time)
+        voltages = np.asarray(sim_results.voltages, dtype=np.float64)
+        selected, _ = select_traces(t, voltages, self.trace_filters)
+        voltages = voltages[selected]
+        if len(voltages) == 0:
+            return np.inf
+
+        backend = self.protocol_params.amplitude_backend
+        amplitudes = get_peak_amplitudes(
+            t if backend == "numpy" else [t] * len(voltages),
+            voltages,
+            self.t_stim,
+            self.pre_syn_type,
+            backend=backend,
+        )
+        return relative_ci_width(amplitudes)
+
+    def _process_one_pair(self, pair, sim_results, all_amplitudes, trace_writer):
+        """Process the simulation results of a given pair.
+
+        Extract the peak amplitude and write the trace to disk if protocol_params.dump_traces.
+
+        Args:
+            pair (tuple): a pair of node ids
+            sim_results (SimulationResult): the simulation results of the pair
+            all_amplitudes: a list that will store all amplitudes
+            trace_writer (BackgroundTraceWriter): the writer of the trace dump (None if no dump)
+        """
+        pre_gid, post_gid = pair
+        time, traces, average = self._post_run(pre_gid, post_gid, sim_results, all_amplitudes)
+
+        if trace_writer is not None:
+            trace_writer.write(time, traces, average, pre_gid, post_gid, sim_results.params)
 
         return sim_results.params
 
     def _post_run(self, pre_gid, post_gid, sim_results, all_amplitudes):
-        """Returns a tuple (all traces, averaged trace).
+        """Returns a tuple (time, all traces, averaged trace).
 
-        Where trace is a voltage in current clamp mode, a current in voltage clamp mode
+        Where trace is a voltage in current clamp mode, a current in voltage clamp mode; all the
+        traces share the same time, and are returned as a N x T array.
 
         Also:
             - fill the all_amplitudes list
@@ -279,20 +1019,26 @@ class Pathway:
         In case of voltage traces, they are filtered to calculate the average,
         but the returned traces are not filtered.
         """
+        t = np.asarray(sim_results.time)
         if self.protocol_params.clamp == "current":
-            traces = old_school_trace(sim_results)
-            v_mean, t, v_used = mean_pair_voltage_from_traces(traces, self.trace_filters)
+            voltages = np.asarray(sim_results.voltages, dtype=np.float64)
+            traces = voltages
+            selected, rejected = select_traces(t, voltages, self.trace_filters)
+            for name, count in rejected.items():
+                self.rejected_traces[name] = self.rejected_traces.get(name, 0) + count
 
-            filtered_count = len(sim_results.voltages) - len(v_used)
+            filtered_count = len(voltages) - np.count_nonzero(selected)
             if filtered_count > 0:
                 L.warning(
                     "%d out of %d traces filtered out for %s-%s"
-                    " simulation(s) due to spiking or synaptic failure",
+                    " simulation(s) due to spiking or synaptic failure (%s)",
                     filtered_count,
-                    len(sim_results.voltages),
+                    len(voltages),
                     pre_gid,
                     post_gid,
+                    _format_rejected_traces(rejected),
                 )
+            v_mean = np.mean(voltages[selected], axis=0) if np.any(selected) else None
             if v_mean is None:
                 L.warning(
                     "Could not extract PSP amplitude for %s-%s pair due to spiking",
@@ -302,8 +1048,14 @@ class Pathway:
                 average = None
                 ampl = np.nan
             else:
-                average = np.stack([v_mean, t])
-                ampl = get_peak_amplitudes([t], [v_mean], self.t_stim, self.pre_syn_type)[0]
+                average = v_mean
+                ampl = get_peak_amplitudes(
+                    [t],
+                    [v_mean],
+                    self.t_stim,
+                    self.pre_syn_type,
+                    backend=self.protocol_params.amplitude_backend,
+                )[0]
                 if ampl < self.min_ampl:
                     L.warning(
                         "PSP amplitude below given threshold for %s-%s pair (%.3g < %.3g)",
@@ -323,42 +1075,64 @@ class Pathway:
 
             all_amplitudes.append(ampl)
         else:
-            average = np.stack([np.mean(sim_results.currents, axis=0), sim_results.time])
-            traces = sim_results.currents
-
-        return traces, average
-
-    def _init_traces_dump(self):
-        """Create empty H5 dump or overwrite existing one."""
-        traces_path = self.protocol_params.output_dir / f"{self.title}.traces.h5"
-        with h5py.File(traces_path, "w") as h5f:
-            h5f.attrs["version"] = "1.1"
-            # we store voltage traces for current clamp and vice-versa
-            h5f.attrs["data"] = {
-                "current": "voltage",
-                "voltage": "current",
-            }[self.protocol_params.clamp]
-        return traces_path
+            traces = np.asarray(sim_results.currents, dtype=np.float64)
+            average = np.mean(traces, axis=0)
+
+        return t, traces, average
+
+    def _init_traces_dump(self, keep_pairs=None):
+        """Create empty H5 dump or overwrite existing one, and return its background writer.
+
+        The traces of the pairs already completed are kept in the existing dump, unless
+        `keep_pairs` is given.
+        """
+        # we store voltage traces for current clamp and vice-versa
+        data = {
+            "current": "voltage",
+            "voltage": "current",
+        }[self.protocol_params.clamp]
+        return BackgroundTraceWriter(
+            TraceWriter(
+                self._get_traces_path(),
+                data,
+                n_trials=self.protocol_params.num_trials,
+                attrs={"pre_syn_type": self.pre_syn_type},
+                keep_pairs=len(self.completed) if keep_pairs is None else keep_pairs,
+            )
+        )
 
     def _write_summary(self, params, all_amplitudes):
-        model_mean = np.nanmean(all_amplitudes)
-        model_std = np.nanstd(all_amplitudes)
+        amplitudes = np.asarray(all_amplitudes, dtype=np.float64)
+        amplitudes = amplitudes[~np.isnan(amplitudes)]
+        if len(amplitudes) == 0:
+            L.warning(
+                "'%s' pathway: no PSP amplitude, all the traces were filtered out", self.title
+            )
+            model_mean = model_std = np.nan
+        else:
+            model_mean = np.mean(amplitudes)
+            model_std = np.std(amplitudes)
 
         reference, scaling = self._get_reference_and_scaling(model_mean, params)
 
         summary_path = self.protocol_params.output_dir / f"{self.title}.summary.yaml"
-        summary = (
-            f"pathway: {self.title}\n"
-            "model:\n"
-            f"    mean: {model_mean}\n"
-            f"    std: {model_std}\n"
-        )
+        summary = f"pathway: {self.title}\nmodel:\n    mean: {model_mean}\n    std: {model_std}\n"
         if reference is not None:
             summary += f"reference:\n    mean: {reference['mean']}\n    std: {reference['std']}\n"
 
         if scaling is not None:
             summary += f"scaling: {scaling}\n"
 
+        if self.protocol_params.adaptive_trials is not None and self.completed:
+            n_trials = [record["n_trials"] for record in self.completed.values()]
+            L.info(
+                "'%s' pathway: %d trials simulated, %.1f per pair on average",
+                self.title,
+                sum(n_trials),
+                np.mean(n_trials),
+            )
+            summary += f"trials:\n    mean: {np.mean(n_trials)}\n    max: {max(n_trials)}\n"
+
         summary_path.write_text(summary)
 
     def _get_reference_and_scaling(self, model_mean, params):
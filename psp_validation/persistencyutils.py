@@ -1,6 +1,28 @@
 """Bundle of tools to help with persistifying data."""
 
+import json
+import logging
+import queue
+import threading
+
+import h5py
 import numpy as np
+from bluepysnap.circuit_ids import CircuitNodeId
+
+from psp_validation import PSPError
+
+L = logging.getLogger(__name__)
+
+TRACES_DUMP_VERSION = "2.0"
+
+# number of pairs written to a trace dump between two flushes
+TRACES_FLUSH_EVERY = 10
+
+# number of pairs waiting to be written by a background trace writer before `write` blocks
+TRACES_MAX_PENDING = 8
+
+# sentinel telling the background writer thread to stop
+_STOP = object()
 
 
 def dump_raw_traces_to_HDF5(h5file, data):  # noqa: N802 (function-lowercase)
@@ -38,33 +60,408 @@ def dump_raw_traces_to_HDF5(h5file, data):  # noqa: N802 (function-lowercase)
         h5file[group_name].attrs["gid_post"] = post_gid
 
 
-def dump_pair_traces(h5file, traces, average, pre_gid, post_gid):
-    """Dump a set of simulated psp traces to an HDF5 file.
+class TraceWriter:
+    """Write the traces of all the pairs of a pathway to an HDF5 file.
 
-    Args:
-        h5file: writable h5py.File
-        traces: N x 2 x T numpy array with trials voltage (or current) traces (V_k (or I_k), t_k)
-        average: 2 x T numpy array with averaged / filtered trace (V_mean, t)
-        pre_gid: presynaptic GID
-        post_gid: postsynaptic GID
-        data: array containing all the trace raw data
+    The file is kept open until the writer is closed, and the traces of all the pairs are
+    appended to pathway-level datasets, flushed to disk every `flush_every` pairs.
 
     The data format is:
 
     /traces
-       /<pair-id>
-           /trials   [N x 2 x T]
-           /average  [2 x T]
+       /time      [T]
+       /trials    [P x N x T]
+       /average   [P x T]
+       /pairs
+           /pre_population   [P]
+           /pre_id           [P]
+           /post_population  [P]
+           /post_id          [P]
+       /index
+           /<pair>           row of the pair
 
-    Each pair group has attributes 'pre_gid' and 'post_gid'.
+    where P is the number of pairs, N the number of trials and T the number of time points.
+    The `index` group maps the name of each pair (see `_get_pair_name`) to its row, so that the
+    traces of a pair are looked up without reading the `pairs` datasets.
+    The trials are chunked by pair and compressed, so that the traces of a pair are read at once.
+    The average of a pair is filled with NaN when it could not be computed, and the trials of
+    the pairs with fewer than N trials (e.g. with adaptive trials) are padded with NaN traces,
+    that are dropped when the traces are read.
+
+    The synapse parameters of the simulations (e.g. reversal potentials) are stored as JSON in the
+    'params' attribute of the file, with the ones of the last pair written.
     """
-    group = h5file.create_group(
-        f"/traces/{pre_gid.population}_{pre_gid.id}-{post_gid.population}_{post_gid.id}",
+
+    def __init__(
+        self,
+        path,
+        data,
+        flush_every=TRACES_FLUSH_EVERY,
+        attrs=None,
+        keep_pairs=None,
+        n_trials=None,
+    ):
+        """Create the HDF5 file, or overwrite the existing one.
+
+        Args:
+            path (pathlib.Path): path to the HDF5 file
+            data (str): traces content ("voltage" or "current")
+            flush_every (int): number of pairs written between two flushes
+            attrs (dict): other attributes of the file
+            keep_pairs (int): if not 0 / None, keep the traces of the first `keep_pairs` pairs of
+                the existing file and append the next ones, instead of overwriting it
+                (e.g. when resuming an interrupted run)
+            n_trials (int): maximum number of trials of a pair (default: the number of trials of
+                the first pair written)
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.n_trials = n_trials
+        self._count = 0
+        if keep_pairs:
+            if (count := count_pair_traces(path)) < keep_pairs:
+                raise PSPError(f"{path} contains the traces of {count} < {keep_pairs} pairs")
+            self._h5f = h5py.File(path, "a")
+            if self._h5f.attrs["data"] != data:
+                self._h5f.close()
+                raise PSPError(f"{path} does not contain {data} traces")
+            self._truncate(keep_pairs)
+        else:
+            self._h5f = h5py.File(path, "w")
+            self._h5f.attrs["version"] = TRACES_DUMP_VERSION
+            self._h5f.attrs["data"] = data
+        self._h5f.attrs.update(attrs or {})
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the file when exiting the context."""
+        self.close()
+
+    def _create_datasets(self, time, traces):
+        """Create the datasets, once the shape of the traces is known."""
+        n_trials, n_points = traces.shape
+        n_trials = max(n_trials, self.n_trials or 0)
+        group = self._h5f.create_group("traces")
+        group["time"] = time
+        group.create_dataset(
+            "trials",
+            shape=(0, n_trials, n_points),
+            maxshape=(None, n_trials, n_points),
+            chunks=(1, n_trials, n_points),
+            dtype=traces.dtype,
+            compression="gzip",
+        )
+        group.create_dataset(
+            "average",
+            shape=(0, n_points),
+            maxshape=(None, n_points),
+            chunks=(1, n_points),
+            dtype=traces.dtype,
+            compression="gzip",
+        )
+        pairs = group.create_group("pairs")
+        for name, dtype in [
+            ("pre_population", h5py.string_dtype()),
+            ("pre_id", np.int64),
+            ("post_population", h5py.string_dtype()),
+            ("post_id", np.int64),
+        ]:
+            pairs.create_dataset(name, shape=(0,), maxshape=(None,), chunks=True, dtype=dtype)
+        group.create_group("index")
+
+    def _truncate(self, n_pairs):
+        """Drop the traces of the pairs beyond the first `n_pairs`."""
+        group = self._h5f["traces"]
+        index = group["index"]
+        for pre_gid, post_gid in _iter_pairs(group["pairs"], start=n_pairs):
+            name = _get_pair_name(pre_gid, post_gid)
+            if name in index and index[name][()] >= n_pairs:
+                del index[name]
+        for name in ["trials", "average", *(f"pairs/{name}" for name in group["pairs"])]:
+            group[name].resize(n_pairs, axis=0)
+        self._count = n_pairs
+
+    def write(self, time, traces, average, pre_gid, post_gid, params=None):
+        """Append the traces of a pair.
+
+        Args:
+            time: T numpy array with the time of all the traces
+            traces: N x T numpy array with trials voltage (or current) traces
+            average: T numpy array with averaged / filtered trace (or None)
+            pre_gid: presynaptic GID
+            post_gid: postsynaptic GID
+            params: synapse parameters of the simulations of the pair (dict)
+        """
+        traces = np.asarray(traces)
+        if "traces" not in self._h5f:
+            self._create_datasets(time, traces)
+        group = self._h5f["traces"]
+        n_trials, n_points = group["trials"].shape[1:]
+        if len(traces) > n_trials or traces.shape[1:] != (n_points,):
+            raise PSPError(
+                f"Traces of shape {traces.shape} can not be appended to traces of shape "
+                f"{group['trials'].shape[1:]}"
+            )
+        if len(traces) < n_trials:
+            traces = np.concatenate([traces, np.full((n_trials - len(traces), n_points), np.nan)])
+
+        row = self._count
+        values = {
+            "trials": traces,
+            "average": np.full(traces.shape[1], np.nan) if average is None else average,
+            "pairs/pre_population": pre_gid.population,
+            "pairs/pre_id": pre_gid.id,
+            "pairs/post_population": post_gid.population,
+            "pairs/post_id": post_gid.id,
+        }
+        for name, value in values.items():
+            group[name].resize(row + 1, axis=0)
+            group[name][row] = value
+        # a pair written several times is looked up at its first row
+        name = _get_pair_name(pre_gid, post_gid)
+        if name not in group["index"]:
+            group["index"][name] = row
+
+        if params is not None:
+            self._h5f.attrs["params"] = json.dumps(params)
+
+        self._count += 1
+        if self._count % self.flush_every == 0:
+            self._h5f.flush()
+
+    def close(self):
+        """Flush and close the file."""
+        self._h5f.close()
+
+
+class BackgroundTraceWriter:
+    """Write the traces of the pairs with a `TraceWriter`, in a background thread.
+
+    The traces are queued and written while the next pairs are processed. At most
+    `max_pending` pairs are queued: `write` blocks when the queue is full, so that the traces
+    waiting to be written do not fill the memory.
+
+    Closing the writer (also on errors or KeyboardInterrupt, when used as a context manager)
+    writes the pending traces, then closes the file. An error raised in the background thread
+    is raised again by the next call to `write` or `close`.
+    """
+
+    def __init__(self, writer, max_pending=TRACES_MAX_PENDING):
+        """The BackgroundTraceWriter constructor.
+
+        Args:
+            writer (TraceWriter): the writer used in the background thread
+            max_pending (int): maximum number of pairs waiting to be written
+        """
+        self.path = writer.path
+        self._writer = writer
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *_):
+        """Write the pending traces and close the file when exiting the context."""
+        self.close()
+
+    def _run(self):
+        while (args := self._queue.get()) is not _STOP:
+            # after an error, the remaining traces are dropped, to never block `write`
+            if self._error is None:
+                try:
+                    self._writer.write(*args)
+                except Exception as e:  # noqa: BLE001 (raised again in the main thread)
+                    L.exception("Could not write the traces to %s", self.path)
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise PSPError(f"Could not write the traces to {self.path}") from self._error
+
+    def write(self, time, traces, average, pre_gid, post_gid, params=None):
+        """Queue the traces of a pair, to be written in the background (same args as TraceWriter).
+
+        The arrays must not be modified once queued.
+        """
+        self._raise_error()
+        self._queue.put((time, traces, average, pre_gid, post_gid, params))
+
+    def close(self):
+        """Write the pending traces, then flush and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._writer.close()
+        self._raise_error()
+
+
+def _get_pair_name(pre_gid, post_gid):
+    """Get the name of a pair in the trace dumps."""
+    return f"{pre_gid.population}_{pre_gid.id}-{post_gid.population}_{post_gid.id}"
+
+
+def _get_pair_group_name(pre_gid, post_gid):
+    """Get the name of the group of a pair in the dumps of version 1.1 and 1.2."""
+    return f"/traces/{_get_pair_name(pre_gid, post_gid)}"
+
+
+def _iter_pairs(pairs, start=0):
+    """Iterate over the pairs of the `pairs` group of a trace dump, from row `start`.
+
+    Yields:
+        (pre_gid, post_gid): the pre- and post-synaptic `CircuitNodeId` of each pair
+    """
+    for pre_population, pre_id, post_population, post_id in zip(
+        pairs["pre_population"].asstr()[start:],
+        pairs["pre_id"][start:],
+        pairs["post_population"].asstr()[start:],
+        pairs["post_id"][start:],
+        strict=True,
+    ):
+        yield (
+            CircuitNodeId(pre_population, int(pre_id)),
+            CircuitNodeId(post_population, int(post_id)),
+        )
+
+
+def _load_pair_group(group):
+    """Load the traces of a pair from its group, in the dumps of version 1.1 and 1.2."""
+    if group.file.attrs.get("version", "1.1") == "1.1":
+        # the time is stored with each trace: N x 2 x T trials and 2 x T average
+        trials = group["trials"][:]
+        average = group["average"][0] if "average" in group else None
+        return trials[0, 1], trials[:, 0], average
+
+    average = group["average"][:] if "average" in group else None
+    return group["time"][:], group["trials"][:], average
+
+
+def _strip_padding(trials):
+    """Drop the NaN traces padding the trials of a pair with fewer trials than the others."""
+    n_trials = len(trials)
+    while n_trials > 0 and np.all(np.isnan(trials[n_trials - 1])):
+        n_trials -= 1
+    return trials[:n_trials]
+
+
+def _check_version(h5file):
+    """Check the version of a trace dump, and return it."""
+    version = h5file.attrs.get("version", "1.1")
+    if version not in {"1.1", "1.2", TRACES_DUMP_VERSION}:
+        raise PSPError(f"Unsupported trace dump version: {version}")
+    return version
+
+
+def count_pair_traces(path):
+    """Count the pairs in a trace dump written by `TraceWriter` (0 if there is no such file)."""
+    if not path.exists():
+        return 0
+    try:
+        with h5py.File(path, "r") as h5f:
+            if _check_version(h5f) != TRACES_DUMP_VERSION:
+                raise PSPError(f"{path} was written by an older version")
+            return len(h5f["traces/pairs/pre_id"]) if "traces" in h5f else 0
+    except OSError as e:
+        raise PSPError(f"Could not read the trace dump {path}") from e
+
+
+def iter_pair_traces(h5file):
+    """Iterate over the simulated psp traces of all the pairs of an HDF5 trace dump.
+
+    Dumps of the previous versions, with a group for each pair, are supported as well.
+
+    Args:
+        h5file: h5py.File of the trace dump
+
+    Yields:
+        (pre_gid, post_gid, time, trials, average): the pre- and post-synaptic `CircuitNodeId`,
+            T array of time, N x T array of trials, and T array of the average (or None)
+    """
+    if _check_version(h5file) != TRACES_DUMP_VERSION:
+        for group in h5file.get("traces", {}).values():
+            yield (
+                CircuitNodeId(group.attrs["pre_population"], int(group.attrs["pre_id"])),
+                CircuitNodeId(group.attrs["post_population"], int(group.attrs["post_id"])),
+                *_load_pair_group(group),
+            )
+        return
+
+    if "traces" not in h5file:
+        return
+    group = h5file["traces"]
+    time = group["time"][:]
+    for row, (pre_gid, post_gid) in enumerate(_iter_pairs(group["pairs"])):
+        average = group["average"][row]
+        yield (
+            pre_gid,
+            post_gid,
+            time,
+            _strip_padding(group["trials"][row]),
+            None if np.all(np.isnan(average)) else average,
+        )
+
+
+def read_pair_traces(h5file, row):
+    """Read the traces of the pair at `row` of an HDF5 trace dump written by `TraceWriter`.
+
+    Args:
+        h5file: h5py.File of the trace dump
+        row (int): index of the pair in the dump, in the order the pairs were written
+
+    Returns:
+        (pre_gid, post_gid, time, trials, average): same as `iter_pair_traces`
+    """
+    group = h5file["traces"]
+    pairs = group["pairs"]
+    average = group["average"][row]
+    return (
+        CircuitNodeId(pairs["pre_population"].asstr()[row], int(pairs["pre_id"][row])),
+        CircuitNodeId(pairs["post_population"].asstr()[row], int(pairs["post_id"][row])),
+        group["time"][:],
+        _strip_padding(group["trials"][row]),
+        None if np.all(np.isnan(average)) else average,
+    )
+
+
+def load_pair_traces(h5file, pre_gid, post_gid):
+    """Load the simulated psp traces of a pair from an HDF5 trace dump.
+
+    Dumps of the previous versions, with a group for each pair, are supported as well.
+
+    Args:
+        h5file: h5py.File of the trace dump
+        pre_gid: presynaptic GID
+        post_gid: postsynaptic GID
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): (T array of time, N x T array of trials,
+            T array of the average or None if there is no average)
+    """
+    if _check_version(h5file) != TRACES_DUMP_VERSION:
+        name = _get_pair_group_name(pre_gid, post_gid)
+        if name not in h5file:
+            raise PSPError(f"No traces for pair {pre_gid}-{post_gid}")
+        return _load_pair_group(h5file[name])
+
+    name = _get_pair_name(pre_gid, post_gid)
+    if "traces" not in h5file or name not in h5file["traces/index"]:
+        raise PSPError(f"No traces for pair {pre_gid}-{post_gid}")
+
+    group = h5file["traces"]
+    row = group["index"][name][()]
+    average = group["average"][row]
+    return (
+        group["time"][:],
+        _strip_padding(group["trials"][row]),
+        None if np.all(np.isnan(average)) else average,
     )
-    group.attrs["pre_id"] = pre_gid.id
-    group.attrs["pre_population"] = pre_gid.population
-    group.attrs["post_id"] = post_gid.id
-    group.attrs["post_population"] = post_gid.population
-    group["trials"] = traces
-    if average is not None:
-        group["average"] = average
@@ -4,6 +4,8 @@ import h5py
 import matplotlib as mpl
 from tqdm import tqdm
 
+from psp_validation.persistencyutils import iter_pair_traces
+
 mpl.use("Agg")
 import matplotlib.pyplot as plt
 
@@ -30,20 +32,17 @@ def voltage_traces(traces_files, output_dir):
                 "current": "I [nA]",
                 "voltage": "V [mV]",
             }[content]
-            for pair in tqdm(root.values(), total=len(root), desc=pathway):
-                title = (
-                    f"{pair.attrs['pre_population']}-{pair.attrs['pre_id']}"
-                    f"-{pair.attrs['post_population']}-{pair.attrs['post_id']}"
-                )
+            for pre_gid, post_gid, time, trials, average in tqdm(
+                iter_pair_traces(h5f), desc=pathway
+            ):
+                title = f"{pre_gid.population}-{pre_gid.id}-{post_gid.population}-{post_gid.id}"
                 figure = plt.figure()
                 ax = figure.gca()
-                for k, trial in enumerate(pair["trials"]):
+                for k, v_k in enumerate(trials):
                     label = "trials" if (k == 0) else None  # show 'trials' only once in the legend
-                    v_k, t_k = trial
-                    ax.plot(t_k, v_k, color="gray", lw=1, ls=":", alpha=0.7, label=label)
-                if "average" in pair:
-                    v_avg, t_avg = pair["average"]
-                    ax.plot(t_avg, v_avg, lw=2, label="average")
+                    ax.plot(time, v_k, color="gray", lw=1, ls=":", alpha=0.7, label=label)
+                if average is not None:
+                    ax.plot(time, average, lw=2, label="average")
                 ax.grid()
                 ax.set_xlabel("t [ms]")
                 ax.set_ylabel(y_label)
@@ -8,17 +8,27 @@ No current injection other than the current to achieve the holding potential
 are included. (no HypAmp for instance)
 """
 
+import contextlib
 import logging
 import pathlib
 from functools import partial
 
 import attr
+import h5py
 import numpy as np
 from bluepysnap import Circuit, Simulation
 
-from psp_validation import PSPError
-from psp_validation.pathways import Pathway
-from psp_validation.simulation import run_pair_simulation_suite
+from psp_validation import PSPError, setup_logging
+from psp_validation.cache import (
+    DEFAULT_CACHE_DIRNAME,
+    DEFAULT_SIMULATION_CACHE_MAX_SIZE,
+    HoldingCurrentCache,
+    SimulationCache,
+)
+from psp_validation.checkpoint import Terminated, handle_sigterm
+from psp_validation.executors import DEFAULT_MAX_RSS, get_n_workers, worker_pool
+from psp_validation.pathways import DEFAULT_MIN_TRIALS, AdaptiveTrials, Pathway
+from psp_validation.simulation import init_worker, submit_pair_simulation_suite
 from psp_validation.utils import load_yaml
 
 L = logging.getLogger(__name__)
@@ -36,6 +46,16 @@ class ProtocolParameters:
     dump_amplitudes = attr.ib(type=bool)
     dump_traces = attr.ib(type=bool)
     output_dir = attr.ib(type=pathlib.Path)
+    connectivity_cache_dir = attr.ib(type=pathlib.Path, default=None)
+    sample_edges = attr.ib(type=bool, default=False)
+    amplitude_backend = attr.ib(type=str, default="efel")
+    # if not None, `num_trials` is the maximum number of trials of a pair
+    adaptive_trials = attr.ib(type=AdaptiveTrials, default=None)
+    resume = attr.ib(type=bool, default=False)
+    # (K, N) to simulate only the shard K of the N shards of the pairs of each pathway
+    shard = attr.ib(type=tuple, default=None)
+    # parameters of the run stored in the checkpoints, that must match when resuming
+    run_params = attr.ib(type=dict, factory=dict)
 
 
 def run(  # noqa: PLR0913,PLR0917 too many args / positional args
@@ -51,13 +71,49 @@ def run(  # noqa: PLR0913,PLR0917 too many args / positional args
     dump_amplitudes=False,
     seed=None,
     jobs=None,
+    settle_margin=None,
+    max_worker_rss=DEFAULT_MAX_RSS,
+    cache_dir=None,
+    cache_connectivity=False,
+    sample_edges=False,
+    amplitude_backend="efel",
+    cache_simulations=False,
+    cache_max_size=DEFAULT_SIMULATION_CACHE_MAX_SIZE,
+    resume=False,
+    shard=None,
+    backend="local",
+    adaptive_tolerance=None,
+    min_trials=DEFAULT_MIN_TRIALS,
+    cache_holding_currents=True,
 ):
-    """Obtain PSP amplitudes; derive scaling factors"""
+    """Obtain PSP amplitudes; derive scaling factors.
+
+    The completed pairs of each pathway are recorded in a checkpoint in `output_dir`; with
+    `resume`, the pairs completed by a previous run with the same parameters are not simulated
+    again. On SIGTERM, the pairs already simulated are recorded before exiting.
+
+    With `shard` = (K, N), all the pairs are sampled but only the shard K of the N shards of the
+    pairs is simulated; the results of the shards are combined with `merge`.
+
+    With the "mpi" `backend`, this must be called by all the MPI ranks: the rank 0 samples the
+    pairs and writes the outputs, while the other ranks run the simulations.
+
+    With `adaptive_tolerance`, the trials of each pair are run in batches of `min_trials` until
+    its PSP amplitude converges (see `psp_validation.pathways.AdaptiveTrials`), and `num_trials`
+    is the maximum number of trials of a pair.
+
+    Unless `cache_holding_currents` is False, the holding currents are cached in `cache_dir`.
+    """
     if clamp == "voltage" and dump_amplitudes:
         raise PSPError("Voltage clamp mode; Can't pass --dump-amplitudes flag")
+    if clamp == "voltage" and adaptive_tolerance is not None:
+        raise PSPError("Voltage clamp mode; Can't run adaptive trials without PSP amplitudes")
 
     np.random.seed(seed)
 
+    if cache_dir is None:
+        cache_dir = pathlib.Path(output_dir, DEFAULT_CACHE_DIRNAME)
+
     protocol_params = ProtocolParameters(
         clamp,
         Simulation(sonata_simulation_config).circuit,
@@ -67,17 +123,201 @@ def run(  # noqa: PLR0913,PLR0917 too many args / positional args
         dump_amplitudes,
         dump_traces,
         output_dir,
+        connectivity_cache_dir=cache_dir if cache_connectivity else None,
+        sample_edges=sample_edges,
+        amplitude_backend=amplitude_backend,
+        adaptive_trials=(
+            None
+            if adaptive_tolerance is None
+            else AdaptiveTrials(tolerance=adaptive_tolerance, min_trials=min_trials)
+        ),
+        resume=resume,
+        shard=shard,
+        run_params={
+            "simulation_config": str(sonata_simulation_config),
+            "edge_population": edge_population,
+            "seed": seed,
+        },
     )
 
-    for pathway_config_path in pathway_files:
+    holding_current_cache = (
+        HoldingCurrentCache(cache_dir, sonata_simulation_config) if cache_holding_currents else None
+    )
+    simulation_cache = (
+        SimulationCache(
+            cache_dir, sonata_simulation_config, max_size=cache_max_size, background=True
+        )
+        if cache_simulations
+        else None
+    )
+
+    # simulations of all pathways are run by the same warm workers; the simulation results are
+    # written to the cache in the background, until the workers are done
+    with (
+        handle_sigterm(),
+        simulation_cache or contextlib.nullcontext(),
+        worker_pool(
+            backend,
+            get_n_workers(jobs),
+            max_rss=max_worker_rss,
+            initializer=init_worker,
+            initargs=(sonata_simulation_config, L.getEffectiveLevel()),
+        ) as pool,
+    ):
+        if pool is None:
+            # MPI worker rank, done running the simulations
+            return
+
         sim_runner = partial(
-            run_pair_simulation_suite,
+            submit_pair_simulation_suite,
+            pool=pool,
             sonata_simulation_config=sonata_simulation_config,
             base_seed=seed,
             n_trials=num_trials,
-            n_jobs=jobs,
             clamp=clamp,
+            settle_margin=settle_margin,
+            holding_current_cache=holding_current_cache,
+            simulation_cache=simulation_cache,
             log_level=L.getEffectiveLevel(),
         )
 
-        Pathway(pathway_config_path, sim_runner, protocol_params, edge_population).run()
+        # planning: sample the pairs of all the pathways first
+        pathways = [
+            Pathway(pathway_config_path, sim_runner, protocol_params, edge_population)
+            for pathway_config_path in pathway_files
+        ]
+        run_pathways(pathways)
+
+    if holding_current_cache is not None:
+        holding_current_cache.log_stats()
+    if simulation_cache is not None:
+        simulation_cache.log_stats()
+
+
+def _reanalyze_pathway(
+    pathway_config_path, traces_path, output_dir, dump_amplitudes, amplitude_backend, log_level
+):
+    """Extract the PSP amplitudes of a pathway from its trace dump, and write the outputs."""
+    setup_logging(log_level)
+    with h5py.File(traces_path, "r") as h5f:
+        clamp = {"voltage": "current", "current": "voltage"}[h5f.attrs.get("data", "voltage")]
+    if clamp != "current":
+        L.warning("Skipping %s: PSP amplitudes are extracted in current clamp only", traces_path)
+        return
+
+    protocol_params = ProtocolParameters(
+        clamp,
+        circuit=None,
+        targets=None,
+        num_pairs=None,
+        num_trials=None,
+        dump_amplitudes=dump_amplitudes,
+        dump_traces=False,
+        output_dir=output_dir,
+        amplitude_backend=amplitude_backend,
+    )
+    L.info("Reanalyzing '%s' pathway from %s...", pathway_config_path.stem, traces_path)
+    pathway = Pathway.from_traces_dump(pathway_config_path, protocol_params, traces_path)
+    pathway.reanalyze(traces_path)
+
+
+def reanalyze(
+    pathway_files,
+    traces_dir,
+    output_dir,
+    dump_amplitudes=False,
+    jobs=None,
+    amplitude_backend="efel",
+    backend="loky",
+):
+    """Obtain PSP amplitudes from the traces dumped by `psp run`; derive scaling factors.
+
+    The traces of the pathway X are read from `traces_dir`/X.traces.h5, and are filtered and
+    analyzed with the current pathway config, without simulating again. The pathways are
+    processed in parallel, by the `jobs` workers of `backend`.
+    """
+    traces_paths = [pathlib.Path(traces_dir, f"{path.stem}.traces.h5") for path in pathway_files]
+    if missing := [str(path) for path in traces_paths if not path.exists()]:
+        raise PSPError(f"Missing trace dumps (run `psp run --dump-traces`): {', '.join(missing)}")
+
+    with worker_pool(backend, get_n_workers(jobs)) as pool:
+        for index, _ in pool.map_as_completed(
+            partial(
+                _reanalyze_pathway,
+                output_dir=output_dir,
+                dump_amplitudes=dump_amplitudes,
+                amplitude_backend=amplitude_backend,
+                log_level=L.getEffectiveLevel(),
+            ),
+            pathway_files,
+            traces_paths,
+        ):
+            L.info("Done reanalyzing '%s' pathway", pathway_files[index].stem)
+
+
+def merge(pathway_files, input_dir, output_dir, dump_amplitudes=False):
+    """Combine the results of the shards of `psp run --shard`.
+
+    For each pathway X, the checkpoints and trace dumps of the shards are read from `input_dir`,
+    and the trace dump, checkpoint, amplitudes and summary are written to `output_dir`, the same
+    as the ones of an unsharded run.
+    """
+    protocol_params = ProtocolParameters(
+        clamp=None,
+        circuit=None,
+        targets=None,
+        num_pairs=None,
+        num_trials=None,
+        dump_amplitudes=dump_amplitudes,
+        dump_traces=False,
+        output_dir=output_dir,
+    )
+    for pathway_config_path in pathway_files:
+        L.info("Merging the shards of '%s' pathway...", pathway_config_path.stem)
+        Pathway.from_shards(pathway_config_path, protocol_params, input_dir).merge()
+
+
+def run_pathways(pathways):
+    """Run the simulations of all the pathways at once, and process each one when it is done.
+
+    The pairs are submitted longest job first, so that the shortest ones keep the workers busy
+    at the end of the run. The pathways are then processed in the order of their first submitted
+    pair: each pathway processes its pairs one by one as their simulations are done (recording
+    them in its checkpoint), while the simulations of the next pairs go on.
+    The pairs completed by a previous run (see `Pathway.pending_pairs`) are not submitted.
+
+    If the process is terminated, the pairs already simulated are recorded in the checkpoints of
+    all the pathways before `psp_validation.checkpoint.Terminated` is raised again.
+
+    Args:
+        pathways (list): `psp_validation.pathways.Pathway` instances
+    """
+    pathway_futures = [[None] * len(pathway.pairs) for pathway in pathways]
+    plan = sorted(
+        (
+            (pathway_index, pair_index)
+            for pathway_index, pathway in enumerate(pathways)
+            for pair_index in pathway.pending_pairs
+        ),
+        key=lambda job: pathways[job[0]].pair_cost,
+        reverse=True,
+    )
+    L.info("Submitting %d pairs from %d pathways...", len(plan), len(pathways))
+    first_submitted = {}
+    for position, (pathway_index, pair_index) in enumerate(plan):
+        pathway = pathways[pathway_index]
+        pathway_futures[pathway_index][pair_index] = pathway.submit_pair(pathway.pairs[pair_index])
+        first_submitted.setdefault(pathway_index, position)
+
+    # the pathways without pairs to simulate first, as they are done already
+    order = sorted(range(len(pathways)), key=lambda index: first_submitted.get(index, -1))
+    for position, pathway_index in enumerate(order):
+        L.info("Processing '%s' pathway results...", pathways[pathway_index].title)
+        try:
+            pathways[pathway_index].process(pathway_futures[pathway_index])
+        except Terminated:
+            # the pathway being processed recorded its simulated pairs itself
+            for index in order[position + 1 :]:
+                pathways[index].flush(pathway_futures[index])
+            L.warning("Terminated: run again with --resume to simulate the remaining pairs")
+            raise
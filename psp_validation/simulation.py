@@ -1,19 +1,28 @@
 """Running pair simulations."""
 
 import logging
+from concurrent.futures import Future
+from functools import cache, partial
 
 import attr
-import joblib
+import numpy as np
 
 from psp_validation import PSPError, setup_logging
+from psp_validation.executors import chain, gather, get_n_workers, worker_pool
 from psp_validation.utils import ensure_list, isolate
 
 L = logging.getLogger(__name__)
 
+SIMULATION_DT = 0.025  # [ms]
+
 
 @attr.s
 class SimulationResult:
-    """Parameters that are the same for all pathways."""
+    """Results of the trials of a pair simulation.
+
+    All the trials share the same `time` (T array); `currents` and `voltages` hold one row
+    for each of the N trials.
+    """
 
     params = attr.ib()
     time = attr.ib()
@@ -21,6 +30,16 @@ class SimulationResult:
     voltages = attr.ib()
 
 
+def concatenate_results(first, second):
+    """Get the `SimulationResult` of the trials of `first` followed by the ones of `second`."""
+    return SimulationResult(
+        params=first.params,
+        time=first.time,
+        currents=np.concatenate([first.currents, second.currents]),
+        voltages=np.concatenate([first.voltages, second.voltages]),
+    )
+
+
 def _bluecellulab(level):
     import bluecellulab  # noqa: PLC0415 import outside top-level
     import bluecellulab.tools  # noqa: PLC0415 import outside top-level
@@ -39,10 +58,50 @@ def _bluecellulab(level):
     return bluecellulab
 
 
-def get_holding_current(log_level, hold_V, post_gid, sonata_simulation_config, post_ttx):  # noqa: N803 (argument lowercase)
+@cache
+def _load_simulation_config(sonata_simulation_config, nrrp=None):
+    """Parse the Sonata simulation config, optionally overriding the NRRP of all synapses.
+
+    The parsed configs are cached, so that a long-lived worker parses each config only once.
+    """
+    import bluecellulab  # noqa: PLC0415 import outside top-level
+
+    config = bluecellulab.circuit.config.SonataSimulationConfig(sonata_simulation_config)
+
+    # `add_connection_override` appends to a list shared by all the instances of the class:
+    # give each config its own list, so that overrides do not leak between configs.
+    config._connection_overrides = []  # noqa: SLF001 private member access
+    if nrrp is not None:
+        config.add_connection_override(
+            bluecellulab.circuit.config.sections.ConnectionOverrides(
+                source="All",
+                target="All",
+                synapse_configure=f"%s.Nrrp = {nrrp}",
+            ),
+        )
+
+    return config
+
+
+def init_worker(sonata_simulation_config, log_level=logging.WARNING):
+    """Initialize a simulation worker.
+
+    Import bluecellulab, load the NEURON mechanisms and parse the simulation config once,
+    instead of doing it for every trial.
+    """
+    setup_logging(log_level)
+    bluecellulab = _bluecellulab(log_level)
+    bluecellulab.importer.load_mod_files(lambda: None)()
+    _load_simulation_config(str(sonata_simulation_config))
+
+
+def get_holding_current(log_level, hold_V, post_gid, sonata_simulation_config, post_ttx):
     """Retrieve the holding current using bluecellulab."""
     hold_i, _ = _bluecellulab(log_level).tools.holding_current(
-        hold_V, post_gid, sonata_simulation_config, enable_ttx=post_ttx
+        hold_V,
+        post_gid,
+        _load_simulation_config(str(sonata_simulation_config)),
+        enable_ttx=post_ttx,
     )
     # If the memory allocated by bluecellulab for the simulation is not automatically freed,
     # consider to call gc.collect() here. See NSETM-1356 and BGLPY-80 for more information.
@@ -74,7 +133,8 @@ def _all_gabaab(synapses, bluecellulab):
     )
 
 
-def run_pair_simulation(  # noqa: PLR0913,PLR0917 too many args / positional args
+def _instantiate_pair_simulation(  # noqa: PLR0913,PLR0917 too many args / positional args
+    bluecellulab,
     sonata_simulation_config,
     pre_gid,
     post_gid,
@@ -82,56 +142,19 @@ def run_pair_simulation(  # noqa: PLR0913,PLR0917 too many args / positional arg
     t_stim,
     record_dt,
     base_seed,
-    hold_I=None,  # noqa: N803 (argument lowercase)
-    hold_V=None,  # noqa: N803 (argument lowercase)
-    post_ttx=False,
-    add_projections=False,
-    nrrp=None,
-    log_level=logging.WARNING,
+    hold_I,
+    hold_V,
+    post_ttx,
+    add_projections,
+    nrrp,
 ):
-    """Run single pair simulation trial.
-
-    Args:
-        sonata_simulation_config: path to Sonata simulation config
-        pre_gid: presynaptic GID
-        post_gid: postsynaptic GID
-        t_stop: run simulation until `t_stop`
-        t_stim: pre_gid spike time(s) [single float or list of floats]
-        record_dt: timestep of the simulation
-        base_seed: simulation base seed
-        hold_I: holding current [nA] (if None, voltage clamp is applied)
-        hold_V: holding voltage [mV]
-        post_ttx: emulate TTX effect on postsynaptic cell (i.e. block Na channels)
-        add_projections: Whether to enable projections from BlueConfig. Default is False.
-        nrrp: Number of vesicles in the Release Ready Pool
-        log_level: logging level
+    """Instantiate the clamped postsynaptic cell with the synapses of the presynaptic cell.
 
     Returns:
-        A 4-tuple (params, time, current, voltage)
-        time and voltage are arrays of the same size
-        In voltage clamp current is an array
-        In current clamp it is a scalar at the clamped value
+        A 3-tuple (simulation, post_cell, params)
     """
-    setup_logging(log_level)
-
-    L.info("sim_pair: %s -> %s (seed=%d)...", pre_gid, post_gid, base_seed)
-
-    bluecellulab = _bluecellulab(log_level)
-
-    sonata_simulation_config = bluecellulab.circuit.config.SonataSimulationConfig(
-        str(sonata_simulation_config),
-    )
-    if nrrp is not None:
-        sonata_simulation_config.add_connection_override(
-            bluecellulab.circuit.config.sections.ConnectionOverrides(
-                source="All",
-                target="All",
-                synapse_configure=f"%s.Nrrp = {nrrp}",
-            ),
-        )
-
     simulation = bluecellulab.circuit_simulation.CircuitSimulation(
-        sonata_simulation_config,
+        _load_simulation_config(str(sonata_simulation_config), nrrp),
         record_dt=record_dt,
         base_seed=base_seed,
         rng_mode="Random123",
@@ -177,18 +200,407 @@ def run_pair_simulation(  # noqa: PLR0913,PLR0917 too many args / positional arg
         # add pre-calculated current to set the holding potential
         post_cell.add_ramp(0, 10000, hold_I, hold_I)
 
-    simulation.run(t_stop=t_stop, dt=0.025, v_init=hold_V, forward_skip=False)
+    return simulation, post_cell, params
 
-    L.info("sim_pair: %s -> %s (seed=%d)... done", pre_gid, post_gid, base_seed)
 
+def _get_recordings(post_cell, hold_I):
+    """Get (time, current, voltage) recorded at the postsynaptic cell."""
     return (
-        params,
         post_cell.get_time(),
         post_cell.get_recording("clamp_i") if hold_I is None else hold_I,
         post_cell.get_soma_voltage(),
     )
 
 
+def get_settle_time(t_stim, settle_margin, record_dt):
+    """Get the time until which the postsynaptic cell is settled before the first stimulus.
+
+    The settle time is aligned to the recording time step, so that the recordings of the
+    restored trials continue on the same time grid.
+
+    Args:
+        t_stim: pre_gid spike time(s) [single float or list of floats]
+        settle_margin: time [ms] between the end of the settling and the first stimulus
+        record_dt: recording time step (if None, simulation time step is used)
+
+    Returns:
+        settle time [ms]
+    """
+    if settle_margin < 0:
+        raise PSPError(f"Settle margin should be non-negative, got: {settle_margin}")
+
+    step = SIMULATION_DT if record_dt is None else record_dt
+    t_settle = np.floor((min(ensure_list(t_stim)) - settle_margin) / step) * step
+    if t_settle <= 0:
+        raise PSPError(
+            f"Settle margin ({settle_margin} ms) should be smaller than the stimulus time"
+        )
+
+    return t_settle
+
+
+def run_pair_simulation(  # noqa: PLR0913,PLR0917 too many args / positional args
+    sonata_simulation_config,
+    pre_gid,
+    post_gid,
+    t_stop,
+    t_stim,
+    record_dt,
+    base_seed,
+    hold_I=None,
+    hold_V=None,
+    post_ttx=False,
+    add_projections=False,
+    nrrp=None,
+    log_level=logging.WARNING,
+):
+    """Run single pair simulation trial.
+
+    Args:
+        sonata_simulation_config: path to Sonata simulation config
+        pre_gid: presynaptic GID
+        post_gid: postsynaptic GID
+        t_stop: run simulation until `t_stop`
+        t_stim: pre_gid spike time(s) [single float or list of floats]
+        record_dt: timestep of the simulation
+        base_seed: simulation base seed
+        hold_I: holding current [nA] (if None, voltage clamp is applied)
+        hold_V: holding voltage [mV]
+        post_ttx: emulate TTX effect on postsynaptic cell (i.e. block Na channels)
+        add_projections: Whether to enable projections from BlueConfig. Default is False.
+        nrrp: Number of vesicles in the Release Ready Pool
+        log_level: logging level
+
+    Returns:
+        A 4-tuple (params, time, current, voltage)
+        time and voltage are arrays of the same size
+        In voltage clamp current is an array
+        In current clamp it is a scalar at the clamped value
+    """
+    setup_logging(log_level)
+
+    L.info("sim_pair: %s -> %s (seed=%d)...", pre_gid, post_gid, base_seed)
+
+    bluecellulab = _bluecellulab(log_level)
+
+    simulation, post_cell, params = _instantiate_pair_simulation(
+        bluecellulab,
+        sonata_simulation_config,
+        pre_gid,
+        post_gid,
+        t_stop,
+        t_stim,
+        record_dt,
+        base_seed,
+        hold_I,
+        hold_V,
+        post_ttx,
+        add_projections,
+        nrrp,
+    )
+
+    simulation.run(t_stop=t_stop, dt=SIMULATION_DT, v_init=hold_V, forward_skip=False)
+    result = (params, *_get_recordings(post_cell, hold_I))
+
+    # free the NEURON objects right away, the process may run more simulations
+    simulation.delete()
+
+    L.info("sim_pair: %s -> %s (seed=%d)... done", pre_gid, post_gid, base_seed)
+
+    return result
+
+
+def run_pair_simulation_from_snapshot(  # noqa: PLR0913,PLR0914,PLR0917 too many args / locals
+    sonata_simulation_config,
+    pre_gid,
+    post_gid,
+    t_stop,
+    t_stim,
+    record_dt,
+    base_seeds,
+    settle_margin,
+    hold_I=None,
+    hold_V=None,
+    post_ttx=False,
+    add_projections=False,
+    nrrp=None,
+    log_level=logging.WARNING,
+):
+    """Run several pair simulation trials restored from a settled NEURON state.
+
+    The postsynaptic cell is simulated once until `t_stim - settle_margin`, and the NEURON
+    state is saved. For each base seed, the state is restored, the synapse random streams are
+    recreated with the trial seed, and only the remaining time window is simulated.
+
+    Since no presynaptic event is delivered before the stimulus, the settled state does not
+    depend on the base seed, and the trials are the same as the ones obtained with
+    `run_pair_simulation`. This does not hold if the postsynaptic cell has stochastic ion
+    channels, whose noise before the stimulus is then shared by all the trials.
+
+    Args:
+        sonata_simulation_config: path to Sonata simulation config
+        pre_gid: presynaptic GID
+        post_gid: postsynaptic GID
+        t_stop: run simulation until `t_stop`
+        t_stim: pre_gid spike time(s) [single float or list of floats]
+        record_dt: timestep of the simulation
+        base_seeds: simulation base seed for each trial
+        settle_margin: time [ms] between the end of the settling and the first stimulus
+        hold_I: holding current [nA] (if None, voltage clamp is applied)
+        hold_V: holding voltage [mV]
+        post_ttx: emulate TTX effect on postsynaptic cell (i.e. block Na channels)
+        add_projections: Whether to enable projections from BlueConfig. Default is False.
+        nrrp: Number of vesicles in the Release Ready Pool
+        log_level: logging level
+
+    Returns:
+        list of 4-tuples (params, time, current, voltage), one for each base seed
+        (see `run_pair_simulation`)
+    """
+    setup_logging(log_level)
+
+    t_settle = get_settle_time(t_stim, settle_margin, record_dt)
+    L.info("sim_pair: %s -> %s (settle until %.3f ms)...", pre_gid, post_gid, t_settle)
+
+    bluecellulab = _bluecellulab(log_level)
+    h = bluecellulab.neuron.h
+
+    simulation, post_cell, params = _instantiate_pair_simulation(
+        bluecellulab,
+        sonata_simulation_config,
+        pre_gid,
+        post_gid,
+        t_stop,
+        t_stim,
+        record_dt,
+        base_seeds[0],
+        hold_I,
+        hold_V,
+        post_ttx,
+        add_projections,
+        nrrp,
+    )
+
+    simulation.run(t_stop=t_settle, dt=SIMULATION_DT, v_init=hold_V, forward_skip=False)
+    settled_time, _, settled_voltage = _get_recordings(post_cell, hold_I)
+    settled_current = post_cell.get_recording("clamp_i") if hold_I is None else None
+
+    state = h.SaveState()
+    state.save()
+
+    results = []
+    for base_seed in base_seeds:
+        L.info("sim_pair: %s -> %s (seed=%d)...", pre_gid, post_gid, base_seed)
+        state.restore()
+
+        # Synapses do not draw random numbers before the stimulus: recreating their streams
+        # with the trial seed puts them in the same state as in a full-length trial.
+        h.Random().Random123_globalindex(base_seed)
+        for synapse in post_cell.synapses.values():
+            synapse.hsynapse.setRNG(synapse.randseed1, synapse.randseed2, synapse.randseed3)
+
+        # restart recordings from the restored time point
+        h.frecord_init()
+        h.continuerun(t_stop)
+
+        time_, current, voltage = _get_recordings(post_cell, hold_I)
+        # drop the settled samples recorded again from the restored time point
+        n_settled = np.searchsorted(settled_time, time_[0] - 0.5 * SIMULATION_DT)
+        if hold_I is None:
+            current = np.concatenate([settled_current[:n_settled], current])
+        results.append(
+            (
+                params,
+                np.concatenate([settled_time[:n_settled], time_]),
+                current,
+                np.concatenate([settled_voltage[:n_settled], voltage]),
+            )
+        )
+
+    simulation.delete()
+
+    L.info("sim_pair: %s -> %s (%d trials)... done", pre_gid, post_gid, len(base_seeds))
+
+    return results
+
+
+def _get_trial_tasks(base_seeds, settle_margin, n_chunks):
+    """Get the function running the trials of `base_seeds` and its specific kwargs for each task."""
+    if settle_margin is None:
+        return run_pair_simulation, [{"base_seed": seed} for seed in base_seeds]
+
+    # one settling per task: split the trials into contiguous chunks of seeds
+    n_chunks = min(len(base_seeds), n_chunks)
+    tasks = [
+        {"base_seeds": chunk.tolist(), "settle_margin": settle_margin}
+        for chunk in (np.array_split(base_seeds, n_chunks) if n_chunks > 0 else [])
+    ]
+    return run_pair_simulation_from_snapshot, tasks
+
+
+def _get_trial_key(kwargs, base_seed, settle_margin):
+    """Get all the inputs determining the result of a trial, used as simulation cache key.
+
+    The simulation config is not part of the key: the cache entries are keyed by its content.
+    """
+    key = {
+        name: value
+        for name, value in kwargs.items()
+        if name not in {"sonata_simulation_config", "log_level"}
+    }
+    return {**key, "base_seed": base_seed, "settle_margin": settle_margin, "dt": SIMULATION_DT}
+
+
+def _get_cached_trials(simulation_cache, base_seeds, settle_margin, kwargs):
+    """Get the results of the trials found in the cache, by base seed."""
+    if simulation_cache is None:
+        return {}
+
+    cached = {}
+    for seed in base_seeds:
+        result = simulation_cache.get(_get_trial_key(kwargs, seed, settle_margin))
+        if result is not None:
+            cached[seed] = result
+    return cached
+
+
+def _get_simulation_result(
+    results, settle_margin, base_seeds, cached=None, simulation_cache=None, kwargs=None
+):
+    """Assemble the results of the trial tasks and of the cached trials in a `SimulationResult`.
+
+    The results of the trial tasks (the trials of `base_seeds` missing from `cached`) are stored
+    in `simulation_cache`, if not None.
+    """
+    cached = cached or {}
+    if settle_margin is not None:
+        results = [result for chunk_results in results for result in chunk_results]
+
+    computed = dict(zip([seed for seed in base_seeds if seed not in cached], results, strict=True))
+    if simulation_cache is not None:
+        for seed, result in computed.items():
+            simulation_cache.put(_get_trial_key(kwargs, seed, settle_margin), result)
+
+    results = [cached[seed] if seed in cached else computed[seed] for seed in base_seeds]
+    return SimulationResult(
+        params=results[0][0],
+        time=np.asarray(results[0][1]),
+        currents=np.asarray([result[2] for result in results]),
+        voltages=np.stack([result[3] for result in results]),
+    )
+
+
+def submit_pair_simulation_suite(  # noqa: PLR0913,PLR0917 too many args / positional args
+    pool,
+    sonata_simulation_config,
+    pre_gid,
+    post_gid,
+    t_stop,
+    t_stim,
+    record_dt,
+    base_seed,
+    hold_V=None,
+    post_ttx=False,
+    clamp="current",
+    add_projections=False,
+    n_trials=1,
+    first_trial=0,
+    settle_margin=None,
+    holding_current_cache=None,
+    simulation_cache=None,
+    log_level=logging.WARNING,
+):
+    """Submit single pair simulation suite (i.e. multiple trials) to a pool without waiting.
+
+    The holding current is computed by a first task (unless found in `holding_current_cache`),
+    and the trials are submitted as soon as it is known, so that the trials of many pairs can
+    be run at the same time by the workers of `pool`. Only the trials missing from
+    `simulation_cache` are simulated.
+
+    Args:
+        pool: pool of `psp_validation.executors.worker_pool` running the simulations
+        sonata_simulation_config: path to Sonata simulation config
+        pre_gid: presynaptic GID
+        post_gid: postsynaptic GID
+        t_stop: run simulation until `t_stop`
+        t_stim: pre_gid spike time(s) [single float or list of floats]
+        record_dt: timestep of the simulation
+        base_seed: simulation base seed
+        hold_V: holding voltage (mV)
+        post_ttx: emulate TTX effect on postsynaptic cell (i.e. block Na channels)
+        clamp: type of the clamp used ['current' | 'voltage']
+        add_projections: Whether to enable projections. Default is False.
+        n_trials: number of trials to run
+        first_trial: index of the first trial to run, e.g. to run the trials of a pair in batches
+            (the k-th trial uses `base_seed` + k as base seed)
+        settle_margin: if not None, settle the postsynaptic cell once per worker until
+            `t_stim - settle_margin` and restore its state for each trial
+            (see `run_pair_simulation_from_snapshot`)
+        holding_current_cache: `psp_validation.cache.HoldingCurrentCache` used to look up
+            the holding current (if None, it is always computed)
+        simulation_cache: `psp_validation.cache.SimulationCache` used to look up the results
+            of the trials (if None, all the trials are simulated)
+        log_level: logging level
+
+    Returns:
+        `concurrent.futures.Future` of the `SimulationResult`
+    """
+    assert clamp in {"current", "voltage"}
+
+    hold_i = None
+    if clamp == "current" and holding_current_cache is not None:
+        hold_i = holding_current_cache.get(post_gid, hold_V, post_ttx)
+
+    if clamp == "current" and hold_i is None:
+        L.info("Calculating %s holding current...", post_gid)
+        hold_i_future = pool.submit(
+            get_holding_current, log_level, hold_V, post_gid, sonata_simulation_config, post_ttx
+        )
+    else:
+        hold_i_future = Future()
+        hold_i_future.set_result(hold_i)
+
+    base_seeds = [base_seed + k for k in range(first_trial, first_trial + n_trials)]
+
+    def _submit_trials(hold_i):
+        if clamp == "current":
+            L.info("%s holding current: %.3f nA", post_gid, hold_i)
+            if holding_current_cache is not None:
+                holding_current_cache.put(post_gid, hold_V, post_ttx, hold_i)
+
+        kwargs = {
+            "sonata_simulation_config": sonata_simulation_config,
+            "pre_gid": pre_gid,
+            "post_gid": post_gid,
+            "t_stop": t_stop,
+            "t_stim": t_stim,
+            "record_dt": record_dt,
+            "hold_I": hold_i,
+            "hold_V": hold_V,
+            "post_ttx": post_ttx,
+            "add_projections": add_projections,
+            "log_level": log_level,
+        }
+        cached = _get_cached_trials(simulation_cache, base_seeds, settle_margin, kwargs)
+        func, tasks = _get_trial_tasks(
+            [seed for seed in base_seeds if seed not in cached], settle_margin, pool.n_workers
+        )
+        # the pool workers are recycled once their memory usage grows too much
+        return chain(
+            gather(pool.submit(func, **task, **kwargs) for task in tasks),
+            partial(
+                _get_simulation_result,
+                settle_margin=settle_margin,
+                base_seeds=base_seeds,
+                cached=cached,
+                simulation_cache=simulation_cache,
+                kwargs=kwargs,
+            ),
+        )
+
+    return chain(hold_i_future, _submit_trials)
+
+
 def run_pair_simulation_suite(  # noqa: PLR0913,PLR0917 too many args / positional args
     sonata_simulation_config,
     pre_gid,
@@ -197,13 +609,18 @@ def run_pair_simulation_suite(  # noqa: PLR0913,PLR0917 too many args / position
     t_stim,
     record_dt,
     base_seed,
-    hold_V=None,  # noqa: N803 (argument lowercase)
+    hold_V=None,
     post_ttx=False,
     clamp="current",
     add_projections=False,
     n_trials=1,
     n_jobs=None,
+    settle_margin=None,
+    pool=None,
+    holding_current_cache=None,
+    simulation_cache=None,
     log_level=logging.WARNING,
+    backend="loky",
 ):
     """Run single pair simulation suite (i.e. multiple trials).
 
@@ -221,57 +638,92 @@ def run_pair_simulation_suite(  # noqa: PLR0913,PLR0917 too many args / position
         add_projections: Whether to enable projections. Default is False.
         n_trials: number of trials to run
         n_jobs: number of jobs to run in parallel (None for sequential runs)
+        settle_margin: if not None, settle the postsynaptic cell once per job until
+            `t_stim - settle_margin` and restore its state for each trial
+            (see `run_pair_simulation_from_snapshot`)
+        pool: pool of `psp_validation.executors.worker_pool` running the simulations
+            (if None, each simulation is isolated in its own process and `n_jobs` are used)
+        holding_current_cache: `psp_validation.cache.HoldingCurrentCache` used to look up
+            the holding current (if None, it is always computed)
+        simulation_cache: `psp_validation.cache.SimulationCache` used to look up the results
+            of the trials (if None, all the trials are simulated)
         log_level: logging level
+        backend: backend running the `n_jobs` if `pool` is None
+            (see `psp_validation.executors.worker_pool`)
 
     k-th trial would use (`base_seed` + k) as base seed; k=0..N-1.
 
     Returns:
-        N x 2 x T numpy array with trials voltage / current traces (Y_k, t_k)
+        `SimulationResult` of the N trials: the simulation `params`, the `time` (T array) shared
+        by all the trials, and the `currents` (holding current of each trial, or N x T array of
+        the clamp currents in voltage clamp) and `voltages` (N x T array) of the trials
     """
+    if pool is not None:
+        return submit_pair_simulation_suite(
+            pool,
+            sonata_simulation_config,
+            pre_gid,
+            post_gid,
+            t_stop,
+            t_stim,
+            record_dt,
+            base_seed,
+            hold_V=hold_V,
+            post_ttx=post_ttx,
+            clamp=clamp,
+            add_projections=add_projections,
+            n_trials=n_trials,
+            settle_margin=settle_margin,
+            holding_current_cache=holding_current_cache,
+            simulation_cache=simulation_cache,
+            log_level=log_level,
+        ).result()
+
     assert clamp in {"current", "voltage"}
     if clamp == "current":
-        L.info("Calculating %s holding current...", post_gid)
-        hold_i = get_holding_current(
-            log_level, hold_V, post_gid, sonata_simulation_config, post_ttx
-        )
+        hold_i = None
+        if holding_current_cache is not None:
+            hold_i = holding_current_cache.get(post_gid, hold_V, post_ttx)
+        if hold_i is None:
+            L.info("Calculating %s holding current...", post_gid)
+            hold_i = get_holding_current(
+                log_level, hold_V, post_gid, sonata_simulation_config, post_ttx
+            )
+            if holding_current_cache is not None:
+                holding_current_cache.put(post_gid, hold_V, post_ttx, hold_i)
         L.info("%s holding current: %.3f nA", post_gid, hold_i)
     else:
         hold_i = None
 
-    if n_jobs is None:
-        n_jobs = 1
-    elif n_jobs <= 0:
-        n_jobs = -1
+    n_workers = get_n_workers(n_jobs)
+    kwargs = {
+        "sonata_simulation_config": sonata_simulation_config,
+        "pre_gid": pre_gid,
+        "post_gid": post_gid,
+        "t_stop": t_stop,
+        "t_stim": t_stim,
+        "record_dt": record_dt,
+        "hold_I": hold_i,
+        "hold_V": hold_V,
+        "post_ttx": post_ttx,
+        "add_projections": add_projections,
+        "log_level": log_level,
+    }
+    base_seeds = [base_seed + k for k in range(n_trials)]
+    cached = _get_cached_trials(simulation_cache, base_seeds, settle_margin, kwargs)
+    func, tasks = _get_trial_tasks(
+        [seed for seed in base_seeds if seed not in cached], settle_margin, n_workers
+    )
 
     # Isolate `run_pair_simulation` in its own process.
     # Note: this is required because bluecellulab uses NEURON, and the latter
     #   cannot be coerced to clean up its memory usage; thus causing out of
     #   memory problems as more simulations are run across multiple workers.
     # Note: for debugging purposes, run_pair_simulation should be called directly.
-    worker = joblib.delayed(isolate(run_pair_simulation))
-    results = joblib.Parallel(n_jobs=n_jobs, backend="loky")(
-        [
-            worker(
-                sonata_simulation_config=sonata_simulation_config,
-                pre_gid=pre_gid,
-                post_gid=post_gid,
-                t_stop=t_stop,
-                t_stim=t_stim,
-                record_dt=record_dt,
-                hold_I=hold_i,
-                hold_V=hold_V,
-                post_ttx=post_ttx,
-                add_projections=add_projections,
-                log_level=log_level,
-                base_seed=(base_seed + k),
-            )
-            for k in range(n_trials)
-        ],
-    )
+    with worker_pool(backend, n_workers) as jobs_pool:
+        futures = [jobs_pool.submit(isolate(func), **task, **kwargs) for task in tasks]
+        results = [future.result() for future in futures]
 
-    return SimulationResult(
-        params=results[0][0],
-        time=results[0][1],
-        currents=[result[2] for result in results],
-        voltages=[result[3] for result in results],
+    return _get_simulation_result(
+        results, settle_margin, base_seeds, cached, simulation_cache, kwargs
     )
@@ -3,20 +3,40 @@
 import logging
 from abc import ABC, abstractmethod
 
-from psp_validation.features import get_peak_amplitudes, get_peak_voltage
+import numpy as np
+
+from psp_validation.features import get_peak_amplitudes
 
 L = logging.getLogger(__name__)
 
 
 class BaseTraceFilter(ABC):
-    """Base trace filter."""
+    """Base trace filter.
+
+    Filters compute a boolean mask of the traces to keep from a N x T array of voltages sharing
+    the same time, so that the masks of several filters can be combined
+    (see `psp_validation.features.select_traces`).
+    """
 
     @abstractmethod
+    def mask(self, time, voltages):
+        """Get the mask of the traces selected by the filter.
+
+        Args:
+            time (np.ndarray): array of the T measurement times, shared by all the traces.
+            voltages (np.ndarray): N x T array of voltages.
+                N: number of traces
+                T: number of measurements
+
+        Returns:
+            np.ndarray: boolean array of length N, True for the selected traces
+        """
+
     def __call__(self, traces):
         """Apply the trace filter.
 
         Args:
-            traces (list): N x 2 x T array of traces.
+            traces (list): N x 2 x T array of traces, sharing the same time.
                 N: number of traces
                 2: voltage and time arrays
                 T: number of measurements
@@ -24,11 +44,23 @@ class BaseTraceFilter(ABC):
         Returns:
             the selected traces
         """
+        traces = list(traces)
+        if not traces:
+            return []
+        time = np.asarray(traces[0][1])
+        voltages = np.array([v_ for v_, _ in traces], dtype=np.float64)
+        return [
+            trace for trace, keep in zip(traces, self.mask(time, voltages), strict=True) if keep
+        ]
 
 
 class NullFilter(BaseTraceFilter):
     """Filter out empty or null traces."""
 
+    def mask(self, time, voltages):  # noqa: PLR6301,ARG002 (same signature as the other filters)
+        """Get the mask of the traces that are not empty, nor only made of NaN."""
+        return ~np.all(np.isnan(voltages), axis=1)
+
     def __call__(self, traces):
         """Apply the filter."""
         selected = []
@@ -54,21 +86,15 @@ class SpikeFilter(BaseTraceFilter):
         self.t0 = t_start
         self.v_max = v_max
 
-    def __call__(self, traces):
-        """Apply the filter."""
-        selected = []
-        for v_, t_ in traces:
-            if get_peak_voltage(t_, v_, self.t0, "EXC") > self.v_max:
-                L.debug("Skip trace containing spikes")
-                continue
-            selected.append((v_, t_))
-        return selected
+    def mask(self, time, voltages):
+        """Get the mask of the traces without any value above `v_max` after `t_start`."""
+        return ~np.any(voltages[:, time > self.t0] > self.v_max, axis=1)
 
 
 class AmplitudeFilter(BaseTraceFilter):
     """Filter out traces with insufficient amplitude."""
 
-    def __init__(self, t_stim, min_trace_amplitude, syn_type):
+    def __init__(self, t_stim, min_trace_amplitude, syn_type, backend="efel"):
         """Initialize the filter.
 
         Args:
@@ -80,29 +106,28 @@ class AmplitudeFilter(BaseTraceFilter):
                 minimum_voltage > voltage_base - min_trace_amplitude.
                 Note: maximum_voltage and minimum_voltage are interpolated.
             syn_type: synapse type (EXC or INH).
+            backend: backend used to compute the amplitudes (see `get_peak_amplitudes`).
         """
         self.t_stim = t_stim
         self.min_trace_amplitude = min_trace_amplitude
         self.syn_type = syn_type
+        self.backend = backend
 
-    def __call__(self, traces):
-        """Apply the filter."""
-        if self.min_trace_amplitude <= 0:
-            return traces
-        insufficient = []
-        selected = []
-        voltages = [v for v, _ in traces]
-        times = [t for _, t in traces]
+    def mask(self, time, voltages):
+        """Get the mask of the traces with a sufficient amplitude."""
+        if self.min_trace_amplitude <= 0 or len(voltages) == 0:
+            return np.ones(len(voltages), dtype=bool)
 
-        amplitudes = get_peak_amplitudes(times, voltages, self.t_stim, self.syn_type)
-        for trace, amplitude in zip(traces, amplitudes):
-            if amplitude < self.min_trace_amplitude:
-                insufficient.append(amplitude)
-            else:
-                selected.append(trace)
+        times = time if self.backend == "numpy" else [time] * len(voltages)
+        amplitudes = np.asarray(
+            get_peak_amplitudes(times, voltages, self.t_stim, self.syn_type, backend=self.backend)
+        )
+        # traces whose amplitude cannot be computed (NaN) are kept
+        insufficient = amplitudes < self.min_trace_amplitude
 
-        if insufficient:
+        if np.any(insufficient):
             L.debug(
-                "Skip trace(s) with insufficient amplitude: %s", ", ".join(map(str, insufficient))
+                "Skip trace(s) with insufficient amplitude: %s",
+                ", ".join(map(str, amplitudes[insufficient])),
             )
-        return selected
+        return ~insufficient
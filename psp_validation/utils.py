@@ -3,6 +3,7 @@
 import multiprocessing
 import pathlib
 from collections.abc import Iterable
+from functools import partial
 
 import click
 import yaml
@@ -20,8 +21,7 @@ def load_config(filepath):
     """Load YAML job config."""
     config = load_yaml(filepath)
     assert "hold_I" not in config["protocol"], (
-        "`hold_I` parameter in protocol is deprecated. "
-        "Please remove it from '%s' pathway config",
+        "`hold_I` parameter in protocol is deprecated. Please remove it from '%s' pathway config",
         filepath,
     )
 
@@ -46,12 +46,13 @@ def isolate(func):
     Returns:
         the isolated function
     """
+    # a partial rather than a closure, so that it can be pickled to be sent to a worker
+    return partial(_run_isolated, func)
 
-    def func_isolated(*args, **kwargs):
-        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
-            return pool.apply(func, args, kwargs)
 
-    return func_isolated
+def _run_isolated(func, *args, **kwargs):
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(func, args, kwargs)
 
 
 def ensure_list(v):
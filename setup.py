@@ -17,7 +17,7 @@ setup(
         "bluepysnap>=3.0.0,<4.0.0",
         "seaborn>=0.11,<1.0",
     ],
-    extras_require={"docs": ["sphinx", "sphinx-bluebrain-theme"]},
+    extras_require={"docs": ["sphinx", "sphinx-bluebrain-theme"], "mpi": ["mpi4py>=3.0"]},
     packages=find_packages(),
     author="BlueBrain NSE",
     author_email="bbp-ou-nse@groupes.epfl.ch",
@@ -25,7 +25,7 @@ setup(
     long_description="PSP analysis tools",
     long_description_content_type="text/plain",
     license="Apache2.0",
-    python_requires=">=3.7",
+    python_requires=">=3.10",
     setup_requires=[
         "setuptools_scm",
     ],
@@ -48,9 +48,6 @@ setup(
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
@@ -1,9 +1,15 @@
 from unittest.mock import Mock, patch
 
+import h5py
 import numpy as np
+import pandas as pd
+import pytest
 from numpy.testing import assert_allclose, assert_array_equal
 
 import psp_validation.cv_validation.analyze_traces as test_module
+from psp_validation.cache import NOISE, NoiseBank
+
+from tests.utils import TEST_DATA_DIR_PSP
 
 
 def test__filter_traces():
@@ -33,6 +39,68 @@ def test__get_jackknife_traces():
     assert_array_equal(res, expected)
 
 
+def test__get_jackknife_traces_random():
+    traces = np.random.default_rng(0).normal(size=(7, 20)).astype(np.float32)
+    expected = [np.mean(np.delete(traces, i, 0), axis=0) for i in range(len(traces))]
+
+    res = test_module._get_jackknife_traces(traces)
+    assert res.dtype == np.float32
+    assert_allclose(res, expected, atol=1e-6)
+
+
+def test__get_delete_d_jackknife_traces():
+    traces = np.random.default_rng(0).normal(size=(6, 20))
+    rng = np.random.default_rng(0)
+
+    # all the 15 subsets of 2 trials
+    res = test_module._get_delete_d_jackknife_traces(traces, 2, 100, rng)
+    expected = [
+        np.mean(np.delete(traces, [i, j], 0), axis=0) for i in range(6) for j in range(i + 1, 6)
+    ]
+    assert_allclose(res, expected)
+
+    # random subsets
+    subsets = test_module._get_delete_d_subsets(6, 2, 10, np.random.default_rng(1))
+    assert subsets.shape == (10, 2)
+    assert all(len(set(subset)) == 2 for subset in subsets)
+    res = test_module._get_delete_d_jackknife_traces(traces, 2, 10, np.random.default_rng(1))
+    assert_allclose(res, [np.mean(np.delete(traces, subset, 0), axis=0) for subset in subsets])
+
+
+def test__get_bootstrap_traces():
+    traces = np.random.default_rng(0).normal(size=(5, 20))
+
+    res = test_module._get_bootstrap_traces(traces, 8, np.random.default_rng(0))
+    counts = np.random.default_rng(0).multinomial(5, np.full(5, 0.2), size=8)
+    assert res.shape == (8, 20)
+    assert_allclose(res, [np.repeat(traces, count, axis=0).mean(axis=0) for count in counts])
+
+
+@patch.object(test_module, "_get_peak_amplitudes")
+def test_calc_resampled_cv(mock_get_amplitudes):
+    traces = np.random.default_rng(0).normal(size=(10, 20))
+    amplitudes = np.random.default_rng(1).random(45)
+    mock_get_amplitudes.return_value = amplitudes
+
+    # delete-2 JK variance: (N-d)/d * MEAN_OF_SQUARED_DIFF
+    expected = np.sqrt(4 * np.var(amplitudes)) / np.mean(amplitudes)
+    res = test_module.calc_resampled_cv(None, traces, "EXC", 1.0, "current", delete=2)
+    assert_allclose(res, expected)
+    assert mock_get_amplitudes.call_args.args[1].shape == (45, 20)
+
+    expected = np.std(amplitudes, ddof=1) / np.mean(amplitudes)
+    res = test_module.calc_resampled_cv(
+        None, traces, "EXC", 1.0, "current", method="bootstrap", n_resamples=45
+    )
+    assert_allclose(res, expected)
+    assert mock_get_amplitudes.call_args.args[1].shape == (45, 20)
+
+    with pytest.raises(ValueError, match="Unknown resampling method"):
+        test_module.calc_resampled_cv(None, traces, "EXC", 1.0, "current", method="a")
+    with pytest.raises(ValueError, match="Can't leave out 10 trials out of 10"):
+        test_module.calc_resampled_cv(None, traces, "EXC", 1.0, "current", delete=10)
+
+
 @patch.object(test_module, "_get_jackknife_traces", new=Mock())
 @patch.object(test_module, "_get_peak_amplitudes")
 def test_calc_cv(mock_get_amplitudes):
@@ -46,3 +114,220 @@ def test_calc_cv(mock_get_amplitudes):
     # Since JK_var = (n-1)/n * SUM_SQUARES, and Var = 1/n * SUM_SQUARES
     expected = np.sqrt(len(amplitudes) - 1) * np.std(amplitudes) / np.mean(amplitudes)
     assert_allclose(test_module.calc_cv(None, None, None, None, "current", jk=True), expected)
+
+
+def test_calc_cv_backends():
+    with h5py.File(TEST_DATA_DIR_PSP / "small-traces.h5", "r") as h5f:
+        trials = h5f["traces/All_11085-All_10126/trials"][:]
+    t, traces = trials[0, 1], trials[:, 0]
+
+    for jk in [False, True]:
+        expected = test_module.calc_cv(t, traces, "EXC", 1.0, "current", jk=jk)
+        actual = test_module.calc_cv(t, traces, "EXC", 1.0, "current", jk=jk, backend="numpy")
+        assert actual == expected
+
+
+def test_calc_resampled_cv_many_trials():
+    with h5py.File(TEST_DATA_DIR_PSP / "small-traces.h5", "r") as h5f:
+        trials = h5f["traces/All_11085-All_10126/trials"][:]
+    t, traces = trials[0, 1], trials[:, 0]
+    traces = np.repeat(traces, 40, axis=0)
+    traces += np.random.default_rng(0).normal(scale=0.01, size=traces.shape)
+
+    jk_cv = test_module.calc_cv(t, traces, "EXC", 1.0, "current", jk=True, backend="numpy")
+    for kwargs in [{"delete": 20}, {"method": "bootstrap"}]:
+        cv = test_module.calc_resampled_cv(
+            t,
+            traces,
+            "EXC",
+            1.0,
+            "current",
+            rng=np.random.default_rng(0),
+            backend="numpy",
+            **kwargs,
+        )
+        assert_allclose(cv, jk_cv, rtol=0.5)
+
+
+PROTOCOL = {"t_stim": 20.0, "tau": 28.2, "sigma": 0.22, "min_good_trials": 3}
+
+
+def _write_cv_simulation(path, n_trials, n_spiking, syn_types, seed=0):
+    """Writes pairs of synthetic PSP traces like `cv-validation run`, and returns the pairs."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, 40, 0.1)
+    psp = np.where(t > 20, (t - 20) * np.exp(1 - (t - 20) / 2) / 2, 0)
+    pairs = pd.DataFrame(
+        {
+            "pre_population": "pre",
+            "pre_id": range(len(n_trials)),
+            "post_population": "post",
+            "post_id": range(100, 100 + len(n_trials)),
+            "synapse_type": syn_types,
+        }
+    )
+    with h5py.File(path, "w") as h5f:
+        h5f.attrs["clamp"] = "current"
+        for row, n, spiking, syn_type in zip(
+            pairs.itertuples(), n_trials, n_spiking, syn_types, strict=True
+        ):
+            group = h5f.create_group(f"pre-{row.pre_id}_post-{row.post_id}")
+            group.attrs["base_seed"] = 10 + row.pre_id
+            for trial in range(n):
+                amplitude = rng.uniform(0.5, 1.5) * (1 if syn_type == "EXC" else -1)
+                voltage = -70 + amplitude * psp
+                if trial < spiking:
+                    voltage[300] = 0.0
+                seed_group = group.create_group(f"seed{trial}")
+                seed_group["time"] = t
+                seed_group["soma_voltage"] = voltage
+                seed_group["soma_current"] = np.zeros_like(t)
+    return pairs
+
+
+def _get_expected_cvs(pairs, h5_path, protocol, backend):
+    expected = [], [], []
+    with h5py.File(h5_path, "r") as h5f:
+        for row in pairs.itertuples():
+            name = f"pre-{row.pre_id}_post-{row.post_id}"
+            rng = np.random.default_rng(h5f[name].attrs["base_seed"])
+            t, traces = test_module.get_noisy_traces(h5f[name], protocol, "current", rng=rng)
+            if traces is None or len(traces) < protocol["min_good_trials"]:
+                expected[2].append(name)
+                continue
+            args = (t, traces, row.synapse_type, protocol["t_stim"], "current")
+            expected[0].append(test_module.calc_cv(*args, jk=False, backend=backend))
+            expected[1].append(
+                test_module.calc_resampled_cv(
+                    *args,
+                    method=protocol.get("jk_method", "jackknife"),
+                    delete=protocol.get("jk_delete", 1),
+                    n_resamples=protocol.get("jk_resamples"),
+                    rng=rng,
+                    backend=backend,
+                )
+            )
+    return expected
+
+
+@pytest.mark.parametrize("backend", ["efel", "numpy"])
+@pytest.mark.parametrize("max_samples", [test_module.MAX_BATCH_SAMPLES, 5000])
+@pytest.mark.parametrize(
+    "protocol",
+    [
+        PROTOCOL,
+        {**PROTOCOL, "jk_method": "bootstrap", "jk_resamples": 20},
+        {**PROTOCOL, "jk_delete": 2, "ou_method": "exact"},
+    ],
+)
+def test_get_cvs_and_jk_cvs(tmp_path, backend, max_samples, protocol):
+    pairs = _write_cv_simulation(
+        tmp_path / "simulation.h5",
+        n_trials=[6, 4, 3, 5, 7],
+        n_spiking=[1, 0, 2, 5, 0],
+        syn_types=["EXC", "EXC", "EXC", "EXC", "INH"],
+    )
+
+    cvs, jk_cvs, bad_pairs = test_module.get_cvs_and_jk_cvs(
+        pairs, tmp_path / "simulation.h5", protocol, backend, max_samples=max_samples
+    )
+    expected_cvs, expected_jk_cvs, expected_bad_pairs = _get_expected_cvs(
+        pairs, tmp_path / "simulation.h5", protocol, backend
+    )
+    assert bad_pairs == expected_bad_pairs == ["pre-2_post-102", "pre-3_post-103"]
+    assert_allclose(cvs, expected_cvs, rtol=1e-10)
+    assert_allclose(jk_cvs, expected_jk_cvs, rtol=1e-10)
+
+
+@pytest.mark.parametrize("max_samples", [test_module.MAX_BATCH_SAMPLES, 5000])
+def test_get_cvs_and_jk_cvs_noise_bank(tmp_path, max_samples):
+    protocol = {**PROTOCOL, "jk_method": "bootstrap", "jk_resamples": 20}
+    pairs = _write_cv_simulation(
+        tmp_path / "simulation.h5", [6, 4, 5], [1, 0, 5], ["EXC", "EXC", "INH"]
+    )
+    noise_bank = NoiseBank(tmp_path / "cache")
+
+    cvs, jk_cvs, bad_pairs = test_module.get_cvs_and_jk_cvs(
+        pairs, tmp_path / "simulation.h5", protocol, max_samples=max_samples, noise_bank=noise_bank
+    )
+    assert bad_pairs == ["pre-2_post-102"]
+
+    # the noise of the trial i of a pair is the row i of its noise in the bank
+    expected_cvs, expected_jk_cvs = [], []
+    with h5py.File(tmp_path / "simulation.h5", "r") as h5f:
+        for row in pairs.itertuples():
+            name = f"pre-{row.pre_id}_post-{row.post_id}"
+            t, traces = test_module._load_traces(h5f[name], "current")
+            good = np.all(traces[:, t > protocol["t_stim"]] <= test_module.SPIKE_TH, axis=1)
+            if not good.any():
+                continue
+            base_seed = h5f[name].attrs["base_seed"]
+            noise = noise_bank.get(name, base_seed, len(traces), t, protocol)
+            args = (t, traces[good] + noise[good], row.synapse_type, protocol["t_stim"], "current")
+            expected_cvs.append(test_module.calc_cv(*args, jk=False))
+            expected_jk_cvs.append(
+                test_module.calc_resampled_cv(
+                    *args,
+                    method="bootstrap",
+                    n_resamples=20,
+                    rng=np.random.default_rng(base_seed),
+                )
+            )
+    assert_allclose(cvs, expected_cvs, rtol=1e-10)
+    assert_allclose(jk_cvs, expected_jk_cvs, rtol=1e-10)
+    # the noise of all the pairs is in the bank
+    assert noise_bank.misses == 3
+
+
+def test_get_cvs_and_jk_cvs_no_good_pairs(tmp_path):
+    pairs = _write_cv_simulation(tmp_path / "simulation.h5", [3, 2], [3, 0], ["EXC", "EXC"])
+
+    cvs, jk_cvs, bad_pairs = test_module.get_cvs_and_jk_cvs(
+        pairs, tmp_path / "simulation.h5", PROTOCOL
+    )
+    assert cvs == jk_cvs == []
+    assert bad_pairs == ["pre-0_post-100", "pre-1_post-101"]
+
+
+def test_get_all_cvs(tmp_path):
+    for nrrp, seed in [(1, 0), (2, 1)]:
+        pairs = _write_cv_simulation(
+            tmp_path / f"simulation_nrrp{nrrp}.h5", [5, 5, 4], [0, 4, 0], ["EXC"] * 3, seed=seed
+        )
+
+    res = test_module.get_all_cvs(tmp_path, pairs, (1, 2), PROTOCOL, n_jobs=2, backend="thread")
+    assert list(res) == ["nrrp1", "nrrp2"]
+    for nrrp in [1, 2]:
+        cvs, jk_cvs, _ = test_module.get_cvs_and_jk_cvs(
+            pairs, tmp_path / f"simulation_nrrp{nrrp}.h5", PROTOCOL
+        )
+        assert_array_equal(res[f"nrrp{nrrp}"]["CV"], cvs)
+        assert_array_equal(res[f"nrrp{nrrp}"]["JK_CV"], jk_cvs)
+
+
+def test_get_all_cvs_noise_bank(tmp_path):
+    # the same traces, with more trials for the second NRRP value
+    for nrrp, n_trials in [(1, [5, 4]), (2, [5, 6])]:
+        pairs = _write_cv_simulation(
+            tmp_path / f"simulation_nrrp{nrrp}.h5", n_trials, [0, 0], ["EXC"] * 2
+        )
+    noise_bank = NoiseBank(tmp_path / "cache")
+
+    res = test_module.get_all_cvs(
+        tmp_path, pairs, (1, 2), PROTOCOL, n_jobs=2, backend="thread", noise_bank=noise_bank
+    )
+    # the noise of each pair is generated once, for its largest number of trials
+    assert noise_bank.misses == 2
+    assert len(list((tmp_path / "cache" / NOISE).glob("*.npy"))) == 2
+
+    # common random numbers: the same trials get the same noise for both NRRP values
+    assert res["nrrp1"]["CV"][0] == res["nrrp2"]["CV"][0]
+    assert res["nrrp1"]["JK_CV"][0] == res["nrrp2"]["JK_CV"][0]
+    assert res["nrrp1"]["CV"][1] != res["nrrp2"]["CV"][1]
+
+    for nrrp in [1, 2]:
+        cvs, jk_cvs, _ = test_module.get_cvs_and_jk_cvs(
+            pairs, tmp_path / f"simulation_nrrp{nrrp}.h5", PROTOCOL, noise_bank=noise_bank
+        )
+        assert_array_equal(res[f"nrrp{nrrp}"]["CV"], cvs)
+        assert_array_equal(res[f"nrrp{nrrp}"]["JK_CV"], jk_cvs)
@@ -1,30 +1,59 @@
-from unittest.mock import Mock, patch
-
 import numpy as np
-from numpy.testing import assert_almost_equal, assert_array_equal
+import pytest
+from numpy.testing import assert_allclose, assert_almost_equal, assert_array_equal
 
 import psp_validation.cv_validation.calibrate_nrrp as test_module
 
 
-def test__sample_cvs():
-    np.random.seed(1)
-    nrrps = [1, 2]
-    counts = [2, 3]
-    cvs = {f"nrrp{i}": {"CV": np.arange(5), "JK_CV": np.arange(5)} for i in range(1, 3)}
+def test__sample_mean_cvs():
+    nrrps = np.array([[1, 1, 2, 2, 2], [1, 1, 1, 1, 1], [2, 2, 2, 2, 2]])
+    cvs = {1: np.arange(5.0), 2: np.arange(5.0) + 10}
 
-    res = test_module._sample_cvs(nrrps, counts, cvs)
-    assert_array_equal(res, [1.8, 1.2])
+    res = test_module._sample_mean_cvs(nrrps, cvs, np.random.default_rng(1))
+    assert res.shape == (3,)
+    assert 0 + 1 + 10 + 11 + 12 <= 5 * res[0] <= 3 + 4 + 12 + 13 + 14
+    assert_almost_equal(res[1:], [2, 12])
 
+    # the CVs are drawn without replacement
+    nrrps = np.ones((1000, 2), dtype=int)
+    res = test_module._sample_mean_cvs(nrrps, {1: np.array([0.0, 1.0])}, np.random.default_rng(1))
+    assert_array_equal(res, np.full(1000, 0.5))
+
+    with pytest.raises(ValueError, match="Can't sample 2 CVs out of the 1 pairs with NRRP=1"):
+        test_module._sample_mean_cvs(nrrps, {1: np.array([0.0])}, np.random.default_rng(1))
 
-@patch.object(test_module, "_sample_cvs", new=Mock(return_value=(0, 1)))
-def test_scan_lambdas():
-    np.random.seed(1)
-    res = test_module.scan_lambdas(None, [1, 2], 1, 1)
 
-    # These values are just simply copied from the original output before changes
-    assert_array_equal(res[0], [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2])
-    assert_array_equal(res[1], np.zeros(11))
-    assert_array_equal(res[2], np.ones(11))
+def test__sample_mean_cvs_distribution():
+    nrrps = np.ones((20000, 2), dtype=int)
+    cvs = np.array([0.0, 1.0, 2.0, 3.0])
+    res = test_module._sample_mean_cvs(nrrps, {1: cvs}, np.random.default_rng(1))
+
+    # each of the 6 pairs of different CVs is drawn with the same probability
+    values, counts = np.unique(res, return_counts=True)
+    assert_array_equal(values, [0.5, 1.0, 1.5, 2.0, 2.5])
+    assert_allclose(counts / len(res), np.array([1, 1, 2, 1, 1]) / 6, atol=0.04)
+
+
+def test_scan_lambdas():
+    n_pairs, n_reps = 5, 3
+    # CVs equal to the NRRP: the mean CV is the mean of the NRRPs in the simulated range
+    all_cvs = {
+        f"nrrp{i}": {"CV": np.full(n_pairs, float(i)), "JK_CV": np.full(n_pairs, -float(i))}
+        for i in range(1, 4)
+    }
+    res = test_module.scan_lambdas(
+        all_cvs, [1, 3], n_pairs, n_reps=n_reps, rng=np.random.default_rng(1)
+    )
+
+    lambdas = np.arange(1, 3.1, 0.1)
+    nrrps = 1 + np.random.default_rng(1).poisson(
+        lambdas[:, np.newaxis, np.newaxis] - 1, size=(len(lambdas), n_reps, n_pairs)
+    )
+    assert len(res[0]) == len(res[1]) == len(res[2]) == len(lambdas) * n_reps
+    assert_array_equal(res[0], nrrps.mean(axis=2).ravel())
+    assert_allclose(res[1], np.clip(nrrps, 1, 3).mean(axis=2).ravel())
+    assert_allclose(res[2], -res[1])
+    assert_array_equal(res[0][:n_reps], [1, 1, 1])
 
 
 def test__flatten_cvs():
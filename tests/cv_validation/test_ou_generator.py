@@ -1,7 +1,8 @@
 from unittest.mock import patch
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal, assert_array_equal
+import pytest
+from numpy.testing import assert_allclose, assert_array_almost_equal, assert_array_equal
 
 import psp_validation.cv_validation.ou_generator as test_module
 
@@ -20,6 +21,18 @@ def test_add_ou_noise(mock_generator):
     assert_array_equal(res, traces + noise)
 
 
+def test_add_ou_noise_rng():
+    t = np.arange(0, 100, 0.1)
+    traces = np.full((2, len(t)), -50.0, dtype=np.float32)
+
+    res = test_module.add_ou_noise(t, traces.copy(), TEST_TAU, TEST_SIGMA, np.random.default_rng(0))
+    expected = traces + test_module.ou_noise(
+        traces.shape, t[1] - t[0], TEST_TAU, TEST_SIGMA, np.random.default_rng(0)
+    )
+    assert res.dtype == np.float32
+    assert_array_equal(res, expected)
+
+
 def test_ou_generator():
     t = np.arange(0, 1, 0.1)
 
@@ -43,3 +56,61 @@ def test_ou_generator():
         dtype=np.float32,
     )
     assert_array_almost_equal(res, expected)
+
+
+def test_ou_noise():
+    shape, dt = (3, 100), 0.1
+    res = test_module.ou_noise(shape, dt, TEST_TAU, TEST_SIGMA, np.random.default_rng(0), 0.5)
+    assert res.dtype == np.float32
+    assert res.shape == shape
+
+    # same recurrence as ou_generator, with the same random elements
+    random_element = np.random.default_rng(0).standard_normal((3, 99), dtype=np.float32)
+    random_element *= TEST_SIGMA * np.sqrt(2 * dt / TEST_TAU)
+    expected = np.full(shape, 0.5)
+    for i in range(1, shape[1]):
+        expected[:, i] = (
+            expected[:, i - 1]
+            + dt / TEST_TAU * (0.5 - expected[:, i - 1])
+            + random_element[:, i - 1]
+        )
+    assert_allclose(res, expected, atol=1e-6)
+
+    res = test_module.ou_noise(
+        shape, dt, TEST_TAU, TEST_SIGMA, np.random.default_rng(0), dtype=np.float64
+    )
+    assert res.dtype == np.float64
+
+    with pytest.raises(ValueError, match="Unknown OU method"):
+        test_module.ou_noise(shape, dt, TEST_TAU, TEST_SIGMA, np.random.default_rng(0), method="a")
+
+
+def _stationary_stats(noise, dt, lag):
+    # drop the transient from the initial value (5 tau)
+    noise = noise[:, int(5 * TEST_TAU / dt) :].astype(np.float64)
+    centered = noise - noise.mean()
+    autocorrelation = np.mean(centered[:, lag:] * centered[:, :-lag]) / np.var(noise)
+    return noise.mean(), noise.var(), autocorrelation
+
+
+@pytest.mark.parametrize("method", test_module.OU_METHODS)
+def test_ou_noise_statistics(method):
+    n_traces, n_samples, dt = 200, 4000, 0.5
+    lag = int(TEST_TAU / dt)
+    t = np.arange(n_samples) * dt
+
+    np.random.seed(0)
+    reference = np.vstack(
+        [test_module.ou_generator(t, TEST_TAU, TEST_SIGMA) for _ in range(n_traces)]
+    )
+    res = test_module.ou_noise(
+        (n_traces, n_samples), dt, TEST_TAU, TEST_SIGMA, np.random.default_rng(0), method=method
+    )
+
+    expected_mean, expected_var, expected_autocorrelation = _stationary_stats(reference, dt, lag)
+    mean, var, autocorrelation = _stationary_stats(res, dt, lag)
+    assert abs(mean - expected_mean) < 0.1 * TEST_SIGMA
+    assert_allclose(var, expected_var, rtol=0.1)
+    assert_allclose(var, TEST_SIGMA**2, rtol=0.1)
+    assert_allclose(autocorrelation, expected_autocorrelation, atol=0.05)
+    assert_allclose(autocorrelation, np.exp(-lag * dt / TEST_TAU), atol=0.05)
@@ -1,5 +1,5 @@
 import logging
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from numpy.testing import assert_array_equal
@@ -38,7 +38,7 @@ def test_resolve_current_and_voltage(mock_resolve_current, protocol, clamp, expe
 
     if clamp == "current" and "hold_I" not in protocol:
         mock_resolve_current.assert_called_once_with(
-            protocol["hold_V"], post_gid, simulation_config, post_ttx
+            protocol["hold_V"], post_gid, simulation_config, post_ttx, None
         )
     else:
         mock_resolve_current.assert_not_called()
@@ -66,3 +66,22 @@ def test__resolve_holding_current(mock_get_holding_current, caplog):
         post_ttx=post_ttx,
     )
     assert res == "mock_current"
+
+
+@patch.object(test_module, "get_holding_current")
+def test__resolve_holding_current_cache(mock_get_holding_current):
+    mock_get_holding_current.return_value = 0.5
+    cache = MagicMock()
+    post_gid = simulation_config = post_ttx = None
+
+    cache.get.return_value = 0.25
+    res = test_module._resolve_holding_current(10, post_gid, simulation_config, post_ttx, cache)
+    assert res == pytest.approx(0.25)
+    mock_get_holding_current.assert_not_called()
+    cache.put.assert_not_called()
+
+    cache.get.return_value = None
+    res = test_module._resolve_holding_current(10, post_gid, simulation_config, post_ttx, cache)
+    assert res == pytest.approx(0.5)
+    mock_get_holding_current.assert_called_once()
+    cache.put.assert_called_once_with(post_gid, 10, post_ttx, 0.5)
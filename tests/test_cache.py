@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from bluepysnap.circuit_ids import CircuitNodeId
+from numpy.testing import assert_array_equal
+
+import psp_validation.cache as test_module
+from psp_validation import PSPError
+
+
+@pytest.fixture
+def simulation_config(tmp_path):
+    circuit_config = tmp_path / "circuit_config.json"
+    circuit_config.write_text(json.dumps({"networks": {"nodes": [], "edges": []}}))
+    simulation_config = tmp_path / "simulation_config.json"
+    simulation_config.write_text(
+        json.dumps(
+            {"network": str(circuit_config), "run": {"tstop": 100, "dt": 0.025, "random_seed": 0}}
+        )
+    )
+    return simulation_config
+
+
+def test_config_digest(simulation_config):
+    digest = test_module.config_digest(simulation_config)
+    assert digest == test_module.config_digest(simulation_config)
+
+    # a modification of the circuit config invalidates the digest
+    circuit_config = simulation_config.parent / "circuit_config.json"
+    circuit_config.write_text(json.dumps({"networks": {"nodes": [], "edges": []}, "x": 1}))
+    assert digest != test_module.config_digest(simulation_config)
+
+
+def test_HoldingCurrentCache(tmp_path, simulation_config):
+    post_gid = CircuitNodeId("pop", 42)
+    cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+
+    assert cache.get(post_gid, -70.0, post_ttx=False) is None
+    cache.put(post_gid, -70.0, post_ttx=False, hold_I=0.123)
+    assert cache.get(post_gid, -70.0, post_ttx=False) == pytest.approx(0.123)
+    assert cache.get(post_gid, -70.0, post_ttx=True) is None
+    assert cache.get(post_gid, -65.0, post_ttx=False) is None
+    assert cache.get(CircuitNodeId("pop", 43), -70.0, post_ttx=False) is None
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # entries are persisted
+    cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+    assert cache.get(post_gid, -70.0, post_ttx=False) == pytest.approx(0.123)
+
+
+def test_HoldingCurrentCache_mechanisms(tmp_path, simulation_config):
+    post_gid = CircuitNodeId("pop", 42)
+    cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+    cache.put(post_gid, -70.0, post_ttx=False, hold_I=0.123)
+
+    # the entries are invalidated by other mechanisms
+    library = tmp_path / "libnrnmech.so"
+    library.write_bytes(b"mechanisms")
+    with patch.dict(os.environ, {test_module.MOD_LIBRARY_PATH_VAR: str(library)}):
+        cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+        assert cache.get(post_gid, -70.0, post_ttx=False) is None
+        cache.put(post_gid, -70.0, post_ttx=False, hold_I=0.2)
+
+        # or by a rebuild of the same mechanisms
+        library.write_bytes(b"rebuilt mechanisms")
+        cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+        assert cache.get(post_gid, -70.0, post_ttx=False) is None
+
+    # or by another version of bluecellulab
+    with patch.object(test_module.importlib.metadata, "version", return_value="0.0.0"):
+        cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+        assert cache.get(post_gid, -70.0, post_ttx=False) is None
+
+    cache = test_module.HoldingCurrentCache(tmp_path / "cache", simulation_config)
+    assert cache.get(post_gid, -70.0, post_ttx=False) == pytest.approx(0.123)
+
+
+def test_NoiseBank(tmp_path):
+    t = np.arange(0, 50, 0.1)
+    protocol = {"tau": 2.0, "sigma": 0.5}
+    bank = test_module.NoiseBank(tmp_path / "cache")
+
+    noise = bank.get("pair", 42, 3, t, protocol)
+    assert noise.shape == (3, len(t))
+    assert noise.dtype == np.float32
+    assert isinstance(noise, np.memmap)
+    assert not noise.flags.writeable
+    assert_array_equal(noise[:, 0], 0)
+    assert (bank.hits, bank.misses) == (0, 1)
+
+    # the noise is read from the bank, for fewer trials too
+    assert_array_equal(bank.get("pair", 42, 2, t, protocol), noise)
+    assert (bank.hits, bank.misses) == (1, 1)
+
+    # more trials: the noise of the first trials is unchanged
+    more_noise = bank.get("pair", 42, 5, t, protocol)
+    assert more_noise.shape == (5, len(t))
+    assert_array_equal(more_noise[:3], noise)
+    assert (bank.hits, bank.misses) == (1, 2)
+    assert len(list((tmp_path / "cache" / test_module.NOISE).glob("*.npy"))) == 1
+
+    # the noise only depends on the base seed of the pair
+    assert_array_equal(bank.get("other", 42, 5, t, protocol), more_noise)
+
+    # the noise of other pairs, seeds, time steps or OU parameters is another entry
+    for args in [
+        ("pair", 43, 5, t, protocol),
+        ("pair", 42, 5, t[::2], protocol),
+        ("pair", 42, 5, t, {**protocol, "sigma": 1.0}),
+        ("pair", 42, 5, t, {**protocol, "ou_method": "exact"}),
+    ]:
+        assert not np.array_equal(bank.get(*args)[:, 1:3], more_noise[:, 1:3])
+    assert len(list((tmp_path / "cache" / test_module.NOISE).glob("*.npy"))) == 6
+
+    # entries are persisted, and reported by the cache info
+    bank = test_module.NoiseBank(tmp_path / "cache")
+    assert_array_equal(bank.get("pair", 42, 5, t, protocol), more_noise)
+    assert (bank.hits, bank.misses) == (1, 0)
+    assert test_module.get_cache_info(tmp_path / "cache")[test_module.NOISE]["entries"] == 6
+
+
+def test_cache_info_and_clear(tmp_path, simulation_config):
+    cache_dir = tmp_path / "cache"
+    cache = test_module.HoldingCurrentCache(cache_dir, simulation_config)
+    cache.put(CircuitNodeId("pop", 0), -70.0, post_ttx=False, hold_I=0.1)
+    cache.put(CircuitNodeId("pop", 1), -70.0, post_ttx=False, hold_I=0.2)
+
+    info = test_module.get_cache_info(cache_dir)
+    assert info[test_module.HOLDING_CURRENT]["entries"] == 2
+    assert info[test_module.HOLDING_CURRENT]["size"] > 0
+
+    test_module.clear_cache(cache_dir)
+    assert test_module.get_cache_info(cache_dir)[test_module.HOLDING_CURRENT]["entries"] == 0
+    assert cache.get(CircuitNodeId("pop", 0), -70.0, post_ttx=False) is None
+
+
+def _trial(base_seed=0, **kwargs):
+    return {
+        "pre_gid": CircuitNodeId("pop", 1),
+        "post_gid": CircuitNodeId("pop", 2),
+        "t_stim": 800.0,
+        "hold_I": 0.1,
+        "base_seed": base_seed,
+        **kwargs,
+    }
+
+
+def _result(seed=0, n_points=1000):
+    rng = np.random.default_rng(seed)
+    return {"e_AMPA": 0.0}, np.arange(n_points) * 0.1, 0.1, rng.normal(size=n_points)
+
+
+def test_SimulationCache(tmp_path, simulation_config):
+    cache = test_module.SimulationCache(tmp_path / "cache", simulation_config)
+
+    assert cache.get(_trial()) is None
+    cache.put(_trial(), _result())
+    params, time, current, voltage = cache.get(_trial())
+    assert params == {"e_AMPA": 0.0}
+    assert_array_equal(time, _result()[1])
+    assert current == pytest.approx(0.1)
+    assert_array_equal(voltage, _result()[3])
+
+    assert cache.get(_trial(base_seed=1)) is None
+    assert cache.get(_trial(t_stim=[800.0, 900.0])) is None
+    assert cache.get(_trial(post_gid=CircuitNodeId("pop", np.int64(3)))) is None
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # voltage clamp: the current is an array
+    cache.put(_trial(hold_I=None), (*_result()[:2], np.ones(1000), _result()[3]))
+    assert_array_equal(cache.get(_trial(hold_I=None))[2], np.ones(1000))
+
+    # entries are persisted, and invalidated by the mechanisms
+    cache = test_module.SimulationCache(tmp_path / "cache", simulation_config)
+    assert cache.get(_trial()) is not None
+    with patch.dict(os.environ, {test_module.MOD_LIBRARY_PATH_VAR: str(tmp_path)}):
+        cache = test_module.SimulationCache(tmp_path / "cache", simulation_config)
+        assert cache.get(_trial()) is None
+
+
+def test_SimulationCache_background(tmp_path, simulation_config):
+    with test_module.SimulationCache(
+        tmp_path / "cache", simulation_config, background=True
+    ) as cache:
+        for seed in range(3):
+            cache.put(_trial(seed), _result(seed))
+
+    # the pending entries are written when the cache is closed
+    for seed in range(3):
+        assert_array_equal(cache.get(_trial(seed))[3], _result(seed)[3])
+
+    # the errors of the background thread are raised again
+    cache = test_module.SimulationCache(tmp_path / "cache", simulation_config, background=True)
+    with patch.object(cache, "_write", side_effect=OSError("disk full")):
+        cache.put(_trial(), _result())
+        with pytest.raises(PSPError, match="Could not write to the simulation cache"):
+            cache.close()
+
+
+def test_SimulationCache_max_size(tmp_path, simulation_config):
+    cache_dir = tmp_path / "cache"
+    cache = test_module.SimulationCache(cache_dir, simulation_config)
+    cache.put(_trial(0), _result(0))
+    entry_size = test_module.get_cache_info(cache_dir)[test_module.SIMULATION]["size"]
+
+    # room for 3 entries
+    cache = test_module.SimulationCache(
+        cache_dir, simulation_config, max_size=3.5 * entry_size / 1024**2
+    )
+    for seed in range(1, 5):
+        cache.put(_trial(seed), _result(seed))
+        # the first entry is used again, the second one is the least recently used
+        time.sleep(0.01)
+        assert cache.get(_trial(0)) is not None
+
+    info = test_module.get_cache_info(cache_dir)[test_module.SIMULATION]
+    assert info["entries"] == 3
+    assert [cache.get(_trial(seed)) is not None for seed in range(5)] == [
+        True,
+        False,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_prune_cache(tmp_path, simulation_config):
+    cache_dir = tmp_path / "cache"
+    cache = test_module.SimulationCache(cache_dir, simulation_config, max_size=None)
+    for seed in range(5):
+        cache.put(_trial(seed), _result(seed))
+        time.sleep(0.01)
+    holding_current_cache = test_module.HoldingCurrentCache(cache_dir, simulation_config)
+    holding_current_cache.put(CircuitNodeId("pop", 0), -70.0, post_ttx=False, hold_I=0.1)
+    size = test_module.get_cache_info(cache_dir)[test_module.SIMULATION]["size"]
+
+    removed, freed = test_module.prune_cache(cache_dir, 0.5 * size / 1024**2)
+
+    assert removed == 3
+    assert freed > 0.5 * size
+    assert [cache.get(_trial(seed)) is not None for seed in range(5)] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+    # other sections are kept
+    assert test_module.get_cache_info(cache_dir)[test_module.HOLDING_CURRENT]["entries"] == 1
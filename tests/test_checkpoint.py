@@ -0,0 +1,68 @@
+import os
+import signal
+
+import pytest
+
+import psp_validation.checkpoint as test_module
+from psp_validation import PSPError
+
+HEADER = {"pathway": "pathway", "run": {"seed": 0}, "pairs": [[["pre", 1], ["post", 2]]]}
+
+
+def test_CheckpointWriter(tmp_path):
+    path = tmp_path / "pathway.checkpoint.jsonl"
+    with test_module.CheckpointWriter(path, HEADER) as checkpoint:
+        checkpoint.write({"index": 0, "amplitude": float("nan")})
+        checkpoint.write({"index": 1, "amplitude": 1.5})
+
+    header, records = test_module.load_checkpoint(path)
+    assert header == {**HEADER, "version": test_module.CHECKPOINT_VERSION}
+    assert [record["index"] for record in records] == [0, 1]
+
+    # the records kept are written again, the other ones are dropped
+    with test_module.CheckpointWriter(path, HEADER, records[1:]) as checkpoint:
+        checkpoint.write({"index": 2, "amplitude": 2.5})
+    _, records = test_module.load_checkpoint(path)
+    assert records == [{"index": 1, "amplitude": 1.5}, {"index": 2, "amplitude": 2.5}]
+
+
+def test_load_checkpoint_partial_record(tmp_path):
+    path = tmp_path / "pathway.checkpoint.jsonl"
+    with test_module.CheckpointWriter(path, HEADER) as checkpoint:
+        checkpoint.write({"index": 0})
+    with path.open("a") as f:
+        f.write('{"index": 1, "ampl')
+
+    _, records = test_module.load_checkpoint(path)
+    assert records == [{"index": 0}]
+
+    with path.open("a") as f:
+        f.write('\n{"index": 2}\n')
+    with pytest.raises(PSPError, match="line 3"):
+        test_module.load_checkpoint(path)
+
+
+def test_load_checkpoint_invalid(tmp_path):
+    path = tmp_path / "pathway.checkpoint.jsonl"
+    path.write_text("")
+    with pytest.raises(PSPError, match="Invalid checkpoint"):
+        test_module.load_checkpoint(path)
+
+    path.write_text('{"version": "0.1"}\n')
+    with pytest.raises(PSPError, match=r"Unsupported checkpoint version: 0\.1"):
+        test_module.load_checkpoint(path)
+
+
+def _terminate():
+    os.kill(os.getpid(), signal.SIGTERM)
+    # raised in the main thread when the handler is run
+    signal.pause()
+
+
+def test_handle_sigterm():
+    previous = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(test_module.Terminated) as exc_info, test_module.handle_sigterm():
+        _terminate()
+
+    assert exc_info.value.code == 128 + signal.SIGTERM
+    assert signal.getsignal(signal.SIGTERM) is previous
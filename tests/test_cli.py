@@ -1,9 +1,10 @@
 import os
+from unittest.mock import patch
 
 import pytest
 from click.testing import CliRunner
 
-from psp_validation.cli import plot, run
+from psp_validation.cli import cache, plot, run
 
 from tests.utils import PROJ12_ACCESS, TEST_DATA_DIR_PSP
 
@@ -53,3 +54,69 @@ def test_plot_cli(tmp_path):
 
     assert os.listdir(tmp_path) == ["small-traces"]
     assert os.listdir(tmp_path / "small-traces") == ["All-11085-All-10126.png"]
+
+
+def test_cache_prune_cli(tmp_path):
+    (tmp_path / "simulation").mkdir()
+    for name in ["a", "b"]:
+        (tmp_path / "simulation" / f"{name}.npz").write_bytes(bytes(1024**2))
+
+    runner = CliRunner()
+    result = runner.invoke(cache, ["prune", str(tmp_path), "--max-size", "1.5"])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == "Removed 1 entries (1.0 MB)\n"
+    assert len(list((tmp_path / "simulation").iterdir())) == 1
+
+
+def _run_shard(tmp_path, shard, *extra_args):
+    args = [
+        "-c",
+        str(DATA / "simulation_config.json"),
+        "-o",
+        str(tmp_path),
+        "-t",
+        str(DATA / "usecases/hippocampus/targets.yaml"),
+        "-e",
+        "default",
+        "-n",
+        "1",
+        "-r",
+        "1",
+        str(DATA / "usecases/hippocampus/pathways/SP_PVBC-SP_PC.yaml"),
+    ]
+    if shard is not None:
+        args += ["--shard", shard]
+    args += extra_args
+
+    with patch("psp_validation.psp.run") as mock_run:
+        result = CliRunner().invoke(run, args)
+    return result, mock_run
+
+
+@pytest.mark.parametrize(("shard", "expected"), [(None, None), ("0/4", (0, 4)), ("3/4", (3, 4))])
+def test_run_shard(tmp_path, shard, expected):
+    result, mock_run = _run_shard(tmp_path, shard)
+
+    assert result.exit_code == 0, result.output
+    mock_run.assert_called_once()
+    assert mock_run.call_args.args[21] == expected
+
+
+@pytest.mark.parametrize("shard", ["4/4", "-1/4", "1", "a/4"])
+def test_run_shard_invalid(tmp_path, shard):
+    result, mock_run = _run_shard(tmp_path, shard)
+
+    assert result.exit_code == 2
+    assert "Invalid value for '--shard'" in result.output
+    mock_run.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    ("extra_args", "expected"), [((), True), (("--no-cache-holding-currents",), False)]
+)
+def test_run_cache_holding_currents(tmp_path, extra_args, expected):
+    result, mock_run = _run_shard(tmp_path, None, *extra_args)
+
+    assert result.exit_code == 0, result.output
+    assert mock_run.call_args.args[-1] is expected
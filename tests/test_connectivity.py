@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from bluepysnap import Circuit
+from numpy.testing import assert_allclose, assert_array_equal
+
+import psp_validation.connectivity as test_module
+from psp_validation.pathways import ConnectionFilter, get_pairs
+
+from tests.utils import create_test_circuit
+
+PRE = {"mtype": "A"}
+POST = {"mtype": "B"}
+
+
+@pytest.fixture
+def edge_population(tmp_path):
+    return Circuit(create_test_circuit(tmp_path)).edges["default"]
+
+
+def test_ConnectivityTable_from_edge_population(edge_population):
+    table = test_module.ConnectivityTable.from_edge_population(edge_population, PRE, POST)
+
+    expected = sorted(
+        (pre.id, post.id, nsyn)
+        for pre, post, nsyn in edge_population.iter_connections(PRE, POST, return_edge_count=True)
+    )
+    assert sorted(zip(table.pre_ids, table.post_ids, table.nsyn, strict=True)) == expected
+
+    positions = edge_population.source.positions().to_numpy()
+    assert_allclose(
+        table.delta, np.abs(positions[table.pre_ids] - positions[table.post_ids]), rtol=1e-6
+    )
+
+
+def test_ConnectivityTable_save_load(tmp_path, edge_population):
+    table = test_module.ConnectivityTable.from_edge_population(edge_population, PRE, POST)
+    table.save(tmp_path / "table.h5")
+    loaded = test_module.ConnectivityTable.load(tmp_path / "table.h5")
+
+    assert (loaded.source, loaded.target) == (table.source, table.target)
+    for name in ["pre_ids", "post_ids", "nsyn", "delta"]:
+        assert_array_equal(getattr(loaded, name), getattr(table, name))
+
+
+def test_get_connectivity_table(tmp_path, edge_population):
+    cache_dir = tmp_path / "cache"
+    table = test_module.get_connectivity_table(cache_dir, edge_population, PRE, POST)
+    assert len(list((cache_dir / test_module.CONNECTIVITY).glob("*.h5"))) == 1
+
+    cached = test_module.get_connectivity_table(cache_dir, edge_population, PRE, POST)
+    assert_array_equal(cached.pre_ids, table.pre_ids)
+
+    # another pathway gets another table
+    test_module.get_connectivity_table(cache_dir, edge_population, POST, PRE)
+    assert len(list((cache_dir / test_module.CONNECTIVITY).glob("*.h5"))) == 2
+
+
+@pytest.mark.parametrize(
+    "constraints",
+    [{}, {"min_nsyn": 2}, {"max_dist_x": 40, "max_dist_z": 40}, {"unique_gids": True}],
+)
+def test_ConnectivityTable_sample(edge_population, constraints):
+    table = test_module.ConnectivityTable.from_edge_population(edge_population, PRE, POST)
+    connection_filter = ConnectionFilter(edge_population, **constraints)
+    expected = {
+        connection[:2]
+        for connection in edge_population.iter_connections(PRE, POST, return_edge_count=True)
+        if ConnectionFilter(edge_population, **constraints)(connection)
+    }
+
+    np.random.seed(0)
+    pairs = table.sample(5, connection_filter)
+
+    assert len(pairs) == 5
+    assert len(set(pairs)) == 5
+    assert set(pairs) <= expected
+    if constraints.get("unique_gids"):
+        gids = [gid for pair in pairs for gid in pair]
+        assert len(set(gids)) == len(gids)
+
+    np.random.seed(0)
+    assert table.sample(5, ConnectionFilter(edge_population, **constraints)) == pairs
+
+
+def test_get_pairs_cache_dir(tmp_path, edge_population):
+    np.random.seed(0)
+    pairs = get_pairs(edge_population, PRE, POST, 1000, cache_dir=tmp_path)
+    expected = {connection[:2] for connection in edge_population.iter_connections(PRE, POST)}
+    assert set(pairs) == expected
@@ -0,0 +1,432 @@
+import collections
+import importlib.util
+import os
+import pickle  # noqa: S403 only used by the fake MPI communicator
+import shutil
+import subprocess  # noqa: S404 used to run mpirun
+import sys
+import textwrap
+import threading
+import time
+import types
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+import pytest
+
+import psp_validation.executors as test_module
+from psp_validation import PSPError
+from psp_validation.utils import isolate
+
+
+def _square(x):
+    return x * x
+
+
+def _get_pid(*_):
+    return os.getpid()
+
+
+def _raise(message):
+    raise ValueError(message)
+
+
+def _die():
+    os._exit(3)
+
+
+def _square_isolated(x):
+    # runs in a child process of the worker, like `bluecellulab.tools.holding_current`
+    return isolate(_square)(x)
+
+
+def _get_initialized():
+    return _INITIALIZED.get("value")
+
+
+_INITIALIZED = {}
+
+
+def _initialize(value):
+    _INITIALIZED["value"] = value
+
+
+@pytest.mark.parametrize(("n_jobs", "expected"), [(None, 1), (3, 3), (0, os.cpu_count())])
+def test_get_n_workers(n_jobs, expected):
+    assert test_module.get_n_workers(n_jobs) == expected
+
+
+def test_get_rss():
+    assert test_module.get_rss() > 0
+
+
+def test_WorkerPool_map():
+    with test_module.WorkerPool(2, max_rss=None) as pool:
+        assert pool.n_workers == 2
+        assert pool.map(_square, range(10)) == [x * x for x in range(10)]
+
+
+def test_WorkerPool_workers_are_reused():
+    with test_module.WorkerPool(1, max_rss=None) as pool:
+        pids = pool.map(_get_pid, range(5))
+
+    assert len(set(pids)) == 1
+    assert pids[0] != os.getpid()
+
+
+def test_WorkerPool_workers_are_recycled():
+    # any worker is above the RSS ceiling after its first task
+    with test_module.WorkerPool(1, max_rss=1e-3) as pool:
+        pids = pool.map(_get_pid, range(3))
+        assert pool.n_workers == 1
+
+    assert len(set(pids)) == 3
+
+
+def test_WorkerPool_initializer():
+    with test_module.WorkerPool(1, initializer=_initialize, initargs=("done",)) as pool:
+        assert pool.submit(_get_initialized).result() == "done"
+
+
+def test_WorkerPool_exception():
+    with test_module.WorkerPool(1, max_rss=None) as pool:
+        with pytest.raises(ValueError, match="from worker"):
+            pool.submit(_raise, "from worker").result()
+
+        # the worker is still usable
+        assert pool.submit(_square, 3).result() == 9
+
+
+def test_WorkerPool_worker_lost():
+    with test_module.WorkerPool(1, max_rss=None) as pool:
+        with pytest.raises(test_module.WorkerLostError, match="exit code: 3"):
+            pool.submit(_die).result()
+
+        # the dead worker has been replaced
+        assert pool.submit(_square, 3).result() == 9
+
+
+def test_WorkerPool_workers_lost():
+    # the tasks of the workers dying as soon as they get them are failed, not lost
+    with test_module.WorkerPool(2, max_rss=None) as pool:
+        futures = [pool.submit(_die) for _ in range(6)]
+        for future in futures:
+            with pytest.raises(test_module.WorkerLostError):
+                future.result(timeout=60)
+
+        assert pool.map(_square, range(4)) == [0, 1, 4, 9]
+        assert pool.n_workers == 2
+
+
+def test_WorkerPool_task_with_child_process():
+    with test_module.WorkerPool(2, max_rss=None) as pool:
+        assert pool.map(_square_isolated, range(4)) == [0, 1, 4, 9]
+        workers = list(pool._workers.values())
+
+    # the workers are reaped on shutdown
+    assert [worker.exitcode for worker in workers] == [0, 0]
+
+
+def test_WorkerPool_shutdown_without_waiting():
+    pool = test_module.WorkerPool(1, max_rss=None)
+    running = pool.submit(time.sleep, 60)
+    pending = pool.submit(_square, 2)
+    while not running.running():
+        time.sleep(0.01)
+    workers = list(pool._workers.values())
+    pool.shutdown(wait=False)
+
+    assert pending.cancelled()
+    # the workers are terminated and reaped
+    assert all(worker.exitcode is not None for worker in workers)
+
+
+def test_WorkerPool_submit_after_shutdown():
+    pool = test_module.WorkerPool(1)
+    pool.shutdown()
+
+    with pytest.raises(RuntimeError, match="Cannot submit tasks after shutdown"):
+        pool.submit(_square, 3)
+
+
+def _done(result=None, exception=None):
+    future = Future()
+    if exception is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exception)
+    return future
+
+
+def test_chain():
+    assert test_module.chain(_done(3), _square).result() == 9
+    assert test_module.chain(_done(3), lambda x: _done(x + 1)).result() == 4
+
+    with pytest.raises(ValueError, match="from func"):
+        test_module.chain(_done("from func"), _raise).result()
+
+    with pytest.raises(ValueError, match="from future"):
+        test_module.chain(_done(exception=ValueError("from future")), _square).result()
+
+
+def test_chain_pending():
+    future = Future()
+    chained = test_module.chain(future, _square)
+    assert not chained.done()
+
+    future.set_result(4)
+    assert chained.result() == 16
+
+
+def test_gather():
+    assert test_module.gather([]).result() == []
+    assert test_module.gather([_done(1), _done(2)]).result() == [1, 2]
+
+    pending = Future()
+    gathered = test_module.gather([pending, _done(exception=ValueError("gathered"))])
+    with pytest.raises(ValueError, match="gathered"):
+        gathered.result()
+
+
+def test_chain_gather_with_pool():
+    with test_module.WorkerPool(2, max_rss=None) as pool:
+        future = test_module.chain(
+            pool.submit(_square, 2),
+            lambda x: test_module.gather(pool.submit(_square, y) for y in range(x)),
+        )
+        assert future.result() == [0, 1, 4, 9]
+
+
+def test_worker_pool():
+    with test_module.worker_pool("local", 2, max_rss=None) as pool:
+        assert isinstance(pool, test_module.WorkerPool)
+        assert pool.map(_square, range(3)) == [0, 1, 4]
+
+    with pytest.raises(PSPError, match="Unknown backend"), test_module.worker_pool("unknown"):
+        pass
+
+
+def test_BasePool_abstract():
+    class IncompletePool(test_module.BasePool):
+        n_workers = 1
+
+    with pytest.raises(TypeError, match="abstract"):
+        IncompletePool()
+
+
+@pytest.mark.parametrize("backend", ["serial", "thread", "process", "loky", "local"])
+def test_worker_pool_backends(backend, monkeypatch, caplog):
+    # the serial and thread backends initialize the current process
+    monkeypatch.setattr(sys.modules[__name__], "_INITIALIZED", {})
+    caplog.set_level("INFO", logger=test_module.L.name)
+
+    with test_module.worker_pool(
+        backend, 2, max_rss=None, initializer=_initialize, initargs=(backend,)
+    ) as pool:
+        assert isinstance(pool, test_module.BasePool)
+        assert pool.n_workers == (1 if backend == "serial" else 2)
+        assert pool.map(_square, range(5)) == [0, 1, 4, 9, 16]
+        assert sorted(pool.map_as_completed(_square, range(5))) == [
+            (0, 0),
+            (1, 1),
+            (2, 4),
+            (3, 9),
+            (4, 16),
+        ]
+        assert pool.submit(_get_initialized).result() == backend
+
+        future = pool.submit(_raise, "boom")
+        with pytest.raises(ValueError, match="boom"):
+            future.result()
+
+    assert pool.stats.count == 12
+    assert 0 < pool.stats.max <= pool.stats.total
+    assert f"{backend} backend: 12 task(s)" in caplog.text
+
+
+def test_ExecutorPool_shutdown_without_waiting():
+    executor = test_module.ThreadPoolExecutor(1)
+    pool = test_module.ExecutorPool(executor, 1)
+    futures = [pool.submit(time.sleep, 0.2) for _ in range(3)]
+    pool.shutdown(wait=False)
+    executor.shutdown(wait=True)
+
+    # the running task is done, the pending ones are cancelled
+    assert [future.cancelled() for future in futures] == [False, True, True]
+    assert pool.stats.count == 1
+
+
+def test_ExecutorPool_cancel():
+    with test_module.ExecutorPool(test_module.ThreadPoolExecutor(1), 1) as pool:
+        running = pool.submit(time.sleep, 0.2)
+        pending = pool.submit(_square, 2)
+        assert pending.cancel()
+
+    assert running.result() is None
+    assert pending.cancelled()
+    assert pool.stats.count == 1
+
+
+def test_SerialPool():
+    pool = test_module.SerialPool()
+    future = pool.submit(_square, 3)
+    assert future.done()
+    assert future.result() == 9
+
+    pool.shutdown()
+    with pytest.raises(RuntimeError, match="after shutdown"):
+        pool.submit(_square, 1)
+
+
+def test_worker_pool_mpi_without_mpi4py(monkeypatch):
+    monkeypatch.setitem(sys.modules, "mpi4py", None)
+    with pytest.raises(PSPError, match="requires mpi4py"), test_module.worker_pool("mpi"):
+        pass
+
+
+class _FakeMPI:
+    """The parts of `mpi4py.MPI` used by the executors."""
+
+    ANY_SOURCE = -1
+    ANY_TAG = -1
+
+    class Status:
+        source = None
+        tag = None
+
+        def Get_source(self):
+            return self.source
+
+        def Get_tag(self):
+            return self.tag
+
+
+class _FakeComm:
+    """Communicator between ranks run by threads of the current process."""
+
+    def __init__(self, rank, mailboxes, condition):
+        self.rank = rank
+        self._mailboxes = mailboxes
+        self._condition = condition
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return len(self._mailboxes)
+
+    def send(self, obj, dest, tag):
+        with self._condition:
+            self._mailboxes[dest].append((self.rank, tag, pickle.dumps(obj)))
+            self._condition.notify_all()
+
+    def _find(self, source, tag, status):
+        for message in self._mailboxes[self.rank]:
+            if source in {_FakeMPI.ANY_SOURCE, message[0]} and tag in {
+                _FakeMPI.ANY_TAG,
+                message[1],
+            }:
+                if status is not None:
+                    status.source, status.tag = message[:2]
+                return message
+        return None
+
+    def recv(self, source, tag, status=None):
+        with self._condition:
+            while (message := self._find(source, tag, status)) is None:
+                self._condition.wait()
+            self._mailboxes[self.rank].remove(message)
+        return pickle.loads(message[2])  # noqa: S301 sent by the test
+
+    def iprobe(self, source, tag, status=None):
+        with self._condition:
+            return self._find(source, tag, status) is not None
+
+
+@pytest.fixture
+def fake_comms(monkeypatch):
+    """Communicators of 3 fake MPI ranks.
+
+    Yields:
+        the communicators, the ones of the ranks 1 and 2 being used by `_mpi_worker` in threads
+    """
+    monkeypatch.setitem(sys.modules, "mpi4py", types.SimpleNamespace(MPI=_FakeMPI))
+    # signal handlers can only be set in the main thread
+    monkeypatch.setattr(test_module, "signal", MagicMock())
+
+    mailboxes = [collections.deque() for _ in range(3)]
+    condition = threading.Condition()
+    comms = [_FakeComm(rank, mailboxes, condition) for rank in range(3)]
+    workers = [
+        threading.Thread(target=test_module._mpi_worker, args=(comm, _initialize, ("mpi",)))
+        for comm in comms[1:]
+    ]
+    for worker in workers:
+        worker.start()
+
+    yield comms
+
+    for worker in workers:
+        worker.join(timeout=10)
+        assert not worker.is_alive()
+
+
+def test_MPIPool(fake_comms):
+    with test_module.MPIPool(fake_comms[0]) as pool:
+        assert pool.n_workers == 2
+        assert pool.map(_square, range(10)) == [x * x for x in range(10)]
+        assert pool.submit(_get_initialized).result() == "mpi"
+
+        future = pool.submit(_raise, "boom")
+        with pytest.raises(ValueError, match="boom"):
+            future.result()
+
+    with pytest.raises(RuntimeError, match="after shutdown"):
+        pool.submit(_square, 1)
+
+
+def test_MPIPool_shutdown_without_waiting(fake_comms):
+    pool = test_module.MPIPool(fake_comms[0])
+    futures = [pool.submit(time.sleep, 0.2) for _ in range(4)]
+    pool.shutdown(wait=False)
+
+    # the running tasks are waited for, the pending ones are cancelled
+    assert sum(future.cancelled() for future in futures) >= 2
+    assert all(future.done() for future in futures)
+
+
+def test_MPIPool_single_rank():
+    comm = MagicMock()
+    comm.Get_size.return_value = 1
+    with pytest.raises(PSPError, match="at least 2 ranks"):
+        test_module.MPIPool(comm)
+
+
+_MPI_SCRIPT = """
+    from psp_validation.executors import worker_pool
+
+    def square(x):
+        return x * x
+
+    with worker_pool("mpi") as pool:
+        if pool is not None:
+            assert pool.n_workers == 3
+            print(pool.map(square, range(10)))
+"""
+
+
+@pytest.mark.skipif(
+    shutil.which("mpirun") is None or not importlib.util.find_spec("mpi4py"),
+    reason="mpi4py or mpirun not available",
+)
+def test_worker_pool_mpi(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(textwrap.dedent(_MPI_SCRIPT))
+    result = subprocess.run(  # noqa: S603 (trusted input)
+        ["mpirun", "-n", "4", sys.executable, str(script)],  # noqa: S607 (mpirun in PATH)
+        capture_output=True,
+        check=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.stdout.strip() == str([x * x for x in range(10)])
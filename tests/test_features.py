@@ -1,5 +1,6 @@
 from unittest.mock import Mock, patch
 
+import h5py
 import numpy as np
 import pandas as pd
 import pytest
@@ -7,8 +8,7 @@ from numpy.testing import assert_allclose, assert_array_equal
 
 import psp_validation.features as test_module
 from psp_validation import PSPError
-from psp_validation.simulation import SimulationResult
-from psp_validation.trace_filters import NullFilter, SpikeFilter
+from psp_validation.trace_filters import AmplitudeFilter, NullFilter, SpikeFilter
 
 from tests.utils import TEST_DATA_DIR_PSP, mock_run_pair_simulation_suite
 
@@ -39,6 +39,11 @@ def test_get_peak_voltage_INH_with_timecut():
     assert peak == actual
 
 
+def test_get_peak_voltage_deprecated():
+    with pytest.warns(DeprecationWarning, match="get_peak_voltage is deprecated"):
+        test_module.get_peak_voltage(np.linspace(1, 10, 10), np.zeros(10), 0.0, "EXC")
+
+
 def test__check_syntype():
     test_module.check_syn_type("EXC")
     test_module.check_syn_type("INH")
@@ -118,13 +123,81 @@ def test_get_peak_amplitudes():
     assert_allclose(40.91181329374111, actual)
 
 
+def _load_small_traces():
+    with h5py.File(TEST_DATA_DIR_PSP / "small-traces.h5", "r") as h5f:
+        trials = h5f["traces/All_11085-All_10126/trials"][:]
+    return trials[:, 1], trials[:, 0]
+
+
+@pytest.mark.parametrize("t_stim", [0.32, 0.35, 0.5, 1.0, 1.05, 1.61, 2.0, 2.85])
+@pytest.mark.parametrize("syn_type", ["EXC", "INH"])
+@pytest.mark.parametrize("clamp", ["current", "voltage"])
+def test_get_peak_amplitudes_numpy_backend(t_stim, syn_type, clamp):
+    time, voltage = _load_small_traces()
+
+    expected = test_module.get_peak_amplitudes(time, voltage, t_stim, syn_type, clamp)
+    actual = test_module.get_peak_amplitudes(
+        time, voltage, t_stim, syn_type, clamp, backend="numpy"
+    )
+    assert_array_equal(actual, expected)
+
+    # the time can also be given once for all the traces
+    actual = test_module.get_peak_amplitudes(
+        time[0], voltage, t_stim, syn_type, clamp, backend="numpy"
+    )
+    assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_get_peak_amplitudes_numpy_backend_random(seed):
+    rng = np.random.default_rng(seed)
+    time = rng.uniform(0, 2) + rng.choice([0.025, 0.05, 0.1, 0.2, 0.0333]) * np.arange(400)
+    voltage = np.cumsum(rng.normal(size=(10, len(time))), axis=1) - 65
+    t_stim = rng.uniform(time[0] + 1, time[-1] - 1)
+
+    expected = test_module.get_peak_amplitudes(np.tile(time, (10, 1)), voltage, t_stim, "EXC")
+    actual = test_module.get_peak_amplitudes(time, voltage, t_stim, "EXC", backend="numpy")
+    assert_array_equal(actual, expected)
+
+
+def test_get_peak_amplitudes_numpy_backend_different_times():
+    time, voltage = _load_small_traces()
+    time[1] += 0.01
+
+    with pytest.raises(PSPError, match="share the same time"):
+        test_module.get_peak_amplitudes(time, voltage, 1.0, "EXC", backend="numpy")
+
+
+def test_get_peak_amplitudes_invalid_backend():
+    time, voltage = _load_small_traces()
+
+    with pytest.raises(PSPError, match="backend must be one of"):
+        test_module.get_peak_amplitudes(time, voltage, 1.0, "EXC", backend="invalid")
+
+
+def test_select_traces():
+    t = np.linspace(1, 10, 100)
+    vs = np.array([np.full(100, 10.0 * i) for i in range(6)])
+    vs[0] = np.nan
+    vs[1, 30:40] += 10  # perturbation
+    vs[3, 30:40] += 10  # perturbation, but spiking (filtered out by the spike filter first)
+
+    filters = [
+        NullFilter(),
+        SpikeFilter(0, 35),
+        AmplitudeFilter(t_stim=2, min_trace_amplitude=4, syn_type="EXC"),
+    ]
+    selected, rejected = test_module.select_traces(t, vs, filters)
+
+    assert_array_equal(selected, [False, True, False, False, False, False])
+    assert rejected == {"NullFilter": 1, "SpikeFilter": 3, "AmplitudeFilter": 1}
+
+
 def test_mean_pair_voltage_from_traces_no_filter():
     t = np.linspace(1, 10, 100)
     v = [np.full(100, 10.0 * i) for i in range(5)]  # 0, 10, 20, 30, 40 : mean is 20
-    results = SimulationResult({}, t, None, v)
-    traces = test_module.old_school_trace(results)
     filters = [NullFilter(), SpikeFilter(0, 100)]
-    mean = test_module.mean_pair_voltage_from_traces(traces, filters)
+    mean = test_module.mean_pair_voltage_from_traces(t, v, filters)
     assert np.all(mean[0] == 20.0)
     assert np.all(mean[1] == t)
     assert_array_equal(mean[2], v)
@@ -133,10 +206,8 @@ def test_mean_pair_voltage_from_traces_no_filter():
 def test_mean_pair_voltage_from_traces_filter():
     t = np.linspace(1, 10, 100)
     v = [np.full(100, 10.0 * i) for i in range(5)]  # 0, 10, 20, 30, 40 : mean is 20
-    results = SimulationResult({}, t, None, v)
-    traces = test_module.old_school_trace(results)
     filters = [NullFilter(), SpikeFilter(0, 25)]
-    mean = test_module.mean_pair_voltage_from_traces(traces, filters)
+    mean = test_module.mean_pair_voltage_from_traces(t, v, filters)
     assert np.all(mean[0] == 10.0)
     assert np.all(mean[1] == t)
     assert_array_equal(mean[2], v[:3])
@@ -145,10 +216,8 @@ def test_mean_pair_voltage_from_traces_filter():
 def test_mean_pair_voltage_from_traces_filter_all_returns_nan():
     t = np.linspace(1, 10, 100)
     v = [np.full(100, 10.0 * i) for i in range(5)]  # 0, 10, 20, 30, 40 : mean is 20
-    results = SimulationResult({}, t, None, v)
     filters = [NullFilter(), SpikeFilter(0, -5)]
-    traces = test_module.old_school_trace(results)
-    mean = test_module.mean_pair_voltage_from_traces(traces, filters)
+    mean = test_module.mean_pair_voltage_from_traces(t, v, filters)
     assert mean == (None, None, [])
 
 
@@ -189,6 +258,16 @@ def test_resting_potential_error():
         test_module.resting_potential(result.time, result.voltages[0], 1000, 1400)
 
 
+def test_relative_ci_width():
+    values = np.array([1.0, 2.0, 3.0, np.nan])
+    expected = 2 * test_module.Z_95 * 1.0 / np.sqrt(3) / 2.0
+    assert_allclose(test_module.relative_ci_width(values), expected)
+    assert_allclose(test_module.relative_ci_width(-values), expected)
+    assert test_module.relative_ci_width([2.0, 2.0]) == 0
+    assert test_module.relative_ci_width([2.0, np.nan]) == np.inf
+    assert test_module.relative_ci_width([-1.0, 1.0]) == np.inf
+
+
 def test_get_synapse_type():
     get = Mock()
     nodes = Mock(get=get, property_names=["synapse_class"])
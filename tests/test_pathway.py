@@ -1,16 +1,31 @@
+import itertools
 import os
+import threading
+from concurrent.futures import Future
 from unittest.mock import MagicMock, patch
 
+import attr
 import h5py
+import numpy as np
 import pandas as pd
+import pytest
+import yaml
+from bluepysnap import Circuit
 from bluepysnap.circuit_ids import CircuitNodeId
 from numpy.testing import assert_allclose, assert_array_equal
 
 import psp_validation.pathways as test_module
-from psp_validation.psp import ProtocolParameters
+from psp_validation.checkpoint import CheckpointWriter, Terminated, load_checkpoint
+from psp_validation.persistencyutils import TraceWriter, iter_pair_traces
+from psp_validation.psp import ProtocolParameters, run_pathways
 from psp_validation.trace_filters import SpikeFilter
 
-from tests.utils import TEST_DATA_DIR_PSP, mock_run_pair_simulation_suite
+from tests.utils import (
+    TEST_DATA_DIR_PSP,
+    create_test_circuit,
+    mock_run_pair_simulation_suite,
+    mock_submit_pair_simulation_suite,
+)
 
 _PATHWAY_PATH = TEST_DATA_DIR_PSP / "pathway.yaml"
 
@@ -35,13 +50,17 @@ def _default_protocol(**kwargs):
 @patch.object(test_module, "get_synapse_type", new=MagicMock(return_value="EXC"))
 def _dummy_pathway(protocol_kwargs):
     protocol = _default_protocol(**protocol_kwargs)
-    sim_runner = MagicMock(return_value=mock_run_pair_simulation_suite())
+    sim_runner = MagicMock(side_effect=mock_submit_pair_simulation_suite)
     pathway = test_module.Pathway(
         _PATHWAY_PATH, sim_runner, protocol, "hippocampus_neurons__hippocampus_neurons__chemical"
     )
-    pathway.pairs = [
-        (CircuitNodeId(id=1, population="population"), CircuitNodeId(id=2, population="population"))
-    ]
+    if not protocol.resume:
+        pathway.pairs = [
+            (
+                CircuitNodeId(id=1, population="population"),
+                CircuitNodeId(id=2, population="population"),
+            )
+        ]
     pathway.pre_syn_type = "EXC"
     pathway.min_ampl = 12.3
     pathway.t_stim = 199.0
@@ -51,45 +70,47 @@ def _dummy_pathway(protocol_kwargs):
 
 def test__init_traces_dump_clamp_current(tmp_path):
     pathway = _dummy_pathway({"dump_traces": False, "output_dir": tmp_path})
-    traces_path = pathway._init_traces_dump()
+    pathway._init_traces_dump().close()
 
-    with h5py.File(traces_path, "r") as h5f:
+    with h5py.File(tmp_path / "pathway.traces.h5", "r") as h5f:
         assert h5f.attrs["data"] == "voltage"
 
 
 def test__init_traces_dump_clamp_voltage(tmp_path):
     pathway = _dummy_pathway({"dump_traces": True, "output_dir": tmp_path, "clamp": "voltage"})
-    traces_path = pathway._init_traces_dump()
+    pathway._init_traces_dump().close()
 
-    with h5py.File(traces_path, "r") as h5f:
+    with h5py.File(tmp_path / "pathway.traces.h5", "r") as h5f:
         assert h5f.attrs["data"] == "current"
 
 
-def test__run_one_pair(tmp_path):
+def test__process_one_pair(tmp_path):
     all_amplitudes = []
 
     pathway = _dummy_pathway({"output_dir": tmp_path})
 
     h5_file = tmp_path / "dump.h5"
-    pathway._run_one_pair(
-        (
-            CircuitNodeId(id=1, population="population"),
-            CircuitNodeId(id=2, population="population"),
-        ),
-        all_amplitudes,
-        h5_file,
-    )
+    with TraceWriter(h5_file, "voltage") as trace_writer:
+        pathway._process_one_pair(
+            (
+                CircuitNodeId(id=1, population="population"),
+                CircuitNodeId(id=2, population="population"),
+            ),
+            mock_run_pair_simulation_suite(),
+            all_amplitudes,
+            trace_writer,
+        )
     assert_allclose(all_amplitudes, [94.0238021084036])
+    assert pathway.rejected_traces == {"SpikeFilter": 0}
 
     with h5py.File(h5_file, "r") as f:
-        assert "/traces/population_1-population_2" in f
-        group = f["/traces/population_1-population_2"]
-        assert group.attrs["pre_id"] == 1
-        assert group.attrs["pre_population"] == "population"
-        assert group.attrs["post_id"] == 2
-        assert group.attrs["post_population"] == "population"
-        assert "trials" in group
-        assert "average" in group
+        group = f["/traces"]
+        assert group["pairs/pre_id"][:] == [1]
+        assert group["pairs/pre_population"].asstr()[:] == ["population"]
+        assert group["pairs/post_id"][:] == [2]
+        assert group["pairs/post_population"].asstr()[:] == ["population"]
+        assert group["average"].shape == (1, *group["time"].shape)
+        assert group["trials"].shape == (1, 1, *group["time"].shape)
 
 
 def test__run_pathway_no_pairs(tmp_path):
@@ -109,11 +130,16 @@ def test__run_pathway_dump_trace(tmp_path):
 
     assert_array_equal(
         sorted(os.listdir(tmp_path)),
-        ["pathway.amplitudes.txt", "pathway.summary.yaml", "pathway.traces.h5"],
+        [
+            "pathway.amplitudes.txt",
+            "pathway.checkpoint.jsonl",
+            "pathway.summary.yaml",
+            "pathway.traces.h5",
+        ],
     )
     with h5py.File(tmp_path / "pathway.traces.h5", "r") as f:
         assert_array_equal(
-            list(f["traces"]["population_1-population_2"].keys()), ["average", "trials"]
+            list(f["traces"].keys()), ["average", "index", "pairs", "time", "trials"]
         )
 
 
@@ -121,7 +147,8 @@ def test__run_pathway_no_traces(tmp_path):
     pathway = _dummy_pathway({"dump_traces": False, "output_dir": tmp_path})
     pathway.run()
     assert_array_equal(
-        sorted(os.listdir(tmp_path)), ["pathway.amplitudes.txt", "pathway.summary.yaml"]
+        sorted(os.listdir(tmp_path)),
+        ["pathway.amplitudes.txt", "pathway.checkpoint.jsonl", "pathway.summary.yaml"],
     )
 
 
@@ -141,7 +168,10 @@ def test__get_reference_and_scaling(tmp_path):
         )
         pathway.config["protocol"]["hold_V"] = None
         # let's have 2 pairs so averaging of resting potential does something
-        pathway.pairs = [(1, 2), (3, 4)]
+        pathway.pairs = [
+            (CircuitNodeId("population", 1), CircuitNodeId("population", 2)),
+            (CircuitNodeId("population", 3), CircuitNodeId("population", 4)),
+        ]
         pathway.t_stim = 1200
         return pathway
 
@@ -152,3 +182,436 @@ def test__get_reference_and_scaling(tmp_path):
 
     reference, scaling = pathway._get_reference_and_scaling(model_mean, params)
     assert_allclose(scaling, 0.007170083739722974)
+
+
+def _mock_edge_population(n_nodes=20, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = pd.DataFrame(rng.uniform(0, 100, size=(n_nodes, 3)), columns=["x", "y", "z"])
+
+    def _node_population():
+        population = MagicMock()
+        population.positions.return_value = positions
+        population.get.side_effect = lambda gid, prop: positions.loc[gid.id, prop]
+        return population
+
+    edge_population = MagicMock()
+    edge_population.source = _node_population()
+    edge_population.target = _node_population()
+    return edge_population
+
+
+def _random_connections(n_nodes, n_connections, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        (
+            CircuitNodeId("population", pre),
+            CircuitNodeId("population", post),
+            nsyn,
+        )
+        for pre, post, nsyn in rng.integers(0, n_nodes, size=(n_connections, 3))
+    ]
+
+
+@pytest.mark.parametrize(
+    "constraints",
+    [
+        {},
+        {"min_nsyn": 5, "max_nsyn": 15},
+        {"max_dist_x": 30, "max_dist_z": 50},
+        {"unique_gids": True, "max_dist_y": 50, "min_nsyn": 3},
+    ],
+)
+def test_ConnectionFilter_filter(constraints):
+    connections = _random_connections(20, 200)
+
+    expected = list(
+        filter(test_module.ConnectionFilter(_mock_edge_population(), **constraints), connections)
+    )
+    connection_filter = test_module.ConnectionFilter(_mock_edge_population(), **constraints)
+    result = connection_filter.filter(connections[:77]) + connection_filter.filter(connections[77:])
+
+    assert result == expected
+
+
+def test_get_pairs_same_random_state():
+    connections = _random_connections(20, 200)
+    constraints = {"max_dist_x": 30, "max_dist_y": 30, "unique_gids": True}
+
+    def _iter_connections(*_, **__):
+        # consume random numbers while iterating, like the shuffled iteration of bluepysnap
+        for connection in connections:
+            np.random.random()
+            yield connection
+
+    edge_population = _mock_edge_population()
+    edge_population.iter_connections.side_effect = _iter_connections
+
+    np.random.seed(0)
+    connection_filter = test_module.ConnectionFilter(edge_population, **constraints)
+    expected = [c[:2] for c in itertools.islice(filter(connection_filter, _iter_connections()), 5)]
+    expected_state = np.random.random()
+
+    np.random.seed(0)
+    pairs = test_module.get_pairs(edge_population, "pre", "post", 5, constraints)
+
+    assert len(pairs) == 5
+    assert pairs == expected
+    assert np.random.random() == expected_state
+
+
+@pytest.mark.parametrize(
+    "constraints",
+    [{}, {"min_nsyn": 2}, {"max_dist_x": 40, "max_dist_z": 40}, {"unique_gids": True}],
+)
+def test_sample_pairs_from_edges(tmp_path, constraints):
+    edge_population = Circuit(create_test_circuit(tmp_path)).edges["default"]
+    pre, post = {"mtype": "A"}, {"mtype": "B"}
+    expected = {
+        connection[:2]
+        for connection in edge_population.iter_connections(pre, post, return_edge_count=True)
+        if test_module.ConnectionFilter(edge_population, **constraints)(connection)
+    }
+
+    np.random.seed(0)
+    pairs = test_module.sample_pairs_from_edges(
+        edge_population, pre, post, 5, test_module.ConnectionFilter(edge_population, **constraints)
+    )
+
+    assert len(pairs) == 5
+    assert len(set(pairs)) == 5
+    assert set(pairs) <= expected
+    if constraints.get("unique_gids"):
+        gids = [gid for pair in pairs for gid in pair]
+        assert len(set(gids)) == len(gids)
+
+
+def test_sample_pairs_from_edges_uniform(tmp_path):
+    edge_population = Circuit(create_test_circuit(tmp_path, n_nodes=10, n_edges=200)).edges[
+        "default"
+    ]
+    pre, post = {"mtype": "A"}, {"mtype": "B"}
+    connections = sorted(edge_population.iter_connections(pre, post))
+    n_samples = 50 * len(connections)
+
+    np.random.seed(0)
+    counts = dict.fromkeys(connections, 0)
+    for _ in range(n_samples):
+        [pair] = test_module.sample_pairs_from_edges(
+            edge_population, pre, post, 1, test_module.ConnectionFilter(edge_population)
+        )
+        counts[pair] += 1
+
+    # the synapse counts differ, but the connections must be drawn with the same probability:
+    # the chi-square statistic stays well below its mean + 5 standard deviations
+    expected = n_samples / len(connections)
+    chi2 = sum((count - expected) ** 2 / expected for count in counts.values())
+    df = len(connections) - 1
+    assert chi2 < df + 5 * np.sqrt(2 * df)
+
+
+def test_get_pairs_sample_edges_fallback(tmp_path):
+    edge_population = Circuit(create_test_circuit(tmp_path)).edges["default"]
+    pre, post = {"mtype": "A"}, {"mtype": "B"}
+    expected = {connection[:2] for connection in edge_population.iter_connections(pre, post)}
+
+    np.random.seed(0)
+    assert (
+        test_module.sample_pairs_from_edges(
+            edge_population, pre, post, 1000, test_module.ConnectionFilter(edge_population)
+        )
+        is None
+    )
+    pairs = test_module.get_pairs(edge_population, pre, post, 1000, sample_edges=True)
+    assert set(pairs) == expected
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+def test_reanalyze(tmp_path):
+    pathway = _dummy_pathway(
+        {"dump_traces": True, "dump_amplitudes": True, "output_dir": tmp_path / "run"}
+    )
+    pathway.config["protocol"]["t_stim"] = 199.0
+    pathway.config["spike_threshold"] = 100.0
+    pathway._init_analysis("EXC")
+    (tmp_path / "run").mkdir()
+    pathway.run()
+
+    pathway_path = tmp_path / "pathway.yaml"
+    pathway_path.write_text(yaml.safe_dump(pathway.config))
+    traces_path = tmp_path / "run" / "pathway.traces.h5"
+
+    def _reanalyze(output_dir):
+        output_dir.mkdir()
+        protocol = _default_protocol(output_dir=output_dir, dump_traces=False)
+        reanalyzed = test_module.Pathway.from_traces_dump(pathway_path, protocol, traces_path)
+        assert reanalyzed.pre_syn_type == "EXC"
+        reanalyzed.reanalyze(traces_path)
+        assert reanalyzed.pairs == pathway.pairs
+        return reanalyzed
+
+    _reanalyze(tmp_path / "reanalyzed")
+    for name in ["pathway.amplitudes.txt", "pathway.summary.yaml"]:
+        assert (tmp_path / "reanalyzed" / name).read_text() == (tmp_path / "run" / name).read_text()
+
+    # the thresholds of the pathway file are applied
+    pathway.config["spike_threshold"] = -20.0
+    pathway_path.write_text(yaml.safe_dump(pathway.config))
+    reanalyzed = _reanalyze(tmp_path / "spiking")
+    assert reanalyzed.rejected_traces == {"NullFilter": 0, "SpikeFilter": 1, "AmplitudeFilter": 0}
+    assert np.isnan(np.loadtxt(tmp_path / "spiking" / "pathway.amplitudes.txt"))
+    summary = (tmp_path / "spiking" / "pathway.summary.yaml").read_text()
+    assert "model:\n    mean: nan\n    std: nan\n" in summary
+
+
+def test_from_traces_dump_old_version():
+    with pytest.raises(test_module.PSPError, match="written by an older version"):
+        test_module.Pathway.from_traces_dump(
+            _PATHWAY_PATH, _default_protocol(), TEST_DATA_DIR_PSP / "small-traces.h5"
+        )
+
+
+def test_resume(tmp_path):
+    pairs = [
+        (CircuitNodeId("population", 1), CircuitNodeId("population", 2)),
+        (CircuitNodeId("population", 3), CircuitNodeId("population", 4)),
+    ]
+    protocol_kwargs = {"dump_traces": True, "output_dir": tmp_path, "run_params": {"seed": 0}}
+
+    # reference run
+    pathway = _dummy_pathway(protocol_kwargs)
+    pathway.pairs = pairs
+    pathway.run()
+    expected_amplitudes = (tmp_path / "pathway.amplitudes.txt").read_text()
+    expected_summary = (tmp_path / "pathway.summary.yaml").read_text()
+    (tmp_path / "pathway.amplitudes.txt").unlink()
+
+    # the run is terminated while the second pair is simulated
+    pathway = _dummy_pathway(protocol_kwargs)
+    pathway.pairs = pairs
+    terminated = Future()
+    terminated.set_exception(Terminated())
+    with pytest.raises(Terminated):
+        pathway.process([mock_submit_pair_simulation_suite(), terminated])
+    assert not (tmp_path / "pathway.amplitudes.txt").exists()
+    with h5py.File(tmp_path / "pathway.traces.h5", "r") as h5f:
+        assert len(h5f["traces/trials"]) == 1
+
+    pathway = _dummy_pathway({**protocol_kwargs, "resume": True})
+    assert pathway.pairs == pairs
+    assert list(pathway.completed) == [0]
+    assert pathway.pending_pairs == [1]
+    pathway.run()
+    assert pathway.sim_runner.call_count == 1
+    assert pathway.sim_runner.call_args.kwargs["pre_gid"] == pairs[1][0]
+    assert (tmp_path / "pathway.amplitudes.txt").read_text() == expected_amplitudes
+    assert (tmp_path / "pathway.summary.yaml").read_text() == expected_summary
+    with h5py.File(tmp_path / "pathway.traces.h5", "r") as h5f:
+        assert len(h5f["traces/trials"]) == 2
+
+    # all the pairs are completed
+    pathway = _dummy_pathway({**protocol_kwargs, "resume": True})
+    assert pathway.pending_pairs == []
+    pathway.run()
+    pathway.sim_runner.assert_not_called()
+    assert (tmp_path / "pathway.amplitudes.txt").read_text() == expected_amplitudes
+
+    # the pairs missing from the trace dump are simulated again
+    (tmp_path / "pathway.traces.h5").unlink()
+    pathway = _dummy_pathway({**protocol_kwargs, "resume": True})
+    assert pathway.pending_pairs == [0, 1]
+
+    with pytest.raises(test_module.PSPError, match="run with other parameters"):
+        _dummy_pathway({**protocol_kwargs, "resume": True, "run_params": {"seed": 1}})
+
+
+def test_run_pathways_writes_pairs_before_last_result(tmp_path):
+    pathway = _dummy_pathway({"dump_traces": True, "output_dir": tmp_path})
+    pathway.pairs = [
+        (CircuitNodeId("population", 1), CircuitNodeId("population", 2)),
+        (CircuitNodeId("population", 3), CircuitNodeId("population", 4)),
+    ]
+    events = []
+    last = Future()
+
+    def _resolve_last():
+        events.append("last result")
+        last.set_result(mock_run_pair_simulation_suite())
+
+    pathway.sim_runner.side_effect = [mock_submit_pair_simulation_suite(), last]
+    write_traces = test_module.BackgroundTraceWriter.write
+    write_record = CheckpointWriter.write
+
+    def _write_traces(self, *args, **kwargs):
+        events.append(f"traces {args[3].id}")
+        write_traces(self, *args, **kwargs)
+
+    def _write_record(self, record):
+        events.append(f"record {record['index']}")
+        write_record(self, record)
+
+    # the simulation of the second pair ends after a while
+    timer = threading.Timer(1.0, _resolve_last)
+    timer.start()
+    with (
+        patch.object(test_module.BackgroundTraceWriter, "write", new=_write_traces),
+        patch.object(CheckpointWriter, "write", new=_write_record),
+    ):
+        run_pathways([pathway])
+    timer.join()
+
+    # the first pair is processed without waiting for the second one
+    assert events == ["traces 1", "record 0", "last result", "traces 3", "record 1"]
+    assert (tmp_path / "pathway.summary.yaml").exists()
+
+
+def test_flush(tmp_path):
+    pathway = _dummy_pathway({"dump_traces": False, "output_dir": tmp_path})
+    pathway.pairs = [
+        (CircuitNodeId("population", 1), CircuitNodeId("population", 2)),
+        (CircuitNodeId("population", 3), CircuitNodeId("population", 4)),
+    ]
+    pathway.flush([Future(), mock_submit_pair_simulation_suite()])
+
+    assert list(pathway.completed) == [1]
+    assert not (tmp_path / "pathway.summary.yaml").exists()
+    header, records = load_checkpoint(tmp_path / "pathway.checkpoint.jsonl")
+    assert header["pairs"] == [
+        [["population", 1], ["population", 2]],
+        [["population", 3], ["population", 4]],
+    ]
+    assert [record["index"] for record in records] == [1]
+
+
+def test_shards(tmp_path):
+    pairs = [
+        (CircuitNodeId("population", 2 * k + 1), CircuitNodeId("population", 2 * k + 2))
+        for k in range(5)
+    ]
+
+    def _run(output_dir, shard=None):
+        pathway = _dummy_pathway({"dump_traces": True, "output_dir": output_dir, "shard": shard})
+        pathway.pairs = pairs
+        pathway.run()
+        return pathway
+
+    (tmp_path / "unsharded").mkdir()
+    _run(tmp_path / "unsharded")
+
+    (tmp_path / "shards").mkdir()
+    for index in range(2):
+        pathway = _run(tmp_path / "shards", shard=(index, 2))
+        assert sorted(pathway.completed) == list(range(index, 5, 2))
+    # only the checkpoints and trace dumps of the shards are written
+    assert sorted(path.name for path in (tmp_path / "shards").iterdir()) == [
+        "pathway.shard-0-of-2.checkpoint.jsonl",
+        "pathway.shard-0-of-2.traces.h5",
+        "pathway.shard-1-of-2.checkpoint.jsonl",
+        "pathway.shard-1-of-2.traces.h5",
+    ]
+
+    (tmp_path / "merged").mkdir()
+    protocol = _default_protocol(output_dir=tmp_path / "merged", dump_traces=False)
+    pathway = test_module.Pathway.from_shards(_PATHWAY_PATH, protocol, tmp_path / "shards")
+    assert pathway.pairs == pairs
+    assert pathway.protocol_params.dump_traces
+    pathway.merge()
+
+    for name in ["pathway.amplitudes.txt", "pathway.summary.yaml", "pathway.checkpoint.jsonl"]:
+        assert (tmp_path / "merged" / name).read_text() == (
+            tmp_path / "unsharded" / name
+        ).read_text()
+    with (
+        h5py.File(tmp_path / "merged" / "pathway.traces.h5", "r") as merged,
+        h5py.File(tmp_path / "unsharded" / "pathway.traces.h5", "r") as unsharded,
+    ):
+        for expected, actual in zip(
+            iter_pair_traces(unsharded), iter_pair_traces(merged), strict=True
+        ):
+            assert actual[:2] == expected[:2]
+            for expected_array, actual_array in zip(expected[2:], actual[2:], strict=True):
+                assert_array_equal(actual_array, expected_array)
+        assert len(merged["traces/trials"]) == len(pairs)
+
+    (tmp_path / "shards" / "pathway.shard-1-of-2.checkpoint.jsonl").unlink()
+    with pytest.raises(test_module.PSPError, match="Missing shards of 'pathway' pathway: 1/2"):
+        test_module.Pathway.from_shards(_PATHWAY_PATH, protocol, tmp_path / "shards")
+    with pytest.raises(test_module.PSPError, match="No shards"):
+        test_module.Pathway.from_shards(_PATHWAY_PATH, protocol, tmp_path)
+
+
+def test_shards_incomplete(tmp_path):
+    pathway = _dummy_pathway({"dump_traces": False, "output_dir": tmp_path, "shard": (0, 1)})
+    pathway.pairs = [
+        (CircuitNodeId("population", 1), CircuitNodeId("population", 2)),
+        (CircuitNodeId("population", 3), CircuitNodeId("population", 4)),
+    ]
+    pathway.flush([mock_submit_pair_simulation_suite(), Future()])
+
+    protocol = _default_protocol(output_dir=tmp_path)
+    with pytest.raises(test_module.PSPError, match=r"not complete \(1 out of 2 pairs\)"):
+        test_module.Pathway.from_shards(_PATHWAY_PATH, protocol, tmp_path)
+
+
+def _mock_submit_noisy_trials(first_trial=0, n_trials=1, **_):
+    """Submit `n_trials` trials whose PSP amplitudes vary with the seed."""
+    result = mock_run_pair_simulation_suite()
+    v_rest = result.voltages[0][0]
+    voltages = [
+        v_rest + (result.voltages[0] - v_rest) * (1 + 0.2 * np.sin(k))
+        for k in range(first_trial, first_trial + n_trials)
+    ]
+    future = Future()
+    future.set_result(attr.evolve(result, currents=voltages, voltages=voltages))
+    return future
+
+
+@pytest.mark.parametrize(
+    ("tolerance", "expected_batches"),
+    [
+        (1.0, [(0, 5)]),
+        (1e-6, [(0, 5), (5, 5), (10, 2)]),
+    ],
+)
+def test_submit_pair_adaptive_trials(tmp_path, tolerance, expected_batches):
+    pathway = _dummy_pathway(
+        {
+            "dump_traces": True,
+            "output_dir": tmp_path,
+            "adaptive_trials": test_module.AdaptiveTrials(tolerance=tolerance),
+        }
+    )
+    pathway.sim_runner.side_effect = _mock_submit_noisy_trials
+
+    sim_results = pathway.submit_pair(pathway.pairs[0]).result()
+    batches = [
+        (call.kwargs["first_trial"], call.kwargs["n_trials"])
+        for call in pathway.sim_runner.call_args_list
+    ]
+    assert batches == expected_batches
+    assert len(sim_results.voltages) == sum(n_trials for _, n_trials in expected_batches)
+
+    pathway.sim_runner.reset_mock()
+    pathway.run()
+    _, records = load_checkpoint(tmp_path / "pathway.checkpoint.jsonl")
+    assert [record["n_trials"] for record in records] == [len(sim_results.voltages)]
+    summary = yaml.safe_load((tmp_path / "pathway.summary.yaml").read_text())
+    assert summary["trials"] == {
+        "mean": len(sim_results.voltages),
+        "max": len(sim_results.voltages),
+    }
+    with h5py.File(tmp_path / "pathway.traces.h5", "r") as h5f:
+        assert h5f["traces/trials"].shape[1] == 12
+        ((*_, trials, _),) = iter_pair_traces(h5f)
+        assert len(trials) == len(sim_results.voltages)
+
+
+def test_submit_pair_adaptive_trials_failure(tmp_path):
+    pathway = _dummy_pathway(
+        {"output_dir": tmp_path, "adaptive_trials": test_module.AdaptiveTrials(tolerance=1e-6)}
+    )
+    failed = Future()
+    failed.set_exception(RuntimeError("simulation failed"))
+    pathway.sim_runner.side_effect = [_mock_submit_noisy_trials(n_trials=5), failed]
+
+    with pytest.raises(RuntimeError, match="simulation failed"):
+        pathway.submit_pair(pathway.pairs[0]).result()
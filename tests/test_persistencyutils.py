@@ -0,0 +1,244 @@
+import h5py
+import numpy as np
+import pytest
+from bluepysnap.circuit_ids import CircuitNodeId
+from numpy.testing import assert_array_equal
+
+import psp_validation.persistencyutils as test_module
+from psp_validation import PSPError
+
+from tests.utils import TEST_DATA_DIR_PSP
+
+PRE = CircuitNodeId(id=1, population="pre")
+POST = CircuitNodeId(id=2, population="post")
+
+
+def _random_pairs(n_pairs, n_trials=3, n_points=11):
+    rng = np.random.default_rng(0)
+    return [
+        (
+            CircuitNodeId("pre", k),
+            CircuitNodeId("post", 100 + k),
+            rng.normal(size=(n_trials, n_points)),
+            None if k % 2 else rng.normal(size=n_points),
+        )
+        for k in range(n_pairs)
+    ]
+
+
+def test_TraceWriter(tmp_path):
+    time = np.linspace(0, 1, 11)
+    pairs = _random_pairs(5)
+
+    with test_module.TraceWriter(tmp_path / "traces.h5", "voltage", flush_every=2) as writer:
+        for pre_gid, post_gid, trials, average in pairs:
+            writer.write(time, trials, average, pre_gid, post_gid)
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        assert h5f.attrs["version"] == test_module.TRACES_DUMP_VERSION
+        assert h5f.attrs["data"] == "voltage"
+        assert h5f["traces/trials"].shape == (5, 3, 11)
+        assert h5f["traces/trials"].chunks == (1, 3, 11)
+        assert h5f["traces/trials"].compression == "gzip"
+
+        loaded = list(test_module.iter_pair_traces(h5f))
+        assert len(loaded) == len(pairs)
+        for (pre_gid, post_gid, trials, average), actual in zip(pairs, loaded, strict=True):
+            assert actual[:2] == (pre_gid, post_gid)
+            assert_array_equal(actual[2], time)
+            assert_array_equal(actual[3], trials)
+            if average is None:
+                assert actual[4] is None
+            else:
+                assert_array_equal(actual[4], average)
+
+        time_, trials_, average_ = test_module.load_pair_traces(h5f, pairs[2][0], pairs[2][1])
+        assert_array_equal(time_, time)
+        assert_array_equal(trials_, pairs[2][2])
+        assert_array_equal(average_, pairs[2][3])
+
+        with pytest.raises(PSPError, match="No traces for pair"):
+            test_module.load_pair_traces(h5f, pairs[2][0], pairs[3][1])
+
+        # the pairs are looked up by name, without reading the pairs datasets
+        assert h5f["traces/index/pre_2-post_102"][()] == 2
+
+
+def test_TraceWriter_empty(tmp_path):
+    test_module.TraceWriter(tmp_path / "traces.h5", "current").close()
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        assert list(h5f) == []
+        assert list(test_module.iter_pair_traces(h5f)) == []
+        with pytest.raises(PSPError, match="No traces for pair"):
+            test_module.load_pair_traces(h5f, PRE, POST)
+
+
+def test_TraceWriter_shape_mismatch(tmp_path):
+    with test_module.TraceWriter(tmp_path / "traces.h5", "voltage") as writer:
+        writer.write(np.arange(3), np.zeros((2, 3)), None, PRE, POST)
+        with pytest.raises(PSPError, match="can not be appended"):
+            writer.write(np.arange(4), np.zeros((2, 4)), None, PRE, POST)
+
+
+def test_TraceWriter_n_trials(tmp_path):
+    time = np.linspace(0, 1, 11)
+    pairs = _random_pairs(2)
+    rng = np.random.default_rng(1)
+    pairs[1] = (*pairs[1][:2], rng.normal(size=(5, 11)), pairs[1][3])
+
+    with test_module.TraceWriter(tmp_path / "traces.h5", "voltage", n_trials=5) as writer:
+        for pre_gid, post_gid, trials, average in pairs:
+            writer.write(time, trials, average, pre_gid, post_gid)
+        with pytest.raises(PSPError, match="can not be appended"):
+            writer.write(time, np.zeros((6, 11)), None, PRE, POST)
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        assert h5f["traces/trials"].shape == (2, 5, 11)
+        assert np.isnan(h5f["traces/trials"][0, 3:]).all()
+
+        loaded = list(test_module.iter_pair_traces(h5f))
+        for (_, _, trials, _), actual in zip(pairs, loaded, strict=True):
+            assert_array_equal(actual[3], trials)
+        assert_array_equal(test_module.read_pair_traces(h5f, 0)[3], pairs[0][2])
+        _, trials, _ = test_module.load_pair_traces(h5f, pairs[0][0], pairs[0][1])
+        assert_array_equal(trials, pairs[0][2])
+
+
+def test_load_pair_traces_written_twice(tmp_path):
+    time = np.arange(3)
+    with test_module.TraceWriter(tmp_path / "traces.h5", "voltage") as writer:
+        writer.write(time, np.zeros((2, 3)), None, PRE, POST)
+        writer.write(time, np.ones((2, 3)), None, PRE, POST)
+
+    # the first row of the pair is looked up
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        _, trials, _ = test_module.load_pair_traces(h5f, PRE, POST)
+    assert_array_equal(trials, np.zeros((2, 3)))
+
+
+def test_load_pair_traces_version_1_1():
+    pre_gid, post_gid = CircuitNodeId("All", 11085), CircuitNodeId("All", 10126)
+    with h5py.File(TEST_DATA_DIR_PSP / "small-traces.h5", "r") as h5f:
+        assert h5f.attrs["version"] == "1.1"
+        group = h5f["traces/All_11085-All_10126"]
+        expected_trials = group["trials"][:]
+        expected_average = group["average"][:]
+        time, trials, average = test_module.load_pair_traces(h5f, pre_gid, post_gid)
+        [loaded] = test_module.iter_pair_traces(h5f)
+
+    assert_array_equal(time, expected_trials[0, 1])
+    assert_array_equal(trials, expected_trials[:, 0])
+    assert_array_equal(average, expected_average[0])
+    assert loaded[:2] == (pre_gid, post_gid)
+    assert_array_equal(loaded[3], trials)
+
+
+def test_load_pair_traces_version_1_2(tmp_path):
+    time = np.linspace(0, 1, 11)
+    trials = np.random.default_rng(0).normal(size=(3, 11))
+    with h5py.File(tmp_path / "traces.h5", "w") as h5f:
+        h5f.attrs["version"] = "1.2"
+        group = h5f.create_group("/traces/pre_1-post_2")
+        group.attrs.update(
+            {"pre_population": "pre", "pre_id": 1, "post_population": "post", "post_id": 2}
+        )
+        group["time"] = time
+        group["trials"] = trials
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        time_, trials_, average = test_module.load_pair_traces(h5f, PRE, POST)
+        [loaded] = test_module.iter_pair_traces(h5f)
+
+    assert_array_equal(time_, time)
+    assert_array_equal(trials_, trials)
+    assert average is None
+    assert loaded[:2] == (PRE, POST)
+
+
+def test_load_pair_traces_unsupported_version(tmp_path):
+    with h5py.File(tmp_path / "traces.h5", "w") as h5f:
+        h5f.attrs["version"] = "0.1"
+        with pytest.raises(PSPError, match="Unsupported trace dump version"):
+            test_module.load_pair_traces(h5f, PRE, POST)
+
+
+def test_BackgroundTraceWriter(tmp_path):
+    time = np.linspace(0, 1, 11)
+    pairs = _random_pairs(20)
+
+    writer = test_module.TraceWriter(tmp_path / "traces.h5", "voltage")
+    with test_module.BackgroundTraceWriter(writer, max_pending=2) as background_writer:
+        assert background_writer.path == tmp_path / "traces.h5"
+        for pre_gid, post_gid, trials, average in pairs:
+            background_writer.write(time, trials, average, pre_gid, post_gid)
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        loaded = list(test_module.iter_pair_traces(h5f))
+
+    assert [actual[:2] for actual in loaded] == [pair[:2] for pair in pairs]
+    for (_, _, trials, _), actual in zip(pairs, loaded, strict=True):
+        assert_array_equal(actual[3], trials)
+
+
+def _write_and_fail(background_writer):
+    background_writer.write(np.arange(3), np.zeros((2, 3)), None, PRE, POST)
+    raise ValueError("Dummy")
+
+
+def test_BackgroundTraceWriter_writes_pending_traces_on_error(tmp_path):
+    writer = test_module.TraceWriter(tmp_path / "traces.h5", "voltage")
+    with (
+        pytest.raises(ValueError, match="Dummy"),
+        test_module.BackgroundTraceWriter(writer) as background_writer,
+    ):
+        _write_and_fail(background_writer)
+
+    with h5py.File(tmp_path / "traces.h5", "r") as h5f:
+        assert len(list(test_module.iter_pair_traces(h5f))) == 1
+
+
+def test_BackgroundTraceWriter_error(tmp_path):
+    writer = test_module.TraceWriter(tmp_path / "traces.h5", "voltage")
+    background_writer = test_module.BackgroundTraceWriter(writer)
+    background_writer.write(np.arange(3), np.zeros((2, 3)), None, PRE, POST)
+    background_writer.write(np.arange(4), np.zeros((2, 4)), None, PRE, POST)
+
+    with pytest.raises(PSPError, match="Could not write the traces"):
+        background_writer.close()
+
+
+def test_TraceWriter_keep_pairs(tmp_path):
+    time = np.linspace(0, 1, 11)
+    pairs = _random_pairs(5)
+    path = tmp_path / "traces.h5"
+    assert test_module.count_pair_traces(path) == 0
+
+    with test_module.TraceWriter(path, "voltage") as writer:
+        for pre_gid, post_gid, trials, average in pairs[:3]:
+            writer.write(time, trials, average, pre_gid, post_gid)
+    assert test_module.count_pair_traces(path) == 3
+
+    # the third pair is dropped, and written again with the next ones
+    with test_module.TraceWriter(path, "voltage", keep_pairs=2) as writer:
+        for pre_gid, post_gid, trials, average in pairs[2:]:
+            writer.write(time, trials, average, pre_gid, post_gid)
+
+    with h5py.File(path, "r") as h5f:
+        loaded = list(test_module.iter_pair_traces(h5f))
+        # the index of the pairs dropped is updated too
+        assert len(h5f["traces/index"]) == 5
+        for pre_gid, post_gid, trials, _ in pairs:
+            assert_array_equal(test_module.load_pair_traces(h5f, pre_gid, post_gid)[1], trials)
+    assert [actual[:2] for actual in loaded] == [pair[:2] for pair in pairs]
+    for (_, _, trials, _), actual in zip(pairs, loaded, strict=True):
+        assert_array_equal(actual[3], trials)
+
+    with pytest.raises(PSPError, match="does not contain current traces"):
+        test_module.TraceWriter(path, "current", keep_pairs=2)
+    with pytest.raises(PSPError, match="contains the traces of 5 < 6 pairs"):
+        test_module.TraceWriter(path, "voltage", keep_pairs=6)
+
+    # the file is overwritten without pairs to keep
+    test_module.TraceWriter(path, "voltage", keep_pairs=0).close()
+    assert test_module.count_pair_traces(path) == 0
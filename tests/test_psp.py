@@ -1,8 +1,12 @@
 import os
+from concurrent.futures import Future
+from functools import partial
+from unittest.mock import MagicMock
 
 import pytest
 
 from psp_validation import psp
+from psp_validation.checkpoint import Terminated
 
 from tests.utils import PROJ12_ACCESS, TEST_DATA_DIR_PSP
 
@@ -30,3 +34,109 @@ def test_run(tmp_path):
         "SP_PVBC-SP_PC.summary.yaml",
         "SP_PVBC-SP_PC.amplitudes.txt",
     }
+
+    psp.reanalyze(
+        [input_folder / "usecases/hippocampus/pathways/SP_PVBC-SP_PC.yaml"],
+        tmp_path,
+        tmp_path / "reanalyzed",
+        dump_amplitudes=True,
+        jobs=1,
+    )
+    for name in ["SP_PVBC-SP_PC.summary.yaml", "SP_PVBC-SP_PC.amplitudes.txt"]:
+        assert (tmp_path / "reanalyzed" / name).read_text() == (tmp_path / name).read_text()
+
+
+def test_reanalyze_missing_traces(tmp_path):
+    with pytest.raises(psp.PSPError, match="Missing trace dumps"):
+        psp.reanalyze([tmp_path / "pathway.yaml"], tmp_path, tmp_path / "out")
+
+
+def test_run_adaptive_trials_voltage_clamp(tmp_path):
+    with pytest.raises(psp.PSPError, match="Can't run adaptive trials"):
+        psp.run(
+            [tmp_path / "pathway.yaml"],
+            tmp_path / "simulation_config.json",
+            tmp_path / "targets.yaml",
+            tmp_path,
+            num_pairs=1,
+            num_trials=10,
+            edge_population="default",
+            clamp="voltage",
+            adaptive_tolerance=0.1,
+        )
+
+
+def _mock_pathway(title, pairs, pair_cost, submitted):
+    def _submit_pair(pair):
+        submitted.append((title, pair))
+        future = Future()
+        future.set_result(pair)
+        return future
+
+    pathway = MagicMock(
+        title=title, pairs=pairs, pair_cost=pair_cost, pending_pairs=list(range(len(pairs)))
+    )
+    pathway.submit_pair.side_effect = _submit_pair
+    return pathway
+
+
+def test_run_pathways():
+    submitted = []
+    pathways = [
+        _mock_pathway("short", [1, 2], 100.0, submitted),
+        _mock_pathway("long", [3], 500.0, submitted),
+        _mock_pathway("empty", [], 500.0, submitted),
+    ]
+
+    psp.run_pathways(pathways)
+
+    # longest jobs first, then the pathway order
+    assert submitted == [("long", 3), ("short", 1), ("short", 2)]
+    for pathway in pathways:
+        pathway.process.assert_called_once()
+        futures = pathway.process.call_args.args[0]
+        assert [future.result() for future in futures] == pathway.pairs
+
+
+def test_run_pathways_streams_results():
+    submitted = []
+    pathways = [
+        _mock_pathway("short", [1, 2], 100.0, submitted),
+        _mock_pathway("long", [3], 500.0, submitted),
+    ]
+    processed = []
+
+    def _process(title, futures):
+        # the pathways are processed while the simulations of their pairs are still running
+        assert not any(future.done() for future in futures)
+        for future in futures:
+            future.set_result(None)
+            processed.append(title)
+
+    for pathway in pathways:
+        pathway.submit_pair.side_effect = lambda _: Future()
+        pathway.process.side_effect = partial(_process, pathway.title)
+
+    psp.run_pathways(pathways)
+
+    # in the order of submission
+    assert processed == ["long", "short", "short"]
+
+
+def test_run_pathways_terminated():
+    submitted = []
+    pathways = [
+        _mock_pathway("first", [1], 500.0, submitted),
+        _mock_pathway("second", [2], 100.0, submitted),
+    ]
+    pathways[0].process.side_effect = Terminated
+    # the simulation of the second pathway is still running
+    pathways[1].submit_pair.side_effect = lambda _: Future()
+
+    with pytest.raises(Terminated):
+        psp.run_pathways(pathways)
+
+    # the pathways not processed yet record their simulated pairs
+    pathways[0].flush.assert_not_called()
+    pathways[1].process.assert_not_called()
+    pathways[1].flush.assert_called_once()
@@ -1,10 +1,15 @@
+import json
+from concurrent.futures import Future
+from unittest.mock import MagicMock, call, patch
+
 import numpy as np
 import pandas as pd
 import pytest
 from bluepysnap.circuit_ids import CircuitNodeId
-from numpy.testing import assert_almost_equal
+from numpy.testing import assert_almost_equal, assert_array_equal
 
 import psp_validation.simulation as test_module
+from psp_validation import PSPError
 
 from tests.utils import PROJ12_ACCESS, TEST_DATA_DIR_CV, TEST_DATA_DIR_PSP
 
@@ -70,3 +75,284 @@ def test_run_pair_simulation_clamp_voltage():
     expected = [0, -0.0739914, -0.0609556, -0.0609562]
 
     assert_almost_equal(current[[0, 1000, 20000, -1]], expected)
+
+
+@pytest.mark.parametrize(
+    ("t_stim", "settle_margin", "record_dt", "expected"),
+    [
+        (800.0, 10.0, 0.1, 790.0),
+        ([900.0, 800.0], 10.0, 0.1, 790.0),
+        (800.0, 0.33, 0.1, 799.6),
+        (800.0, 0.33, None, 799.65),
+    ],
+)
+def test_get_settle_time(t_stim, settle_margin, record_dt, expected):
+    assert_almost_equal(test_module.get_settle_time(t_stim, settle_margin, record_dt), expected)
+
+
+@pytest.mark.parametrize(("t_stim", "settle_margin"), [(800.0, -1.0), (800.0, 800.0)])
+def test_get_settle_time_raises(t_stim, settle_margin):
+    with pytest.raises(PSPError, match="Settle margin"):
+        test_module.get_settle_time(t_stim, settle_margin, 0.1)
+
+
+@patch.object(test_module, "isolate", new=lambda func: func)
+@patch.object(test_module, "get_holding_current", return_value=0.1)
+@patch.object(test_module, "run_pair_simulation_from_snapshot")
+def test_run_pair_simulation_suite_settle_margin(mock_run, mock_holding_current):
+    mock_run.side_effect = lambda base_seeds, **_: [
+        ({}, np.arange(3), 0.1, np.full(3, seed)) for seed in base_seeds
+    ]
+
+    res = test_module.run_pair_simulation_suite(
+        sonata_simulation_config=None,
+        pre_gid=1,
+        post_gid=2,
+        t_stop=900.0,
+        t_stim=800.0,
+        record_dt=0.1,
+        base_seed=10,
+        hold_V=-70.0,
+        n_trials=5,
+        n_jobs=2,
+        settle_margin=10.0,
+        backend="serial",
+    )
+
+    # the holding current is computed once for all the trials
+    mock_holding_current.assert_called_once()
+    # one settling per job, trials are kept in the seed order
+    assert [call.kwargs["base_seeds"] for call in mock_run.call_args_list] == [
+        [10, 11, 12],
+        [13, 14],
+    ]
+    assert_array_equal(res.time, np.arange(3))
+    assert_array_equal(res.voltages, [np.full(3, seed) for seed in range(10, 15)])
+
+
+class _InlinePool:
+    """Pool running the tasks in the calling process when they are submitted."""
+
+    n_workers = 2
+
+    @staticmethod
+    def submit(func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+@patch.object(test_module, "get_holding_current", return_value=0.1)
+@patch.object(test_module, "run_pair_simulation")
+def test_submit_pair_simulation_suite(mock_run, mock_holding_current):
+    mock_run.side_effect = lambda base_seed, hold_I, **_: (
+        {},
+        np.arange(3),
+        hold_I,
+        np.full(3, base_seed),
+    )
+    cache = MagicMock()
+    cache.get.return_value = None
+
+    future = test_module.submit_pair_simulation_suite(
+        _InlinePool(),
+        sonata_simulation_config=None,
+        pre_gid=1,
+        post_gid=2,
+        t_stop=900.0,
+        t_stim=800.0,
+        record_dt=0.1,
+        base_seed=10,
+        hold_V=-70.0,
+        n_trials=3,
+        holding_current_cache=cache,
+    )
+    res = future.result()
+
+    mock_holding_current.assert_called_once()
+    cache.put.assert_called_once()
+    assert cache.put.call_args.args == (2, -70.0, False, 0.1)
+    assert [call.kwargs["base_seed"] for call in mock_run.call_args_list] == [10, 11, 12]
+    assert_array_equal(res.currents, [0.1, 0.1, 0.1])
+    assert_array_equal(res.voltages, [np.full(3, seed) for seed in range(10, 13)])
+
+    # the next trials of the pair, e.g. with adaptive trials
+    mock_run.reset_mock()
+    res = test_module.submit_pair_simulation_suite(
+        _InlinePool(),
+        sonata_simulation_config=None,
+        pre_gid=1,
+        post_gid=2,
+        t_stop=900.0,
+        t_stim=800.0,
+        record_dt=0.1,
+        base_seed=10,
+        hold_V=-70.0,
+        n_trials=2,
+        first_trial=3,
+        holding_current_cache=cache,
+    ).result()
+    assert [call.kwargs["base_seed"] for call in mock_run.call_args_list] == [13, 14]
+    assert_array_equal(res.voltages, [np.full(3, seed) for seed in range(13, 15)])
+
+
+@pytest.mark.parametrize("settle_margin", [None, 10.0])
+@patch.object(test_module, "get_holding_current", return_value=0.1)
+@patch.object(test_module, "run_pair_simulation_from_snapshot")
+@patch.object(test_module, "run_pair_simulation")
+def test_submit_pair_simulation_suite_simulation_cache(
+    mock_run, mock_run_from_snapshot, mock_holding_current, settle_margin
+):
+    mock_run.side_effect = lambda base_seed, hold_I, **_: (
+        {},
+        np.arange(3),
+        hold_I,
+        np.full(3, base_seed),
+    )
+    mock_run_from_snapshot.side_effect = lambda base_seeds, **kwargs: [
+        mock_run(base_seed=seed, **kwargs) for seed in base_seeds
+    ]
+    cached = {}
+    simulation_cache = MagicMock()
+    simulation_cache.get.side_effect = lambda trial: cached.get(json.dumps(trial, default=str))
+    simulation_cache.put.side_effect = lambda trial, result: cached.update(
+        {json.dumps(trial, default=str): result}
+    )
+
+    def _submit(n_trials):
+        return test_module.submit_pair_simulation_suite(
+            _InlinePool(),
+            sonata_simulation_config=None,
+            pre_gid=1,
+            post_gid=2,
+            t_stop=900.0,
+            t_stim=800.0,
+            record_dt=0.1,
+            base_seed=10,
+            hold_V=-70.0,
+            n_trials=n_trials,
+            settle_margin=settle_margin,
+            simulation_cache=simulation_cache,
+        ).result()
+
+    _submit(3)
+    assert len(cached) == 3
+    mock_run.reset_mock()
+
+    # only the missing trials are simulated
+    res = _submit(5)
+    assert [call.kwargs["base_seed"] for call in mock_run.call_args_list] == [13, 14]
+    assert_array_equal(res.voltages, [np.full(3, seed) for seed in range(10, 15)])
+    assert len(cached) == 5
+
+    mock_run.reset_mock()
+    res = _submit(4)
+    mock_run.assert_not_called()
+    assert_array_equal(res.voltages, [np.full(3, seed) for seed in range(10, 14)])
+
+    # without a holding current cache, the holding current is computed for each pair
+    assert mock_holding_current.call_count == 3
+
+
+@pytest.mark.skipif(not PROJ12_ACCESS, reason="No access to proj12")
+@pytest.mark.parametrize("hold_I", [0.02, None])
+def test_run_pair_simulation_from_snapshot(hold_I):
+    pair_df = pd.read_csv(PAIRS)
+    kwargs = {
+        "sonata_simulation_config": SIMULATION_CONFIG,
+        "pre_gid": CircuitNodeId(id=pair_df.pre_id[0], population=pair_df.pre_population[0]),
+        "post_gid": CircuitNodeId(id=pair_df.post_id[0], population=pair_df.post_population[0]),
+        "record_dt": None,  # Use what's in BlueConfig
+        "nrrp": 1,
+        "hold_V": -73.0,
+        "hold_I": hold_I,
+        "t_stim": 800.0,
+        "t_stop": 1000.0,
+    }
+    base_seeds = [int(pair_df.seed[0]), int(pair_df.seed[0]) + 1]
+
+    results = test_module.run_pair_simulation_from_snapshot(
+        base_seeds=base_seeds, settle_margin=10.0, **kwargs
+    )
+
+    assert len(results) == len(base_seeds)
+    for base_seed, (_, time, current, voltage) in zip(base_seeds, results, strict=True):
+        _, expected_time, expected_current, expected_voltage = test_module.run_pair_simulation(
+            base_seed=base_seed, **kwargs
+        )
+        assert_almost_equal(time, expected_time)
+        assert_almost_equal(current, expected_current)
+        assert_almost_equal(voltage, expected_voltage)
+
+
+@patch.object(test_module, "_get_recordings")
+@patch.object(test_module, "_instantiate_pair_simulation")
+@patch.object(test_module, "_bluecellulab")
+def test_run_pair_simulation_from_snapshot_reseeding(
+    mock_bluecellulab, mock_instantiate, mock_get_recordings
+):
+    h = mock_bluecellulab.return_value.neuron.h
+    synapses = {
+        index: MagicMock(randseed1=index, randseed2=10 + index, randseed3=20 + index)
+        for index in range(2)
+    }
+    simulation = MagicMock()
+    mock_instantiate.return_value = (simulation, MagicMock(synapses=synapses), {"e_AMPA": 0.0})
+
+    # settled until 5 ms, then each trial records again from the restored time point
+    settled_time = np.arange(0, 5.01, 1.0)
+    trial_time = np.arange(5, 10.01, 1.0)
+    mock_get_recordings.side_effect = [
+        (settled_time, 0.02, np.full(len(settled_time), -70.0)),
+        (trial_time, 0.02, np.full(len(trial_time), 1.0)),
+        (trial_time, 0.02, np.full(len(trial_time), 2.0)),
+    ]
+
+    # record the order of the calls restoring and reseeding each trial
+    calls = MagicMock()
+    calls.attach_mock(h.SaveState.return_value.restore, "restore")
+    calls.attach_mock(h.Random.return_value.Random123_globalindex, "globalindex")
+    for index, synapse in synapses.items():
+        calls.attach_mock(synapse.hsynapse.setRNG, f"setRNG{index}")
+    calls.attach_mock(h.frecord_init, "frecord_init")
+    calls.attach_mock(h.continuerun, "continuerun")
+
+    results = test_module.run_pair_simulation_from_snapshot(
+        sonata_simulation_config=SIMULATION_CONFIG,
+        pre_gid=CircuitNodeId("pre", 0),
+        post_gid=CircuitNodeId("post", 1),
+        t_stop=10.0,
+        t_stim=6.0,
+        record_dt=1.0,
+        base_seeds=[42, 43],
+        settle_margin=1.0,
+        hold_I=0.02,
+        hold_V=-70.0,
+    )
+
+    # the cell is instantiated and settled once
+    assert mock_instantiate.call_count == 1
+    assert mock_instantiate.call_args.args[7] == 42
+    simulation.run.assert_called_once_with(t_stop=5.0, dt=0.025, v_init=-70.0, forward_skip=False)
+    h.SaveState.return_value.save.assert_called_once_with()
+
+    # each trial restores the state, then recreates the synapse streams with its own seed
+    expected_calls = []
+    for seed in [42, 43]:
+        expected_calls += [
+            call.restore(),
+            call.globalindex(seed),
+            call.setRNG0(0, 10, 20),
+            call.setRNG1(1, 11, 21),
+            call.frecord_init(),
+            call.continuerun(10.0),
+        ]
+    assert calls.mock_calls == expected_calls
+    simulation.delete.assert_called_once_with()
+
+    assert len(results) == 2
+    for expected_voltage, (params, time, current, voltage) in zip([1.0, 2.0], results, strict=True):
+        assert params == {"e_AMPA": 0.0}
+        assert_array_equal(time, np.arange(0, 10.01, 1.0))
+        assert current == pytest.approx(0.02)
+        assert_array_equal(voltage, [-70.0] * 5 + [expected_voltage] * 6)
@@ -1,6 +1,7 @@
 from itertools import repeat
 
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal
 
 import psp_validation.trace_filters as test_module
@@ -173,7 +174,8 @@ def test_AmplitudeFilter_filter_all_flat_inh():
     assert_array_equal(filtered, [])
 
 
-def test_AmplitudeFilter_filter():
+@pytest.mark.parametrize("backend", ["efel", "numpy"])
+def test_AmplitudeFilter_filter(backend):
     t = np.linspace(1, 10, 100)
     vs = [np.full(100, 10.0 * i) for i in range(6)]
     vs[0][30:40] += 10  # perturbation
@@ -183,8 +185,39 @@ def test_AmplitudeFilter_filter():
     vs[4][30:40] -= 10  # negative perturbation (ignored in EXC)
     traces = _make_traces(vs, t)
 
-    tf = test_module.AmplitudeFilter(2, 4, "EXC")
+    tf = test_module.AmplitudeFilter(2, 4, "EXC", backend=backend)
     filtered = np.array(tf(traces))
 
     assert filtered.shape == (3, 2, 100)
     assert_array_equal(filtered, traces[:3])
+
+
+def test_NullFilter_mask():
+    t = np.linspace(1, 10, 100)
+    vs = np.array([np.full(100, 10.0 * i) for i in range(3)])
+    vs[1] = np.nan
+
+    assert_array_equal(test_module.NullFilter().mask(t, vs), [True, False, True])
+    assert_array_equal(test_module.NullFilter().mask(t[:0], vs[:, :0]), [False, False, False])
+
+
+def test_SpikeFilter_mask():
+    t = np.linspace(1, 10, 100)
+    vs = np.array([np.full(100, 10.0 * i) for i in range(5)])
+    vs[0, 5] = 50  # spike before t_start is ignored
+
+    tf = test_module.SpikeFilter(2, 25)
+    assert_array_equal(tf.mask(t, vs), [True, True, True, False, False])
+
+
+@pytest.mark.parametrize("backend", ["efel", "numpy"])
+def test_AmplitudeFilter_mask(backend):
+    t = np.linspace(1, 10, 100)
+    vs = np.array([np.full(100, 10.0 * i) for i in range(4)])
+    vs[0, 30:40] += 10  # perturbation
+    vs[1, 30:40] += 1  # too small perturbation (trace should be filtered out)
+    vs[2, 30:40] -= 10  # negative perturbation (ignored in EXC)
+
+    tf = test_module.AmplitudeFilter(2, 4, "EXC", backend=backend)
+    assert_array_equal(tf.mask(t, vs), [True, False, False, False])
+    assert_array_equal(tf.mask(t, vs[:0]), [])
@@ -1,6 +1,10 @@
+import json
 import pathlib
+from concurrent.futures import Future
 from itertools import repeat
 
+import h5py
+import libsonata
 import numpy as np
 
 from psp_validation.simulation import SimulationResult
@@ -20,3 +24,71 @@ def mock_run_pair_simulation_suite(*_, **__):
     time = data[:, 0]
     voltage = data[:, 1]
     return SimulationResult({"e_GABAA": -90}, time, [voltage], [voltage])
+
+
+def mock_submit_pair_simulation_suite(*_, **__):
+    future = Future()
+    future.set_result(mock_run_pair_simulation_suite())
+    return future
+
+
+def create_test_circuit(path, n_nodes=30, n_edges=400, seed=0):
+    """Create a small SONATA circuit with random edges, and return the circuit config path.
+
+    Nodes of the single "default" population alternate between mtypes "A" and "B".
+    """
+    rng = np.random.default_rng(seed)
+    path = pathlib.Path(path)
+
+    with h5py.File(path / "nodes.h5", "w") as h5f:
+        population = h5f.create_group("nodes/default")
+        population.create_dataset("node_type_id", data=np.full(n_nodes, -1))
+        group = population.create_group("0")
+        for axis in "xyz":
+            group.create_dataset(axis, data=rng.uniform(0, 100, n_nodes))
+        for name, values in [
+            ("mtype", np.array(["A", "B"])[np.arange(n_nodes) % 2]),
+            ("model_type", np.full(n_nodes, "biophysical")),
+        ]:
+            group.create_dataset(name, data=values.astype(object), dtype=h5py.string_dtype())
+
+    source_ids = rng.integers(0, n_nodes, n_edges)
+    target_ids = rng.integers(0, n_nodes, n_edges)
+    order = np.lexsort((source_ids, target_ids))
+    with h5py.File(path / "edges.h5", "w") as h5f:
+        population = h5f.create_group("edges/default")
+        for name, ids in [("source_node_id", source_ids), ("target_node_id", target_ids)]:
+            dataset = population.create_dataset(name, data=ids[order].astype(np.uint64))
+            dataset.attrs["node_population"] = "default"
+        population.create_dataset("edge_type_id", data=np.full(n_edges, -1))
+        population.create_group("0")
+    libsonata.EdgePopulation.write_indices(str(path / "edges.h5"), "default", n_nodes, n_nodes)
+
+    circuit_config = path / "circuit_config.json"
+    circuit_config.write_text(
+        json.dumps(
+            {
+                "networks": {
+                    "nodes": [
+                        {
+                            "nodes_file": str(path / "nodes.h5"),
+                            "populations": {
+                                "default": {
+                                    "type": "biophysical",
+                                    "morphologies_dir": str(path),
+                                    "biophysical_neuron_models_dir": str(path),
+                                }
+                            },
+                        }
+                    ],
+                    "edges": [
+                        {
+                            "edges_file": str(path / "edges.h5"),
+                            "populations": {"default": {"type": "chemical"}},
+                        }
+                    ],
+                }
+            }
+        )
+    )
+    return circuit_config